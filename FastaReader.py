@@ -1,9 +1,26 @@
 
 from __future__ import absolute_import
 
-import gzip
+import re
 from os.path import abspath, expanduser
 
+from GzipReader import open_gzip
+
+
+CHUNK_SIZE = 1 << 20
+# [key=value] fields of NCBI translated_cds header with the gene id used by KEGG,
+# GeneID is the first of db_xref such as [db_xref=GeneID:939978]
+NCBI_HEADER_PATTERN = r"\[(?:db_xref=)?(locus_tag|GeneID|protein_id)[=:]([^\]]*)"
+NCBI_HEADER_FIELDS = {
+    str: re.compile(NCBI_HEADER_PATTERN).findall,
+    bytes: re.compile(NCBI_HEADER_PATTERN.encode()).findall,
+}
+# keys of the gene id in order and the version separator
+NCBI_GENE_TOKENS = {
+    str: ("locus_tag", "GeneID", "protein_id", "."),
+    bytes: (b"locus_tag", b"GeneID", b"protein_id", b"."),
+}
+
 
 def split_header(name):
     """
@@ -19,6 +36,37 @@ def split_header(name):
     return parts
 
 
+def parse_ncbi_header(name):
+    """
+    get the gene fields of NCBI translated_cds header in one scan, such as
+    "lcl|... [locus_tag=BSU00010] [db_xref=GeneID:939978] [protein_id=AAB00001.1] ..."
+    :param name: the header in str or bytes
+    :return: dict {key: value} of locus_tag, GeneID and protein_id found, in the type of name
+    """
+    # the first field of a key is kept
+    return dict(reversed(NCBI_HEADER_FIELDS[type(name)](name)))
+
+
+def ncbi_gene_id(name):
+    """
+    get the gene id used by KEGG from NCBI translated_cds header,
+    it is locus_tag, GeneID or protein_id without version in order
+    :param name: the header in str or bytes
+    :return: the id in the type of name, None if not found
+    """
+    locus, gene, protein, dot = NCBI_GENE_TOKENS[type(name)]
+    fields = parse_ncbi_header(name)
+
+    if locus in fields:
+        return fields[locus]
+    if gene in fields:
+        return fields[gene]
+    if protein in fields:
+        return fields[protein].split(dot, 1)[0]
+
+    return None
+
+
 class FastaRecord(object):
     """
     object to process a fasta record
@@ -100,6 +148,77 @@ class FastaRecord(object):
         return ">%s\n%s" % (self.name, self.seq)
 
 
+class LazyFastaRecord(object):
+    """
+    light object of a fasta record, keeps the raw bytes of name and seq,
+    id and description are split from name on first access
+    """
+    DELIMITER = b">"
+    __slots__ = ("raw_name", "raw_seq", "_id", "_description")
+
+    def __init__(self, name, seq, validate=False):
+        if validate and (b"\n" in name or b"\n" in seq or self.DELIMITER in seq):
+            raise ValueError("Invalid FASTA record data")
+
+        self.raw_name = name
+        self.raw_seq = seq
+        self._id = None
+        self._description = None
+
+    def _split_header(self):
+        self._id, self._description = split_header(self.name)
+
+    @property
+    def name(self):
+        """
+        the name of the seq, strings after ">"
+        """
+        return self.raw_name.decode()
+
+    @property
+    def id(self):
+        """
+        The id of the seq, equal to the FASTA header
+        up to the first whitespace.
+        """
+        if self._id is None:
+            self._split_header()
+
+        return self._id
+
+    @property
+    def description(self):
+        """
+        The description of the seq in the FASTA file, equal to
+        the contents of the FASTA header following the first whitespace
+        """
+        if self._description is None:
+            self._split_header()
+
+        return self._description
+
+    @property
+    def seq(self):
+        """
+        The seq of the record
+        """
+        return self.raw_seq.decode()
+
+    @property
+    def length(self):
+        """
+        the length of the seq
+        """
+        return len(self.raw_seq)
+
+    def __str__(self):
+        """
+        str conversion
+        :return:
+        """
+        return ">%s\n%s" % (self.name, self.seq)
+
+
 def check_format(filename):
     """
     check the format of file
@@ -139,19 +258,129 @@ def yield_fasta_records(stream):
         yield FastaRecord.from_string(string)
 
 
-def open_fasta(filename):
+def parse_fasta_bytes(data):
+    """
+    split the bytes of a single fasta record to name and seq
+    :param data: bytes start with ">", lines of seq may be wrapped
+    :return: (name, seq) in bytes, None if data is blank
+    """
+    data = data.strip()
+
+    if not data:
+        return None
+
+    end = data.find(b"\n")
+
+    if data[:1] != b">" or end == -1:
+        raise ValueError("String not recognized as a valid FASTA record")
+
+    return data[1:end].strip(), b"".join(data[end+1:].split())
+
+
+def yield_fasta_bytes(stream, chunk_size=CHUNK_SIZE):
+    """
+    yield fasta records from a binary stream, the stream is read in chunks and
+    records are split at the ">" of line start, each record is joined only once
+    :param stream: a binary stream object
+    :param chunk_size: bytes read from stream each time
+    :return: (name, seq) in bytes
+    """
+    pieces = []
+    last = b"\n"
+
+    while True:
+        chunk = stream.read(chunk_size)
+
+        if not chunk:
+            break
+
+        start = 0
+
+        # the ">" at the start of a chunk is a record boundary if the previous chunk ends a line
+        if last == b"\n" and chunk[:1] == b">":
+            if pieces:
+                record = parse_fasta_bytes(b"".join(pieces))
+                pieces = []
+
+                if record:
+                    yield record
+
+        pos = chunk.find(b"\n>")
+
+        while pos != -1:
+            pieces.append(chunk[start:pos+1])
+            record = parse_fasta_bytes(b"".join(pieces))
+            pieces = []
+
+            if record:
+                yield record
+
+            start = pos + 1
+            pos = chunk.find(b"\n>", start)
+
+        pieces.append(chunk[start:])
+        last = chunk[-1:]
+
+    if pieces:
+        record = parse_fasta_bytes(b"".join(pieces))
+
+        if record:
+            yield record
+
+
+def yield_fasta_index(stream, offset=0):
+    """
+    yield the .fai fields of records from a binary stream
+    :param stream: a binary stream object
+    :param offset: offset of the stream start in the file indexed
+    :return: (name, length, offset, linebases, linewidth), name is the header up to the first whitespace
+    """
+    name = None
+    pos = offset
+    length = start = linebases = linewidth = 0
+
+    for line in stream:
+
+        if line.startswith(b">"):
+            if name is not None:
+                yield name, length, start, linebases, linewidth
+
+            name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+            length = linebases = linewidth = 0
+            start = pos + len(line)
+        elif name is not None:
+            bases = len(line.rstrip(b"\r\n"))
+
+            if not linewidth:
+                linebases, linewidth = bases, len(line)
+
+            length += bases
+
+        pos += len(line)
+
+    if name is not None:
+        yield name, length, start, linebases, linewidth
+
+
+def open_fasta(filename, lazy=False, validate=True, threads=1):
     """
     read fasta file and return fasta records
     :param filename:
+    :param lazy: return LazyFastaRecord instead of FastaRecord
+    :param validate: check the records, only works with lazy
+    :param threads: threads to decompress .gz file, see GzipReader.open_gzip
     :return:
     """
     check_format(filename)
     filename = abspath(expanduser(filename))
-    mode = 'r'
+    mode = 'rb'
 
     if filename.endswith(".gz"):
-        stream = gzip.open(filename, mode)
+        stream = open_gzip(filename, threads)
     else:
         stream = open(filename, mode)
 
-    return yield_fasta_records(stream)
+    if lazy:
+        return (LazyFastaRecord(name, seq, validate) for name, seq in yield_fasta_bytes(stream))
+
+    return (FastaRecord(name.decode(), seq.decode()) for name, seq in yield_fasta_bytes(stream))
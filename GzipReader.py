@@ -0,0 +1,484 @@
+from __future__ import absolute_import
+
+import os
+import gzip
+import zlib
+import queue
+import struct
+import threading
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 4 << 20
+
+
+def _put(queue_, closed, item):
+
+    while not closed.is_set():
+        try:
+            queue_.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def _produce(chunks, queue_, closed):
+
+    try:
+        for chunk in chunks:
+            if chunk and not _put(queue_, closed, chunk):
+                break
+        else:
+            _put(queue_, closed, None)
+    except Exception as e:
+        _put(queue_, closed, e)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class ThreadedReader(object):
+    """
+    binary file-like object, the chunks are produced by a background thread
+    and buffered in a bounded queue, so that producing overlaps with reading
+    """
+
+    def __init__(self, chunks, queue_size=8):
+        self._queue = queue.Queue(queue_size)
+        self._closed = threading.Event()
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+        # the thread keeps no reference to self, so an abandoned reader can be collected
+        self._thread = threading.Thread(target=_produce, args=(chunks, self._queue, self._closed))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        """
+        get next chunk from queue, return False at the end of stream
+        """
+        while self._pos >= len(self._buffer):
+
+            if self._eof:
+                return False
+
+            item = self._queue.get()
+
+            if item is None or isinstance(item, Exception):
+                self._eof = True
+                self._buffer, self._pos = b"", 0
+
+                if item is not None:
+                    raise item
+
+                return False
+
+            self._buffer, self._pos = item, 0
+
+        return True
+
+    def read(self, size=-1):
+        """
+        read at most size bytes, read all if size is negative
+        """
+        if size is None or size < 0:
+            parts = []
+
+            while self._fill():
+                parts.append(self._buffer[self._pos:])
+                self._pos = len(self._buffer)
+
+            return b"".join(parts)
+
+        if not size or not self._fill():
+            return b""
+
+        if self._pos == 0 and size >= len(self._buffer):
+            chunk = self._buffer
+        else:
+            chunk = self._buffer[self._pos:self._pos+size]
+
+        self._pos += len(chunk)
+
+        return chunk
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self._closed.set()
+
+
+def parse_member_header(data):
+    """
+    parse the header of a gzip member
+    :param data: bytes start with a gzip member
+    :return: (header size, BSIZE), BSIZE is None if the member is not a BGZF block
+    """
+    if len(data) < 12 or data[:3] != b"\x1f\x8b\x08":
+        raise ValueError("not a gzip member")
+
+    if not data[3] & 4:
+        return 10, None
+
+    xlen = struct.unpack("<H", data[10:12])[0]
+    extra = data[12:12+xlen]
+    pos = 0
+
+    while pos + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[pos+2:pos+4])[0]
+
+        if extra[pos:pos+2] == b"BC" and slen == 2:
+            return 12 + xlen, struct.unpack("<H", extra[pos+4:pos+6])[0]
+
+        pos += 4 + slen
+
+    return 12 + xlen, None
+
+
+def is_bgzf(filename):
+    """
+    check whether the file is BGZF compressed
+    :param filename:
+    :return: True or False
+    """
+    with open(filename, "rb") as fh:
+        data = fh.read(1 << 16)
+
+    try:
+        return parse_member_header(data)[1] is not None
+    except ValueError:
+        return False
+
+
+def inflate_members(stream, chunk_size=CHUNK_SIZE, index=None):
+    """
+    decompress a gzip stream of one or more members
+    :param stream: binary stream of compressed data
+    :param chunk_size: compressed bytes read each time
+    :param index: a list, (compressed offset, uncompressed offset) of each member is appended if set
+    :return: yield decompressed chunks
+    """
+    pos = 0
+    total = 0
+    fed = False
+    decomp = zlib.decompressobj(31)
+    data = stream.read(chunk_size)
+
+    if index is not None and data:
+        index.append((0, 0))
+
+    while data:
+        chunk = decomp.decompress(data)
+        fed = True
+
+        if chunk:
+            total += len(chunk)
+            yield chunk
+
+        if not decomp.eof:
+            pos += len(data)
+            data = stream.read(chunk_size)
+            continue
+
+        rest = decomp.unused_data
+        pos += len(data) - len(rest)
+
+        if not rest:
+            rest = stream.read(chunk_size)
+
+        # null bytes may pad the end of file
+        if not rest.strip(b"\0"):
+            break
+
+        decomp = zlib.decompressobj(31)
+        fed = False
+
+        if index is not None:
+            index.append((pos, total))
+
+        data = rest
+
+    if fed and not decomp.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
+def iter_bgzf_blocks(stream):
+    """
+    yield the raw BGZF blocks of a stream
+    :param stream: binary stream of BGZF file
+    :return: bytes of each block
+    """
+    while True:
+        head = stream.read(18)
+
+        if not head:
+            break
+
+        size, bsize = parse_member_header(head)
+
+        if size > len(head):
+            head += stream.read(size - len(head))
+            size, bsize = parse_member_header(head)
+
+        if bsize is None:
+            raise ValueError("not a BGZF block")
+
+        block = head + stream.read(bsize + 1 - len(head))
+
+        if len(block) != bsize + 1:
+            raise EOFError("BGZF block is truncated")
+
+        yield block
+
+
+def iter_index_members(stream, index):
+    """
+    yield the raw gzip members of a stream by index
+    :param stream: binary stream of gzip file
+    :param index: see build_gzip_index
+    :return: bytes of each member
+    """
+    offsets = [i[0] for i in index]
+
+    for start, end in zip(offsets, offsets[1:] + [None]):
+        stream.seek(start)
+        yield stream.read(-1 if end is None else end - start)
+
+
+def inflate_batch(members):
+    """
+    decompress complete gzip members
+    :param members: a list of bytes
+    :return: decompressed bytes
+    """
+    return b"".join([zlib.decompress(i, 31) for i in members])
+
+
+def inflate_parallel(members, threads, batch_size=BATCH_SIZE):
+    """
+    decompress complete gzip members with a thread pool, zlib releases the GIL while inflating
+    :param members: iterator of gzip members
+    :param threads: number of threads
+    :param batch_size: compressed bytes decompressed by a thread each time
+    :return: yield decompressed chunks in order
+    """
+    futures = deque()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        batch = []
+        size = 0
+
+        for member in members:
+            batch.append(member)
+            size += len(member)
+
+            if size < batch_size:
+                continue
+
+            futures.append(pool.submit(inflate_batch, batch))
+            batch = []
+            size = 0
+
+            if len(futures) > threads * 2:
+                yield futures.popleft().result()
+
+        if batch:
+            futures.append(pool.submit(inflate_batch, batch))
+
+        while futures:
+            yield futures.popleft().result()
+
+
+def build_gzip_index(filename):
+    """
+    index the members of a gzip file, BGZF blocks are read from headers,
+    other gzip files are decompressed once
+    :param filename:
+    :return: list of (compressed offset, uncompressed offset)
+    """
+    r = []
+
+    with open(filename, "rb") as fh:
+
+        if not is_bgzf(filename):
+            for chunk in inflate_members(fh, index=r):
+                pass
+
+            return r
+
+        pos = total = 0
+
+        for block in iter_bgzf_blocks(fh):
+            r.append((pos, total))
+            pos += len(block)
+            total += struct.unpack("<I", block[-4:])[0]
+
+    return r
+
+
+def write_gzip_index(index, file):
+    """
+    write index to file in the .gzi format of bgzip
+    :param index: see build_gzip_index
+    :param file: output file
+    :return: 0
+    """
+    index = [i for i in index if i != (0, 0)]
+
+    with open(file, "wb") as fh:
+        fh.write(struct.pack("<Q", len(index)))
+
+        for i in index:
+            fh.write(struct.pack("<QQ", *i))
+
+    return 0
+
+
+def read_gzip_index(file):
+    """
+    read .gzi index
+    :param file:
+    :return: see build_gzip_index
+    """
+    r = [(0, 0)]
+
+    with open(file, "rb") as fh:
+        data = fh.read()
+
+    num = struct.unpack("<Q", data[:8])[0]
+
+    for i in range(num):
+        r.append(struct.unpack("<QQ", data[8+16*i:24+16*i]))
+
+    return r
+
+
+def find_gzip_index(filename):
+    """
+    read the index of filename from filename.gzi if it is newer than filename
+    :param filename:
+    :return: see build_gzip_index, None if no index found
+    """
+    file = filename + ".gzi"
+
+    if os.path.exists(file) and os.path.getmtime(file) >= os.path.getmtime(filename):
+        return read_gzip_index(file)
+
+    return None
+
+
+def _read_members(filename, index):
+
+    with open(filename, "rb") as fh:
+
+        if index:
+            for member in iter_index_members(fh, index):
+                yield member
+        else:
+            for block in iter_bgzf_blocks(fh):
+                yield block
+
+
+def _read_stream(filename, chunk_size):
+
+    with open(filename, "rb") as fh:
+        for chunk in inflate_members(fh, chunk_size):
+            yield chunk
+
+
+def open_gzip(filename, threads=1, queue_size=8, chunk_size=CHUNK_SIZE):
+    """
+    open gzip file for binary reading, the decompression runs in background threads.
+    BGZF files and files indexed by filename.gzi are decompressed in parallel blocks,
+    other files are decompressed in a single background thread.
+    :param filename:
+    :param threads: number of threads to decompress, 0 means decompress in the calling thread
+    :param queue_size: max decompressed chunks buffered
+    :param chunk_size: compressed bytes read each time
+    :return: a binary file-like object
+    """
+    if threads < 1:
+        return gzip.open(filename, "rb")
+
+    index = find_gzip_index(filename)
+
+    # the index of a single member has only (0, 0), nothing to decompress in parallel
+    if index is not None and len(index) < 2:
+        index = None
+
+    if index or is_bgzf(filename):
+        chunks = inflate_parallel(_read_members(filename, index), threads)
+    else:
+        chunks = _read_stream(filename, chunk_size)
+
+    return ThreadedReader(chunks, queue_size)
+
+
+class IndexedGzipReader(object):
+    """
+    random access to the decompressed data of an indexed gzip file
+    """
+
+    def __init__(self, filename, index=None):
+        self.filename = filename
+
+        if index is None:
+            index = find_gzip_index(filename) or build_gzip_index(filename)
+
+        self._index = index
+        self._uoffsets = [i[1] for i in index]
+        self._fh = open(filename, "rb")
+
+    def read_at(self, offset, size):
+        """
+        read size bytes start from the uncompressed offset
+        :param offset: uncompressed offset
+        :param size: bytes to read
+        :return: bytes
+        """
+        n = bisect_right(self._uoffsets, offset) - 1
+        coffset, uoffset = self._index[max(n, 0)]
+        skip = offset - uoffset
+        parts = []
+        self._fh.seek(coffset)
+
+        for chunk in inflate_members(self._fh, 1 << 16):
+
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+
+            parts.append(chunk[skip:skip+size])
+            size -= len(parts[-1])
+            skip = 0
+
+            if size <= 0:
+                break
+
+        return b"".join(parts)
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
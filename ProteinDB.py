@@ -0,0 +1,212 @@
+from __future__ import absolute_import
+
+import os
+import mmap
+import heapq
+import struct
+import tempfile
+
+from common import map_file
+
+
+# header of protein index: magic, version, number of entries, offset of the entry table
+INDEX_MAGIC = b"KGPI"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct("<4sIQQ")
+RUN_SIZE = 1 << 20
+
+
+class ProteinIndexWriter(object):
+    """
+    write the sorted index of protein id to KO, pathway and the .fai fields of the seq.
+    entries are sorted in runs of temporary files and merged at close, so memory is bounded by run_size
+    """
+
+    def __init__(self, file, run_size=RUN_SIZE):
+        self.file = file
+        self.run_size = run_size
+        self._entries = []
+        self._runs = []
+
+    def add(self, id, ko, path, length, offset, linebases, linewidth):
+        """
+        add a protein
+        :param id: protein id, the header of fasta up to the first whitespace
+        :param ko: KOs joined with ";"
+        :param path: pathways joined with ";"
+        :param length, offset, linebases, linewidth: see .fai
+        """
+        self._entries.append(("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+            id, ko, path, length, offset, linebases, linewidth)).encode())
+
+        if len(self._entries) >= self.run_size:
+            self._flush()
+
+    def _flush(self):
+        # "\t" sorts before any char of id, so sorting lines sorts ids
+        self._entries.sort()
+        run = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.file)))
+        run.writelines(self._entries)
+        run.seek(0)
+        self._runs.append(run)
+        self._entries = []
+
+    def close(self):
+        """
+        merge runs and write the index
+        :return: number of entries
+        """
+        self._entries.sort()
+        entries = heapq.merge(self._entries, *self._runs)
+        offsets = []
+        tmp = self.file + ".tmp"
+
+        with open(tmp, "wb") as fh:
+            fh.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0, 0))
+            pos = INDEX_HEADER.size
+
+            for entry in entries:
+                offsets.append(pos)
+                fh.write(entry)
+                pos += len(entry)
+
+            for run in self._runs:
+                run.close()
+
+            fh.write(struct.pack("<%sQ" % len(offsets), *offsets))
+            fh.seek(0)
+            fh.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(offsets), pos))
+
+        os.replace(tmp, self.file)
+        self._entries = []
+        self._runs = []
+
+        return len(offsets)
+
+
+def write_fai(entries, file):
+    """
+    write .fai
+    :param entries: (name, length, offset, linebases, linewidth), see FastaReader.yield_fasta_index
+    :param file: output file
+    :return: 0
+    """
+    with open(file, "w") as fh:
+        for entry in entries:
+            fh.write("%s\t%s\t%s\t%s\t%s\n" % entry)
+
+    return 0
+
+
+class ProteinDB(object):
+    """
+    random access to the proteins of database created by makedb.py --index,
+    the fasta and the sorted index are mapped and searched in O(log n)
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: output prefix of makedb.py, {prefix}.pep.fasta and {prefix}.pep.idx are used
+        """
+        self._fasta = map_file(prefix + ".pep.fasta")
+        self._index = map_file(prefix + ".pep.idx")
+
+        if len(self._index) < INDEX_HEADER.size:
+            raise ValueError("%r is not a protein index" % (prefix + ".pep.idx"))
+
+        magic, version, self._num, self._table = INDEX_HEADER.unpack_from(self._index, 0)
+
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%r is not a protein index" % (prefix + ".pep.idx"))
+
+    def _entry(self, n):
+        start = struct.unpack_from("<Q", self._index, self._table + 8 * n)[0]
+        end = self._index.find(b"\n", start)
+
+        return self._index[start:end].split(b"\t")
+
+    def _search(self, id):
+        """
+        :return: the first entry number of id, or the number of entries larger than id
+        """
+        lo, hi = 0, self._num
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._entry(mid)[0] < id:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def find(self, id):
+        """
+        get the index entries of id
+        :param id: protein id, such as "hsa:10327"
+        :return: list of (id, [ko], [pathway], length, offset, linebases, linewidth)
+        """
+        r = []
+        key = id.encode()
+        n = self._search(key)
+
+        while n < self._num:
+            entry = self._entry(n)
+
+            if entry[0] != key:
+                break
+
+            ko, path = entry[1].decode(), entry[2].decode()
+            r.append((id, ko.split(";") if ko else [], path.split(";") if path else []) +
+                     tuple(int(i) for i in entry[3:]))
+            n += 1
+
+        return r
+
+    def get_seq(self, id):
+        """
+        :return: the seq of protein id, raise KeyError if not found
+        """
+        entries = self.find(id)
+
+        if not entries:
+            raise KeyError(id)
+
+        length, offset, linebases, linewidth = entries[0][3:]
+
+        if not length:
+            return ""
+
+        size = length + (length - 1) // linebases * (linewidth - linebases)
+
+        return b"".join(self._fasta[offset:offset+size].split()).decode()
+
+    def get_annotation(self, id):
+        """
+        :return: ([ko], [pathway]) of protein id, raise KeyError if not found
+        """
+        entries = self.find(id)
+
+        if not entries:
+            raise KeyError(id)
+
+        return entries[0][1], entries[0][2]
+
+    def __len__(self):
+        return self._num
+
+    def __contains__(self, id):
+        return bool(self.find(id))
+
+    def close(self):
+        for i in (self._fasta, self._index):
+            if isinstance(i, mmap.mmap):
+                i.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import logging
+
+from common import process_pool, __author__, __email__, __version__
+from make_keg import cluster_protein, cluster_protein_spill, load_hierarchy, output_keg, sample_name
+from plot_keg import KegCounts, plot_keg, write_svg
+
+LOG = logging.getLogger(__name__)
+
+__all__ = []
+
+# the KO hierarchy shared by the samples processed in a worker
+_HIERARCHY = None
+
+
+def read_manifest(file):
+    """
+    read the manifest of samples, each line is a annotation result with an optional sample name before it:
+    "sample\\tfile" or "file", relative file names are relative to the manifest
+    :param file:
+    :return: a list of (sample, file)
+    """
+    r = []
+    seen = set()
+    root = os.path.dirname(os.path.abspath(file))
+
+    for line in open(file):
+        line = line.strip()
+
+        if line.startswith("#") or not line:
+            continue
+
+        mess = line.split("\t")
+
+        if len(mess) == 1:
+            sample, path = sample_name(mess[0]), mess[0]
+        else:
+            sample, path = mess[0], mess[1]
+
+        if sample in seen:
+            raise ValueError("sample %r is duplicated in %r" % (sample, file))
+
+        seen.add(sample)
+        r.append((sample, os.path.join(root, path)))
+
+    LOG.info("get %s samples from %r" % (len(r), file))
+
+    return r
+
+
+def count_pathways(path_dict):
+    """
+    count the proteins of each pathway
+    :param path_dict: see make_keg.cluster_protein
+    :return: dict {pathway: number of distinct proteins}
+    """
+    r = {}
+
+    for path, kos in path_dict.items():
+        proteins = set()
+
+        for ko in kos.values():
+            proteins.update(ko)
+
+        r[path] = len(proteins)
+
+    return r
+
+
+def _init_worker(hierarchy):
+    global _HIERARCHY
+    _HIERARCHY = hierarchy
+
+
+def process_sample(sample, file, out, plot="pdf", spill_dir=None):
+    """
+    create .keg and plot of a sample with the shared KO hierarchy
+    :param sample: sample name
+    :param file: kegg annotation result
+    :param out: output prefix, outputs are {out}.{sample}.keg and {out}.{sample}.{plot}
+    :param plot: format of plot, "pdf", "png" by matplotlib or "svg" by the built-in writer, None for no plot
+    :param spill_dir: cluster proteins in temporary files of this directory, see make_keg.cluster_protein_spill
+    :return: (sample, dict {pathway: number of proteins})
+    """
+    prefix = "%s.%s" % (out, sample)
+
+    if spill_dir:
+        with cluster_protein_spill(file, tmp_dir=spill_dir) as path_dict:
+            output_keg(_HIERARCHY, path_dict, prefix + ".keg")
+            count = count_pathways(path_dict)
+            keg_counts = KegCounts.from_hierarchy(_HIERARCHY, path_dict) if plot else None
+    else:
+        path_dict = cluster_protein(file)
+        output_keg(_HIERARCHY, path_dict, prefix + ".keg")
+        count = count_pathways(path_dict)
+        keg_counts = KegCounts.from_hierarchy(_HIERARCHY, path_dict) if plot else None
+
+    # the counts of the plot are of the .keg just written, from the proteins in memory
+    if plot == "svg":
+        write_svg(keg_counts, prefix + ".svg")
+    elif plot:
+        plot_keg(keg_counts, "%s.%s" % (prefix, plot))
+
+    return sample, count
+
+
+def _process_sample(args):
+    return process_sample(*args)
+
+
+def write_matrix(samples, counts, pathways, file):
+    """
+    write the numbers of proteins of samples in pathways
+    :param samples: list of sample names
+    :param counts: dict {sample: {pathway: number}}
+    :param pathways: list of pathways in order, pathways no sample has are not written
+    :param file: output file
+    :return: 0
+    """
+    pathways = [p for p in pathways if any(counts[s].get(p) for s in samples)]
+
+    LOG.info("output %s samples x %s pathways to %r" % (len(samples), len(pathways), file))
+
+    with open(file, "w") as fh:
+        fh.write("#sample\t%s\n" % "\t".join(pathways))
+
+        for sample in samples:
+            fh.write("%s\t%s\n" % (sample, "\t".join(str(counts[sample].get(p, 0)) for p in pathways)))
+
+    return 0
+
+
+def batch_keg(keg, samples, out, threads=1, plot="pdf", cache=None, spill_dir=None):
+    """
+    process many samples with the KO hierarchy read once
+    :param keg: ko00001.keg
+    :param samples: see read_manifest
+    :param out: output prefix
+    :param threads: number of processes
+    :param plot: format of plot, see process_sample
+    :param cache: directory to cache parsed ko00001.keg
+    :param spill_dir: cluster proteins in temporary files of this directory
+    :return: 0
+    """
+    hierarchy = load_hierarchy(keg, cache)
+    tasks = [(sample, file, out, plot, spill_dir) for sample, file in samples]
+    counts = {}
+
+    # the hierarchy is sent once to each worker instead of with each sample
+    with process_pool(threads, _init_worker, (hierarchy,)) as imap:
+        for n, (sample, count) in enumerate(imap(_process_sample, tasks, ordered=False)):
+            LOG.info("%s/%s processed %s" % (n+1, len(tasks), sample))
+            counts[sample] = count
+
+    pathways = []
+    seen = set()
+
+    # a pathway may be listed under many categories
+    for text, path_id, entries in hierarchy.blocks:
+        if path_id and path_id not in seen:
+            seen.add(path_id)
+            pathways.append(path_id)
+
+    write_matrix([i[0] for i in samples], counts, pathways, out + ".matrix.tsv")
+
+    return 0
+
+
+def set_args():
+
+    args = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                   description="""
+create .keg and plot of many kegg annotation results, and a matrix of proteins of samples in pathways
+
+version: %s
+contact: %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args.add_argument("--keg", metavar="FILE", required=True,
+                      help="KO file downloaded from KEGG, usually named 'ko00001.keg'")
+    args.add_argument("--samples", metavar="FILE", required=True,
+                      help="manifest of KEGG annotation results, a file each line, "
+                           "optional sample name before the file joined with '\t'")
+    args.add_argument("--out", metavar="STR", default="out",
+                      help="output prefix, outputs are {out}.{sample}.keg, {out}.{sample}.{plot} "
+                           "and {out}.matrix.tsv (default: out)")
+    args.add_argument("--threads", metavar="INT", type=int, default=1,
+                      help="number of processes to process samples (default: 1)")
+    args.add_argument("--plot", metavar="STR", choices=["pdf", "png", "svg", "none"], default="pdf",
+                      help="format of plot, svg is written by the built-in writer without matplotlib, "
+                           "none for no plot (default: pdf)")
+    args.add_argument("--cache", metavar="DIR", default=None,
+                      help="directory to cache parsed KO file, reused if it not changed (default: no cache)")
+    args.add_argument("--spill", metavar="DIR", default=None,
+                      help="cluster proteins in temporary files of DIR with bounded memory, "
+                           "for annotation results of huge number of proteins (default: in memory)")
+
+    return args.parse_args()
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    args = set_args()
+    samples = read_manifest(args.samples)
+    plot = None if args.plot == "none" else args.plot
+    batch_keg(args.keg, samples, args.out, args.threads, plot, args.cache, args.spill)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import string
+import random
+import filecmp
+import argparse
+import logging
+import tempfile
+import threading
+import tracemalloc
+import urllib.request
+from array import array
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from common import __author__, __email__, __version__
+from FastaReader import yield_fasta_records, yield_fasta_bytes, ncbi_gene_id
+from common import KoTable, KoTableBuilder, dump_ko_table, read_org, read_org_ko_table, _csr, _names
+from download_organism import iter_org_list, write_org
+from get_ranks import read_kegg_org
+from make_keg import KoHierarchy, cluster_protein, output_keg, read_tbl
+from makedb import add_pep2ko
+from plot_keg import stat_keg
+
+
+LOG = logging.getLogger(__name__)
+
+__all__ = []
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+# header shapes of NCBI *_translated_cds.faa.gz
+NCBI_HEADERS = [
+    "lcl|NC_000964.3_prot_NP_387882.1_1 [gene=dnaA] [locus_tag=BSU_00010] [db_xref=GeneID:939978] "
+    "[protein=chromosomal replication initiator informational ATPase] [protein_id=NP_387882.1] "
+    "[location=410..1750] [gbkey=CDS]",
+    "lcl|NC_000001.11_prot_NP_001005484.2_1 [gene=OR4F5] [db_xref=CCDS:CCDS30547.2,GeneID:79501] "
+    "[protein=olfactory receptor 4F5] [protein_id=NP_001005484.2] "
+    "[location=join(65565..65573,69037..71585)] [gbkey=CDS]",
+    "lcl|NW_003315947.1_prot_XP_003307542.1_1 [db_xref=GeneID:10018766] "
+    "[protein=hypothetical protein] [protein_id=XP_003307542.1] [location=complement(<1..1287)] [gbkey=CDS]",
+    "lcl|CP000001.1_prot_AAB00001.1_7 [gene=yaaA] [protein=hypothetical protein] "
+    "[protein_id=AAB00001.1] [location=5..299] [gbkey=CDS]",
+]
+
+
+def parse_size(string):
+    """
+    convert size like 512K, 64M, 2G to bytes
+    :param string:
+    :return: int
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    string = string.strip().upper()
+
+    if string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+
+    return int(string)
+
+
+def read_example_ids(file=os.path.join(EXAMPLES, "human.pep2ko.txt")):
+    """
+    read protein ids from the example annotation result
+    :param file:
+    :return: list of ids
+    """
+    r = []
+
+    for line in open(file):
+        line = line.strip()
+
+        if line:
+            r.append(line.split("\t")[0])
+
+    return r
+
+
+def make_fasta(file, size, width=80, seed=1):
+    """
+    create a synthetic NCBI translated_cds like fasta file
+    :param file: output file name
+    :param size: approximate file size in bytes
+    :param width: line width of seq, 0 means no wrap
+    :param seed: random seed
+    :return: number of records
+    """
+    rand = random.Random(seed)
+    ids = read_example_ids()
+    block = "".join(rand.choice(AMINO_ACIDS) for i in range(1 << 16))
+    n = 0
+    total = 0
+
+    with open(file, "w") as fh:
+        while total < size:
+            gene = ids[n % len(ids)]
+            start = rand.randrange(len(block) - 2000)
+            seq = block[start:start+rand.randint(50, 2000)]
+
+            if width:
+                seq = "\n".join(seq[i:i+width] for i in range(0, len(seq), width))
+
+            record = ">lcl|NC_000001.11_prot_NP_%06d.1_%s [gene=G%s] [db_xref=GeneID:%s] " \
+                     "[protein=synthetic protein] [protein_id=NP_%06d.1] [gbkey=CDS]\n%s\n" % (
+                         n, n+1, gene, gene, n, seq)
+            fh.write(record)
+            total += len(record)
+            n += 1
+
+    return n
+
+
+def timeit(func, *args):
+    """
+    run function and return (result, seconds)
+    """
+    start = time.perf_counter()
+    result = func(*args)
+
+    return result, time.perf_counter() - start
+
+
+def report(name, size, seconds, baseline=None):
+    """
+    log the speed of a benchmark
+    """
+    speed = size / seconds / (1 << 20) if seconds else float("inf")
+    mess = "%-28s %8.3fs %10.1f MB/s" % (name, seconds, speed)
+
+    if baseline:
+        mess += "  x%.2f" % (baseline / seconds)
+
+    LOG.info(mess)
+
+
+def bench_fasta(files, size, width, chunk_size):
+    """
+    compare the line based and the chunked byte fasta reader
+    :param files: fasta files, a synthetic one is created if empty
+    :param size: size of the synthetic fasta
+    :param width: line width of the synthetic fasta
+    :param chunk_size: chunk size of the byte reader
+    :return: 0
+    """
+
+    def text_reader(file):
+        return sum(len(r.seq) for r in yield_fasta_records(open(file)))
+
+    def byte_reader(file):
+        with open(file, "rb") as fh:
+            return sum(len(s) for n, s in yield_fasta_bytes(fh, chunk_size))
+
+    tmp = None
+
+    if not files:
+        tmp = tempfile.NamedTemporaryFile(suffix=".fasta", delete=False)
+        tmp.close()
+        LOG.info("create synthetic fasta %r of %s bytes" % (tmp.name, size))
+        make_fasta(tmp.name, size, width)
+        files = [tmp.name]
+
+    try:
+        for file in files:
+            size = os.path.getsize(file)
+            LOG.info("benchmark %r" % file)
+            old, old_time = timeit(text_reader, file)
+            new, new_time = timeit(byte_reader, file)
+
+            if old != new:
+                raise Exception("readers disagree on %r: %s != %s residues" % (file, old, new))
+
+            report("yield_fasta_records", size, old_time)
+            report("yield_fasta_bytes", size, new_time, old_time)
+    finally:
+        if tmp:
+            os.remove(tmp.name)
+
+    return 0
+
+
+def split_gene_id(name):
+    """
+    the gene id parser used by process_protein before ncbi_gene_id
+    """
+    if "locus_tag=" in name:
+        return name.split("locus_tag=")[1].split("]")[0]
+    elif "db_xref=GeneID:" in name:
+        return name.split("db_xref=GeneID:")[1].split("]")[0]
+    elif "protein_id=" in name:
+        return name.split("protein_id=")[1].split("]")[0].split(".")[0]
+
+    return None
+
+
+def bench_header(files, number):
+    """
+    compare the gene id parsers of NCBI headers
+    :param files: fasta files to read headers, NCBI_HEADERS are used if empty
+    :param number: times to parse each header
+    :return: 0
+    """
+
+    if files:
+        headers = []
+
+        for file in files:
+            with open(file, "rb") as fh:
+                headers += [n.decode() for n, s in yield_fasta_bytes(fh)]
+    else:
+        headers = NCBI_HEADERS
+
+    raw_headers = [i.encode() for i in headers]
+    size = sum(len(i) for i in raw_headers) * number
+
+    for name in headers:
+        if ncbi_gene_id(name) != split_gene_id(name):
+            raise Exception("parsers disagree on %r" % name)
+
+    def run(func, names):
+        for i in range(number):
+            for name in names:
+                func(name)
+
+    LOG.info("parse %s headers %s times" % (len(headers), number))
+    # process_protein decoded every header before split_gene_id
+    old = timeit(run, lambda name: split_gene_id(name.decode()), raw_headers)[1]
+    report("decode + split_gene_id", size, old)
+    report("decode + ncbi_gene_id", size, timeit(run, lambda name: ncbi_gene_id(name.decode()), raw_headers)[1], old)
+    report("ncbi_gene_id (bytes)", size, timeit(run, ncbi_gene_id, raw_headers)[1], old)
+
+    return 0
+
+
+def make_org_page(file, records, copies=1):
+    """
+    create a KEGG organism catalog page like org_list.html
+    :param file: output file name
+    :param records: records of .org
+    :param copies: times to repeat the records, the org abbr. of copies are suffixed by the number of copy
+    :return: number of organisms
+    """
+    n = 0
+
+    with open(file, "w") as fh:
+        fh.write("<html>\n<body>\n<table>\n")
+
+        for i in range(copies):
+            suffix = str(i) if i else ""
+
+            for record in records:
+                org, name, link = (record + ["", ""])[:3]
+                org += suffix
+                fh.write("<tr>\n<td align=center><a href='/kegg-bin/show_organism?org=%s'>%s</a></td>\n" % (org, org))
+                fh.write("<td align=left><a href='/dbget-bin/www_bget?gn:T%05d'>%s</a></td>\n" % (n, name))
+
+                if link:
+                    fh.write("<td align=center><a href='%s'>RefSeq</a></td>\n" % link)
+                else:
+                    fh.write("<td align=center></td>\n")
+
+                fh.write("<td align=left>Prokaryotes;Bacteria</td>\n</tr>\n")
+                n += 1
+
+        fh.write("</table>\n</body>\n</html>\n")
+
+    return n
+
+
+def serve_file(file):
+    """
+    serve file by a local HTTP server in a background thread
+    :param file:
+    :return: (server, url), server.shutdown() to stop
+    """
+    data = open(file, "rb").read()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server, "http://127.0.0.1:%s/%s" % (server.server_port, os.path.basename(file))
+
+
+def legacy_html2org(url):
+    """
+    the line based parser of download_organism.html2org before OrgListParser
+    """
+    r = {}
+    file = urllib.request.urlopen(url)
+    org = name = link = ""
+    n = 0
+
+    for line in file:
+        line = line.decode("utf-8").strip()
+
+        if "show_organism?org=" in line:
+
+            if org:
+                r[org] = [name, link]
+
+            org = line.split("</a>")[0].split("'>")[-1]
+            name = link = ""
+            n = 1
+            continue
+
+        if n == 1:
+            name = line.split("</a>")[0].split("'>")[-1]
+            n = 2
+            continue
+        if n == 2:
+            if "ftp://" not in line:
+                continue
+            link = line.split("href='")[-1].split("'>")[0]
+            n = 0
+
+    if org:
+        r[org] = [name, link]
+
+    return r
+
+
+def bench_org(page, copies):
+    """
+    compare the organism catalog parsers on a page served locally
+    :param page: a saved copy of org_list.html, a page is created from examples/KEGG.org if not set
+    :param copies: times to repeat the organisms of the created page
+    :return: 0
+    """
+    tmp = tempfile.mkdtemp()
+
+    if not page:
+        page = os.path.join(tmp, "org_list.html")
+        LOG.info("create org list page of %s organisms" % make_org_page(
+            page, read_org(os.path.join(EXAMPLES, "KEGG.org")), copies))
+
+    size = os.path.getsize(page)
+    server, url = serve_file(page)
+    out = os.path.join(tmp, "KEGG.org")
+    legacy_out = os.path.join(tmp, "legacy.org")
+
+    def legacy():
+        r = legacy_html2org(url)
+
+        with open(legacy_out, "w") as fh:
+            for k, v in sorted(r.items()):
+                fh.write("%s\t%s\t%s\n" % (k, v[0], v[1]))
+
+        return r
+
+    def stream():
+        return write_org(iter_org_list(url), out)
+
+    def measure(func):
+        # tracing slows down the parser, so time and memory are measured in separate runs
+        result, seconds = timeit(func)
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return result, seconds, peak
+
+    try:
+        logging.getLogger("download_organism").setLevel(logging.WARNING)
+        old, old_time, old_peak = measure(legacy)
+        new, new_time, new_peak = measure(stream)
+
+        if old != new:
+            raise Exception("parsers disagree on %s organisms" % len([
+                i for i in set(old) | set(new) if old.get(i) != new.get(i)]))
+        if not filecmp.cmp(legacy_out, out, shallow=False):
+            raise Exception("%r and %r are not the same" % (legacy_out, out))
+
+        LOG.info("parse %s organisms of %s bytes from %s" % (len(new), size, url))
+        report("legacy html2org", size, old_time)
+        LOG.info("%-28s %8.1f MB peak" % ("", old_peak / (1 << 20)))
+        report("OrgListParser", size, new_time, old_time)
+        LOG.info("%-28s %8.1f MB peak" % ("", new_peak / (1 << 20)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+
+        os.rmdir(tmp)
+
+    return 0
+
+
+def legacy_org_ko_table(file):
+    """
+    the line loop of common.KoTable.from_keg before htext
+    """
+    genes = {}
+    kos = {}
+    paths = {}
+    ko_pairs = set()
+    path_pairs = set()
+    ko_rows, ko_cols = array("I"), array("I")
+    path_rows, path_cols = array("I"), array("I")
+    p = 0
+
+    for n, line in enumerate(open(file)):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        tag = line[0]
+
+        if tag == "C":
+            path_id = "ko"+line[-6:-1]
+            p = paths.setdefault(path_id, len(paths))
+            continue
+
+        if tag != "D":
+            continue
+
+        tmp = line.split("\t")
+        gene = tmp[0].split()[1]
+
+        if len(tmp) == 2:
+            ko = tmp[1].split()[0]
+        else:
+            ko = ""
+
+        g = genes.get(gene)
+
+        if g is None:
+            g = genes[gene] = len(genes)
+
+        k = kos.get(ko)
+
+        if k is None:
+            k = kos[ko] = len(kos)
+
+        if not paths:
+            p = paths[""] = 0
+
+        key = g << 32 | k
+
+        if key not in ko_pairs:
+            ko_pairs.add(key)
+            ko_rows.append(g)
+            ko_cols.append(k)
+
+        key = g << 32 | p
+
+        if key not in path_pairs:
+            path_pairs.add(key)
+            path_rows.append(g)
+            path_cols.append(p)
+
+    ko_ptr, ko_idx = _csr(len(genes), ko_rows, ko_cols)
+    path_ptr, path_idx = _csr(len(genes), path_rows, path_cols)
+
+    return KoTable(_names(genes), _names(kos), _names(paths), ko_ptr, ko_idx, path_ptr, path_idx)
+
+
+def _table_fields(table):
+    return (table.genes, table.kos, table.paths, table.ko_ptr, table.ko_idx, table.path_ptr, table.path_idx)
+
+
+def legacy_read_kegg_org(file):
+    """
+    the line loop of get_ranks.read_kegg_org before htext
+    """
+    r = {}
+    taxon = ""
+    level = "A"
+    levels = {k: n for n, k in enumerate(string.ascii_uppercase)}
+
+    for line in open(file):
+        line = line.strip()
+        tag = line[0]
+
+        if tag not in levels:
+            continue
+
+        if "TAX:" in line:
+            taxon = line.split("TAX:")[-1].split("]")[0]
+            level = tag
+            continue
+
+        if levels[tag] - levels[level] == 1:
+            if taxon:
+                org = line.split()[1]
+
+                if not org.isdigit():
+                    r[org] = taxon
+        else:
+            taxon = ""
+
+    return r
+
+
+def legacy_hierarchy(keg):
+    """
+    the line loop of make_keg.output_keg before htext, collecting the blocks of KoHierarchy
+    """
+    blocks = []
+    lines = []
+    entries = []
+    path_id = ""
+
+    for line in open(keg):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        tag = line[0]
+
+        if tag == "D":
+            mess = line.split()
+            entries.append((mess[1], " ".join(mess[2:])))
+            continue
+
+        if entries:
+            blocks.append(("".join(lines), path_id, entries))
+            lines = []
+            entries = []
+
+        if tag == "C":
+            path_id = "ko" + line.split()[1]
+
+        lines.append("%s\n" % line)
+
+    blocks.append(("".join(lines), path_id, entries))
+
+    return blocks
+
+
+def legacy_stat_keg(keg):
+    """
+    the line loop of plot_keg.stat_keg before htext
+    """
+    r = OrderedDict()
+    path1 = ""
+    path2 = ""
+
+    for line in open(keg):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        tag = line[0]
+
+        if tag == "A" and "<b>" in line:
+            path1 = line[4:-4]
+            r[path1] = OrderedDict()
+            continue
+
+        if tag == "B" and "<b>" in line:
+            path2 = line[6:-4]
+            r[path1][path2] = []
+            continue
+
+        if tag == "D":
+            r[path1][path2].append(line.split()[1])
+
+    return r
+
+
+def bench_htext(ko, org, keg, number):
+    """
+    compare the htext readers on htext before and after htext.iter_htext
+    :param ko: ko00001.keg
+    :param org: br08610.keg
+    :param keg: .keg of annotation result, such as human.keg
+    :param number: times to read each file
+    :return: 0
+    """
+    cases = [
+        ("KoTable", keg, lambda file: _table_fields(legacy_org_ko_table(file)),
+         lambda file: _table_fields(read_org_ko_table(file))),
+        ("read_kegg_org", org, legacy_read_kegg_org, read_kegg_org),
+        ("KoHierarchy", ko, legacy_hierarchy, lambda file: KoHierarchy.from_keg(file).blocks),
+        ("stat_keg", keg, legacy_stat_keg, stat_keg),
+    ]
+
+    for name, file, old_func, new_func in cases:
+        size = os.path.getsize(file)
+        old_time = new_time = float("inf")
+
+        # the readers take turns and the best time of each is kept, as a single read is short
+        for i in range(number):
+            old, seconds = timeit(old_func, file)
+            old_time = min(old_time, seconds)
+            new, seconds = timeit(new_func, file)
+            new_time = min(new_time, seconds)
+
+        if old != new:
+            raise Exception("%s disagree on %r" % (name, file))
+
+        LOG.info("%s of %r, best of %s times" % (name, file, number))
+        report("line loop", size, old_time)
+        report("htext", size, new_time, old_time)
+
+    return 0
+
+
+def make_pep2ko(file, rows, source=os.path.join(EXAMPLES, "human.pep2ko.txt")):
+    """
+    create a pep2ko of rows by repeating the lines of source with numbered protein ids
+    :param file: output pep2ko
+    :param rows: number of lines
+    :param source: pep2ko to repeat
+    :return: KoTableBuilder of the lines written
+    """
+    lines = [line.split("\t", 1) for line in open(source).read().splitlines() if line]
+    builder = KoTableBuilder()
+
+    with open(file, "w") as fh:
+        for start in range(0, rows, len(lines)):
+            text = "".join("%s.%s\t%s\n" % (gene, start, rest) for gene, rest in lines[:rows-start])
+            fh.write(text)
+            add_pep2ko(builder, text)
+
+    return builder
+
+
+def bench_pep2ko(rows, keg):
+    """
+    compare make_keg.py on pep2ko of text and of the columnar format written by makedb.py --columnar
+    :param rows: number of proteins of the synthetic pep2ko
+    :param keg: ko00001.keg
+    :return: 0
+    """
+    tmp = tempfile.mkdtemp()
+    text = os.path.join(tmp, "bench.pep2ko.txt")
+    columnar = os.path.join(tmp, "bench.pep2ko.kgt")
+
+    def make_keg(file):
+        output = file + ".keg"
+        output_keg(hierarchy, cluster_protein(file), output)
+
+        return output
+
+    def measure(func, *args):
+        result, seconds = timeit(func, *args)
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return result, seconds, peak
+
+    try:
+        LOG.info("create pep2ko of %s proteins" % rows)
+        dump_ko_table(make_pep2ko(text, rows).table(), columnar)
+        size = os.path.getsize(text)
+        LOG.info("text %s bytes, columnar %s bytes" % (size, os.path.getsize(columnar)))
+        hierarchy = KoHierarchy.from_keg(keg)
+        logging.getLogger("make_keg").setLevel(logging.WARNING)
+
+        for name, func in [("cluster_protein", cluster_protein), ("make_keg", make_keg)]:
+            old, old_time, old_peak = measure(func, text)
+            new, new_time, new_peak = measure(func, columnar)
+
+            if not (filecmp.cmp(old, new, shallow=False) if name == "make_keg" else old == new):
+                raise Exception("%s disagree on %s proteins" % (name, rows))
+
+            LOG.info("%s %s proteins" % (name, rows))
+            report("text", size, old_time)
+            LOG.info("%-28s %8.1f MB peak" % ("", old_peak / (1 << 20)))
+            report("columnar", size, new_time, old_time)
+            LOG.info("%-28s %8.1f MB peak" % ("", new_peak / (1 << 20)))
+    finally:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+
+        os.rmdir(tmp)
+
+    return 0
+
+
+def set_args():
+
+    args = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                   description="""
+benchmark the readers of KEGGTools
+
+version: %s
+contact: %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    subparsers = args.add_subparsers(dest="command")
+    subparsers.required = True
+
+    fasta = subparsers.add_parser("fasta", help="benchmark fasta readers")
+    fasta.add_argument("fasta", metavar="FILE", nargs="*",
+                       help="fasta files to read, a synthetic file is created if not set")
+    fasta.add_argument("--size", metavar="SIZE", type=parse_size, default="256M",
+                       help="size of the synthetic fasta, such as 512M, 4G (default: 256M)")
+    fasta.add_argument("--width", metavar="INT", type=int, default=80,
+                       help="line width of the synthetic fasta, 0 means no wrap (default: 80)")
+    fasta.add_argument("--chunk", metavar="SIZE", type=parse_size, default="1M",
+                       help="chunk size of the byte reader (default: 1M)")
+
+    header = subparsers.add_parser("header", help="benchmark NCBI header parsers")
+    header.add_argument("fasta", metavar="FILE", nargs="*",
+                        help="fasta files to read headers, built-in NCBI header shapes are used if not set")
+    header.add_argument("--number", metavar="INT", type=int, default=200000,
+                        help="times to parse each header (default: 200000)")
+
+    org = subparsers.add_parser("org", help="benchmark KEGG organism catalog parsers")
+    org.add_argument("page", metavar="FILE", nargs="?",
+                     help="a saved copy of org_list.html, a page is created from examples/KEGG.org if not set")
+    org.add_argument("--copies", metavar="INT", type=int, default=1,
+                     help="times to repeat the organisms of the created page (default: 1)")
+
+    htext = subparsers.add_parser("htext", help="benchmark htext readers")
+    htext.add_argument("--ko", metavar="FILE", default=os.path.join(EXAMPLES, "ko00001.keg"),
+                       help="KO htext (default: examples/ko00001.keg)")
+    htext.add_argument("--org", metavar="FILE", default=os.path.join(EXAMPLES, "br08610.keg"),
+                       help="KEGG organisms htext (default: examples/br08610.keg)")
+    htext.add_argument("--keg", metavar="FILE", default=os.path.join(EXAMPLES, "human.keg"),
+                       help="htext of annotation result (default: examples/human.keg)")
+    htext.add_argument("--number", metavar="INT", type=int, default=20,
+                       help="times to read each file (default: 20)")
+
+    pep2ko = subparsers.add_parser("pep2ko", help="benchmark pep2ko of text and columnar format")
+    pep2ko.add_argument("--rows", metavar="INT", type=int, default=2000000,
+                        help="number of proteins of the synthetic pep2ko (default: 2000000)")
+    pep2ko.add_argument("--keg", metavar="FILE", default=os.path.join(EXAMPLES, "ko00001.keg"),
+                        help="KO htext (default: examples/ko00001.keg)")
+
+    return args.parse_args()
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    args = set_args()
+
+    if args.command == "fasta":
+        bench_fasta(args.fasta, args.size, args.width, args.chunk)
+    elif args.command == "header":
+        bench_header(args.fasta, args.number)
+    elif args.command == "org":
+        bench_org(args.page, args.copies)
+    elif args.command == "htext":
+        bench_htext(args.ko, args.org, args.keg, args.number)
+    elif args.command == "pep2ko":
+        bench_pep2ko(args.rows, args.keg)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,18 @@
 
+import os
+import sys
+import mmap
+import struct
+import zlib
 import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain
+from collections.abc import Sequence
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from htext import open_htext
 
 
 LOG = logging.getLogger(__name__)
@@ -8,6 +21,15 @@ __version__ = "0.1.0"
 __author__ = ("Junpeng Fan",)
 __email__ = "jpfan@whu.edu.cn"
 
+# header of binary KoTable: magic, version, byte order mark, source mtime_ns, source size,
+# number of genes, kos, paths, bytes of gene, ko, pathway names, number of ko and pathway entries,
+# crc32 of the header before it and the names, the header and arrays are little endian on any machine,
+# the names are followed by the offsets of gene names and the CSR arrays
+KO_TABLE_MAGIC = b"KGKT"
+KO_TABLE_VERSION = 5
+KO_TABLE_BOM = 0x01020304
+KO_TABLE_HEADER = struct.Struct("<4sIIqQIIIQQQIII")
+
 
 def read_org(file):
     """
@@ -30,48 +52,630 @@ def read_org(file):
     return r
 
 
-def read_org_ko(file):
+class KoTable(object):
+    """
+    compact gene table of KEGG organism KO .keg, KOs and pathways are interned to
+    integer ids and the KOs and pathways of genes are stored in CSR arrays:
+    the KOs of gene n are kos[i] for i in ko_idx[ko_ptr[n]:ko_ptr[n+1]]
+    """
+
+    def __init__(self, genes, kos, paths, ko_ptr, ko_idx, path_ptr, path_idx):
+        self.genes = genes
+        self.kos = kos
+        self.paths = paths
+        self.ko_ptr = ko_ptr
+        self.ko_idx = ko_idx
+        self.path_ptr = path_ptr
+        self.path_idx = path_idx
+        self._index = None
+
+    @classmethod
+    def from_keg(cls, file):
+        """
+        read KEGG organism KO .keg file
+        :param file: file name
+        :return: KoTable
+        """
+        genes = {}
+        kos = {}
+        paths = {}
+        # (gene, ko) and (gene, pathway) pairs seen, packed to int
+        ko_pairs = set()
+        path_pairs = set()
+        # a gene is listed under each of its pathways by the same line, {line: gene number}
+        parsed = {}
+        ko_rows, ko_cols = array("I"), array("I")
+        path_rows, path_cols = array("I"), array("I")
+        p = 0
+
+        with open_htext(file, "CD", numbers=True) as events:
+            for n, tag, line in events:
+
+                if tag == "C":
+                    path_id = "ko"+line[-6:-1]
+                    p = paths.setdefault(path_id, len(paths))
+                    continue
+
+                g = parsed.get(line)
+
+                if g is None:
+                    tmp = line.split("\t")
+                    gene = tmp[0].split(None, 2)[1]
+
+                    if len(tmp) == 2:
+                        ko = tmp[1].split(None, 1)[0]
+                    else:
+                        LOG.warning("line %s: %r has no ko" % (n, line))
+                        ko = ""
+
+                    g = genes.get(gene)
+
+                    if g is None:
+                        g = genes[gene] = len(genes)
+
+                    k = kos.get(ko)
+
+                    if k is None:
+                        k = kos[ko] = len(kos)
+
+                    key = g << 32 | k
+
+                    if key not in ko_pairs:
+                        ko_pairs.add(key)
+                        ko_rows.append(g)
+                        ko_cols.append(k)
+
+                    # the lines without ko are parsed again to warn each of them
+                    if ko:
+                        parsed[line] = g
+
+                if not paths:
+                    p = paths[""] = 0
+
+                key = g << 32 | p
+
+                if key not in path_pairs:
+                    path_pairs.add(key)
+                    path_rows.append(g)
+                    path_cols.append(p)
+
+        ko_ptr, ko_idx = _csr(len(genes), ko_rows, ko_cols)
+        path_ptr, path_idx = _csr(len(genes), path_rows, path_cols)
+
+        return cls(_names(genes), _names(kos), _names(paths), ko_ptr, ko_idx, path_ptr, path_idx)
+
+    def index(self, gene):
+        """
+        the row of gene, raise KeyError if gene not in table
+        """
+        if self._index is None:
+            self._index = {g: n for n, g in enumerate(self.genes)}
+
+        return self._index[gene]
+
+    def get_kos(self, gene):
+        """
+        :return: list of KOs of gene
+        """
+        n = self.index(gene)
+
+        return [self.kos[i] for i in self.ko_idx[self.ko_ptr[n]:self.ko_ptr[n+1]]]
+
+    def get_paths(self, gene):
+        """
+        :return: list of pathways of gene
+        """
+        n = self.index(gene)
+
+        return [self.paths[i] for i in self.path_idx[self.path_ptr[n]:self.path_ptr[n+1]]]
+
+    def items(self):
+        """
+        yield (gene, [ko], [pathway]) in the order of .keg
+        """
+        kos, paths = self.kos, self.paths
+        ko_ptr, ko_idx = self.ko_ptr, self.ko_idx
+        path_ptr, path_idx = self.path_ptr, self.path_idx
+
+        for n, gene in enumerate(self.genes):
+            yield (gene,
+                   [kos[i] for i in ko_idx[ko_ptr[n]:ko_ptr[n+1]]],
+                   [paths[i] for i in path_idx[path_ptr[n]:path_ptr[n+1]]])
+
+    def to_dict(self):
+        """
+        :return: dict {protein_id: {"ko": [], "path": []}}, see read_org_ko
+        """
+        return {gene: {"ko": ko, "path": path} for gene, ko, path in self.items()}
+
+    def __len__(self):
+        return len(self.genes)
+
+    def __iter__(self):
+        return iter(self.genes)
+
+    def __contains__(self, gene):
+        try:
+            self.index(gene)
+        except KeyError:
+            return False
+
+        return True
+
+
+class KoTableBuilder(object):
+    """
+    build KoTable row by row, such as the lines of pep2ko, rows are kept in order even if genes repeat,
+    KOs and pathways are interned in the order first seen
+    """
+
+    def __init__(self):
+        self.genes = []
+        self._kos = {}
+        self._paths = {}
+        self.ko_ptr = array("I", [0])
+        self.ko_idx = array("I")
+        self.path_ptr = array("I", [0])
+        self.path_idx = array("I")
+
+    def add(self, gene, kos, paths):
+        """
+        :param gene: gene or protein id
+        :param kos: list of KOs
+        :param paths: list of pathways
+        """
+        self.genes.append(gene)
+
+        for ko in kos:
+            k = self._kos.get(ko)
+
+            if k is None:
+                k = self._kos[ko] = len(self._kos)
+
+            self.ko_idx.append(k)
+
+        for path in paths:
+            p = self._paths.get(path)
+
+            if p is None:
+                p = self._paths[path] = len(self._paths)
+
+            self.path_idx.append(p)
+
+        self.ko_ptr.append(len(self.ko_idx))
+        self.path_ptr.append(len(self.path_idx))
+
+    def __len__(self):
+        return len(self.genes)
+
+    def table(self):
+        """
+        :return: KoTable of the rows added
+        """
+        return KoTable(self.genes, _names(self._kos), _names(self._paths),
+                       self.ko_ptr, self.ko_idx, self.path_ptr, self.path_idx)
+
+
+def _names(ids):
+    """
+    convert interned {name: id} to list of names
+    """
+    r = [""] * len(ids)
+
+    for k, v in ids.items():
+        r[v] = k
+
+    return r
+
+
+def _csr(num, rows, cols):
+    """
+    build CSR arrays, the order of cols in a row is kept
+    :param num: number of rows
+    :param rows: array of row ids
+    :param cols: array of col ids
+    :return: (ptr, idx)
+    """
+    ptr = array("I", [0]) * (num + 1)
+
+    for r in rows:
+        ptr[r+1] += 1
+
+    for i in range(num):
+        ptr[i+1] += ptr[i]
+
+    idx = array("I", [0]) * len(cols)
+    fill = ptr[:-1]
+
+    for r, c in zip(rows, cols):
+        idx[fill[r]] = c
+        fill[r] += 1
+
+    return ptr, idx
+
+
+def read_org_ko_table(file):
     """
     read KEGG organism KO .keg file
     :param file: file name
-    :return: dict contains {protein_id: {"ko": [], "path": []}}, if protein_id has no ko, the ko will be "-"
+    :return: KoTable
     """
+    return KoTable.from_keg(file)
+
 
-    r = {}
+def dump_ko_table(table, file, stamp=(0, 0)):
+    """
+    write KoTable to a binary file, the arrays are little endian, the header and names are checked by crc32
+    :param table: KoTable
+    :param file: output file
+    :param stamp: (mtime_ns, size) of the source file
+    :return: 0
+    """
+    genes = [i.encode() for i in table.genes]
+    blobs = [b"\n".join(genes)] + ["\n".join(i).encode() for i in (table.kos, table.paths)]
+    size = KO_TABLE_HEADER.size + sum(len(i) for i in blobs)
+    # the arrays are aligned to 8 bytes
+    blobs.append(b"\0" * (-size % 8))
+    # gene n is the bytes from offsets[n] to offsets[n+1] - 1 of gene names
+    offsets = array("Q", accumulate(map((1).__add__, map(len, genes)), initial=0))
+    del genes
 
-    path_id = ""
+    for typecode, a in zip("QIIII", (offsets, table.ko_ptr, table.ko_idx, table.path_ptr, table.path_idx)):
+        a = array(typecode, a)
 
-    for n, line in enumerate(open(file)):
-        line = line.strip()
+        if sys.byteorder == "big":
+            a.byteswap()
+
+        blobs.append(a.tobytes())
+
+    fields = [KO_TABLE_MAGIC, KO_TABLE_VERSION, KO_TABLE_BOM, stamp[0], stamp[1],
+              len(table.genes), len(table.kos), len(table.paths),
+              len(blobs[0]), len(blobs[1]), len(blobs[2]), len(table.ko_idx), len(table.path_idx)]
+    crc = zlib.crc32(KO_TABLE_HEADER.pack(*(fields + [0]))[:-4])
+
+    for blob in blobs[:3]:
+        crc = zlib.crc32(blob, crc)
+
+    header = KO_TABLE_HEADER.pack(*(fields + [crc]))
+    tmp = "%s.%s.tmp" % (file, os.getpid())
+
+    with open(tmp, "wb") as fh:
+        fh.write(header)
+
+        for blob in blobs:
+            fh.write(blob)
+
+    os.replace(tmp, file)
+
+    return 0
+
+
+def load_ko_table(file):
+    """
+    load KoTable from binary file, the file is mapped and the arrays of KoTable are views of the map,
+    so only the names are decoded, the map is closed when the arrays are released
+    :param file: file created by dump_ko_table
+    :return: (KoTable, (mtime_ns, size) of the source file)
+    """
+    with open(file, "rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        return _read_ko_table(mm, file)
+    except Exception:
+        # no view is left on a broken file
+        mm.close()
+        raise
+
+
+def _read_ko_table(mm, file):
+
+    if len(mm) < KO_TABLE_HEADER.size:
+        raise ValueError("%r is not a KoTable file" % file)
+
+    magic, version, bom, mtime, size, n_genes, n_kos, n_paths, l_genes, l_kos, l_paths, n_ko, n_path, crc = \
+        KO_TABLE_HEADER.unpack_from(mm, 0)
 
-        if not line:
-            continue
+    if magic != KO_TABLE_MAGIC or version != KO_TABLE_VERSION:
+        raise ValueError("%r is not a KoTable file" % file)
 
-        tag = line[0]
+    if bom != KO_TABLE_BOM:
+        raise ValueError("%r is not little endian" % file)
 
-        if tag == "C":
-            path_id = "ko"+line[-6:-1]
-            continue
+    pos = KO_TABLE_HEADER.size + l_genes + l_kos + l_paths
+    pos += -pos % 8
 
-        if tag != "D":
-            continue
+    # the size of file is checked by the counts of header before any slice
+    if pos + 8 * (n_genes + 1) + 4 * (2 * (n_genes + 1) + n_ko + n_path) != len(mm):
+        raise ValueError("%r is truncated or broken" % file)
 
-        tmp = line.split("\t")
-        gene = tmp[0].split()[1]
+    # the arrays are not checked, it would read the whole file on each load
+    with memoryview(mm) as view:
+        with view[:KO_TABLE_HEADER.size - 4] as header, \
+                view[KO_TABLE_HEADER.size:KO_TABLE_HEADER.size + l_genes + l_kos + l_paths] as data:
+            if zlib.crc32(data, zlib.crc32(header)) != crc:
+                raise ValueError("%r is broken, crc32 not matched" % file)
 
-        if len(tmp) == 2:
-            ko = tmp[1].split()[0]
+    pos = KO_TABLE_HEADER.size + l_genes
+    names = []
+
+    for num, length in ((n_kos, l_kos), (n_paths, l_paths)):
+        names.append(mm[pos:pos+length].decode().split("\n") if num else [])
+        pos += length
+
+        if len(names[-1]) != num:
+            raise ValueError("%r has %s names instead of %s" % (file, len(names[-1]), num))
+
+    pos += -pos % 8
+    # the last of gene offsets, ko_ptr and path_ptr
+    ends = struct.unpack_from("<Q", mm, pos + 8 * n_genes) + \
+        struct.unpack_from("<I", mm, pos + 8 * (n_genes + 1) + 4 * n_genes) + \
+        struct.unpack_from("<I", mm, pos + 8 * (n_genes + 1) + 4 * (2 * n_genes + 1 + n_ko))
+
+    if ends != (l_genes + 1 if n_genes else 0, n_ko, n_path):
+        raise ValueError("%r is broken" % file)
+
+    offsets = map_array(mm, pos, "Q", n_genes + 1)
+    pos += 8 * (n_genes + 1)
+    arrays = []
+
+    for num in (n_genes + 1, n_ko, n_genes + 1, n_path):
+        arrays.append(map_array(mm, pos, "I", num))
+        pos += num * 4
+
+    genes = MappedNames(mm, KO_TABLE_HEADER.size, offsets)
+
+    return KoTable(genes, *(names + arrays)), (mtime, size)
+
+
+def map_array(mm, pos, typecode, num):
+    """
+    little endian array of the map, a view on little endian machines, otherwise a copy
+    """
+    if sys.byteorder == "little":
+        return memoryview(mm)[pos:pos + num * array(typecode).itemsize].cast(typecode)
+
+    a = array(typecode)
+    a.frombytes(mm[pos:pos + num * a.itemsize])
+    a.byteswap()
+
+    return a
+
+
+class MappedNames(Sequence):
+    """
+    read only list of names joined with "\n" in a map, a name is decoded only when it is accessed
+    """
+
+    def __init__(self, data, base, offsets):
+        """
+        :param data: map of names joined with "\n"
+        :param base: position of the first name in data
+        :param offsets: name n is data[base+offsets[n]:base+offsets[n+1]-1]
+        """
+        self._data = data
+        self._base = base
+        self._offsets = offsets
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+
+            if n < 0:
+                raise IndexError("name index out of range")
+
+        offsets = self._offsets
+
+        return self._data[self._base+offsets[n]:self._base+offsets[n+1]-1].decode()
+
+    def take(self, rows):
+        """
+        :param rows: array of name numbers
+        :return: list of the names of rows, faster than getting them one by one
+        """
+        data, base, offsets = self._data, self._base, self._offsets
+
+        return [data[base+offsets[n]:base+offsets[n+1]-1].decode() for n in rows]
+
+    def __iter__(self):
+        # decoded in blocks, iterating does not keep all names in memory
+        num = len(self)
+
+        return chain.from_iterable(self.take(range(i, min(i + 4096, num))) for i in range(0, num, 4096))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+def map_file(file):
+    """
+    map file read only, an empty file can not be mapped and is b""
+    :param file:
+    :return: mmap or b""
+    """
+    with open(file, "rb") as fh:
+        if not os.fstat(fh.fileno()).st_size:
+            return b""
+
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextmanager
+def process_pool(threads, initializer=None, initargs=()):
+    """
+    run tasks in a pool of processes, or in the current process if threads <= 1.
+    the tasks not started are cancelled if a task or the caller raises, the running tasks are waited,
+    workers are not killed, as killing a worker that is sending its result can hang multiprocessing.Pool
+    :param threads: number of processes
+    :param initializer: called with initargs in each process before its tasks
+    :param initargs:
+    :return: yield imap(func, tasks, ordered=True, chunksize=1), the iterator of func over tasks,
+             in the order of tasks if ordered else as they are done
+    """
+    if threads <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+
+        yield lambda func, tasks, ordered=True, chunksize=1: map(func, tasks)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=threads, initializer=initializer, initargs=initargs)
+
+    def imap(func, tasks, ordered=True, chunksize=1):
+        if ordered:
+            return pool.map(func, tasks, chunksize=chunksize)
+
+        return (i.result() for i in as_completed([pool.submit(func, i) for i in tasks]))
+
+    try:
+        yield imap
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def file_stamp(file):
+    """
+    :return: (mtime_ns, size) of file
+    """
+    stat = os.stat(file)
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_org_ko_table(file, cache_dir=None):
+    """
+    read KEGG organism KO .keg file through a binary cache,
+    the cache is rebuilt if the mtime or size of file changes
+    :param file: file name
+    :param cache_dir: directory of cache, no cache is used if None
+    :return: KoTable
+    """
+    if not cache_dir:
+        return read_org_ko_table(file)
+
+    stamp = file_stamp(file)
+    cache = os.path.join(cache_dir, os.path.basename(file) + ".kgt")
+
+    if os.path.exists(cache):
+        try:
+            table, cache_stamp = load_ko_table(cache)
+
+            if cache_stamp == stamp:
+                return table
+        except (ValueError, TypeError, OSError, struct.error) as e:
+            LOG.warning("cache %r is broken: %s" % (cache, e))
+
+    table = read_org_ko_table(file)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    dump_ko_table(table, cache, stamp)
+
+    return table
+
+
+class RankIndex(object):
+    """
+    prefix index of KEGG organisms by the lineage in KEGG.ranks created by get_ranks.py:
+    org, taxon_id, superkingdom, kingdom, phylum, class, order, family, genus, species
+    organisms are sorted by lineage, so the organisms under a lineage prefix are one range of them,
+    each prefix is indexed by its last name and found by binary search
+    """
+    RANKS = ("superkingdom", "kingdom", "phylum", "class", "order", "family", "genus", "species")
+
+    def __init__(self, file):
+        self.orgs = []
+        lineages = []
+
+        LOG.info("index organism ranks from %r" % file)
+
+        for line in open(file):
+            line = line.rstrip("\n")
+
+            if not line or line.startswith("#"):
+                continue
+
+            tmp = line.split("\t")
+            self.orgs.append(tmp[0])
+            lineages.append(tuple(tmp[2:2 + len(self.RANKS)]))
+
+        # org numbers sorted by lineage
+        self._order = sorted(range(len(self.orgs)), key=lineages.__getitem__)
+        # [(name, rank depth, start, end)] of each lineage prefix, the range is in self._order
+        nodes = []
+        starts = [0] * len(self.RANKS)
+        last = ()
+
+        for n, i in enumerate(self._order + [None]):
+            lineage = lineages[i] if i is not None else ()
+
+            # the depth where lineage leaves the prefixes of last
+            depth = 0
+            while depth < len(last) and depth < len(lineage) and last[depth] == lineage[depth]:
+                depth += 1
+
+            for d in range(depth, len(last)):
+                if last[d]:
+                    nodes.append((last[d], d, starts[d], n))
+
+            for d in range(depth, len(lineage)):
+                starts[d] = n
+
+            last = lineage
+
+        nodes.sort()
+        self._nodes = nodes
+        self._names = [i[0] for i in nodes]
+
+    def find(self, rank_filter):
+        """
+        :param rank_filter: "name" of any rank, or "rank=name", such as "Bacteria", "genus=Escherichia"
+        :return: set of org number
+        """
+        if "=" in rank_filter:
+            rank, name = rank_filter.split("=", 1)
+
+            if rank not in self.RANKS:
+                raise ValueError("rank %r not in %s" % (rank, self.RANKS))
+
+            depth = self.RANKS.index(rank)
         else:
-            LOG.warning("line %s: %r has no ko" % (n+1, line))
-            ko = ""
+            depth, name = None, rank_filter
 
-        if gene not in r:
-            r[gene] = {"ko": [], "path": []}
+        r = set()
 
-        if ko not in r[gene]["ko"]:
-            r[gene]["ko"].append(ko)
+        # a name may be the last of many prefixes, such as the same genus name in two families
+        for n in range(bisect_left(self._names, name), bisect_right(self._names, name)):
+            _, d, start, end = self._nodes[n]
 
-        if path_id not in r[gene]["path"]:
-            r[gene]["path"].append(path_id)
+            if depth is None or d == depth:
+                r.update(self._order[start:end])
 
-    return r
+        return r
+
+    def select(self, rank_filters):
+        """
+        select organisms matched all filters
+        :param rank_filters: list of filters, see find
+        :return: list of org abbr. in the order of file
+        """
+        r = None
+
+        for i in rank_filters:
+            found = self.find(i)
+            r = found if r is None else r & found
+
+            LOG.info("%s organisms in %r" % (len(found), i))
+
+        return [self.orgs[i] for i in sorted(r or [])]
+
+
+def read_org_ko(file):
+    """
+    read KEGG organism KO .keg file
+    :param file: file name
+    :return: dict contains {protein_id: {"ko": [], "path": []}}, if protein_id has no ko, the ko will be "-"
+    """
+
+    return read_org_ko_table(file).to_dict()
@@ -1,79 +1,113 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib.request
 import argparse
 import os.path
 import logging
 import sys
-import time
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from common import read_org, __author__, __email__, __version__
+from downloader import HTTPClient, Manifest, sync_file
 
 
 LOG = logging.getLogger(__name__)
 
+KO_URL = "http://www.kegg.jp/kegg-bin/download_htext?htext=%s&format=htext&filedir="
 
-def download(org, status, output_dir):
+
+def download(client, org, status, output_dir, url=KO_URL, manifest=None):
     """
     download .keg file contains KO information from KEGG
+    :param client: HTTPClient
     :param org: KEGG organism abbr.
     :param status: the download status
     :param output_dir: output directory
-    :return: 0
+    :param url: url of .keg, "%s" is replaced by the file name
+    :param manifest: Manifest, only new or changed files are kept if set
+    :return: 0, or org if it has no KO file
     """
 
-    time.sleep(2)
-
     LOG.info("%s processing %s" % (status, org))
     id = org + "00001.keg"
     out_file = os.path.join(output_dir, id)
 
+    if manifest is not None:
+        # a file without ETag or Last-Modified is downloaded again and compared by sha256
+        if sync_file(client, url % id, out_file, manifest):
+            LOG.info("%s updated" % id)
+
+        if not os.path.getsize(out_file):
+            LOG.warning("%s has no KO file" % org)
+            os.remove(out_file)
+            return org
+
+        return 0
+
     if os.path.exists(out_file):
-        LOG.info("%s has been downloaded before, skip")
+        LOG.info("%s has been downloaded before, skip" % org)
         return 0
 
-    file = urllib.request.urlopen("http://www.kegg.jp/kegg-bin/download_htext?htext=%s&format=htext&filedir=" % id)
+    data = client.fetch(url % id)
 
-    if not file.read():
+    if not data:
         LOG.warning("%s has no KO file" % org)
         return org
-    else:
-        with open(out_file, "wb") as out:
-            out.write(file.read())
+
+    tmp = out_file + ".tmp"
+
+    with open(tmp, "wb") as out:
+        out.write(data)
+
+    os.replace(tmp, out_file)
 
     return 0
 
 
-def download_ko(orgs, output_dir, concurrent=1):
+def download_ko(orgs, output_dir, concurrent=1, rate=2.0, url=KO_URL, manifest=None):
+    """
+    download .keg of organisms with threads, the connections are kept alive
+    :param orgs: list of KEGG organism abbr.
+    :param output_dir: output directory
+    :param concurrent: number of download threads
+    :param rate: max requests per second, 0 means no limit
+    :param url: see download
+    :param manifest: manifest file of incremental sync, see downloader.Manifest
+    :return: list of organisms failed
+    """
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    pool = Pool(processes=concurrent)
-    results = []
+    client = HTTPClient(rate=rate)
+    manifest = Manifest(manifest) if manifest else None
     num = len(orgs)
 
-    for n, org in enumerate(orgs):
-
+    def run(n, org):
         index = "%s/%s" % (n + 1, num)
-        results.append(pool.apply_async(download, (org, index, output_dir)))
 
-    pool.close()
-    pool.join()
+        try:
+            return download(client, org, index, output_dir, url, manifest)
+        except Exception as e:
+            LOG.warning("%s download failed: %s" % (org, e))
+            return org
 
-    returns = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent) as pool:
+            returns = list(pool.map(run, range(num), orgs))
+    finally:
+        # the connections kept alive by the threads of pool
+        client.close()
 
-    for i, result in enumerate(results):
-        returns.append(result.get())
+        if manifest:
+            manifest.save()
 
     fail = [i for i in returns if i]
-    LOG.info("%s records, %s failed! Here are they!" % (len(orgs), len(orgs)-len(fail)))
+    LOG.info("%s records, %s failed! Here are they!" % (len(orgs), len(fail)))
 
     print("\n".join(fail))
 
-    return 0
+    return fail
 
 
 def set_args():
@@ -91,7 +125,11 @@ contact: %s <%s>\
     args.add_argument("--out", metavar="DIR",
                       default=".", help="output directory (default: current directory)")
     args.add_argument("--concurrent", metavar="INT", type=int,
-                      default=5, help="number of processes concurrent (default: 1)")
+                      default=5, help="number of download threads concurrent (default: 5)")
+    args.add_argument("--rate", metavar="FLOAT", type=float,
+                      default=2.0, help="max requests per second, 0 means no limit (default: 2.0)")
+    args.add_argument("--manifest", metavar="FILE", default=None,
+                      help="manifest of files downloaded, only new or changed files are kept if set")
 
     return args.parse_args()
 
@@ -107,7 +145,7 @@ def main():
 
     orgs = read_org(args.org)
     LOG.info("download .keg from KEGG")
-    download_ko([i[0] for i in orgs], args.out, args.concurrent)
+    download_ko([i[0] for i in orgs], args.out, args.concurrent, args.rate, manifest=args.manifest)
 
 
 if __name__ == "__main__":
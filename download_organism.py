@@ -1,64 +1,188 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import re
 import sys
+import html
 import logging
 import urllib.request
 import argparse
+from collections import deque
 
-from common import __author__, __version__, __email__
+from common import read_org, __author__, __version__, __email__
 
 
 LOG = logging.getLogger(__name__)
 
+ORG_LIST_URL = "http://www.kegg.jp/kegg/catalog/org_list.html"
+CHUNK_SIZE = 1 << 16
+# <a href='url'>text</a>, quoted by ' or "
+LINK_RE = re.compile(rb"""<a\s[^>]*?href\s*=\s*(?:'([^']*)'|"([^"]*)")[^>]*>(.*?)</a\s*>""", re.S | re.I)
+TAG_RE = re.compile(rb"<[^>]*>")
 
-def html2org(url="http://www.kegg.jp/kegg/catalog/org_list.html"):
+
+class OrgListParser(object):
+    """
+    incremental parser of the KEGG organism catalog, fed with bytes of the page as they arrive.
+    links are scanned by LINK_RE, a record starts at the link to show_organism,
+    the text of the next link is the name, the first link to ftp is the download url
+    """
+
+    def __init__(self):
+        self.records = deque()
+        self._record = None
+        # bytes after the last link, may contain a link not complete
+        self._buffer = b""
+
+    def feed(self, data):
+        """
+        parse a part of page
+        :param data: bytes
+        """
+        data = self._buffer + data
+        end = 0
+
+        for match in LINK_RE.finditer(data):
+            href = match.group(1) if match.group(1) is not None else match.group(2)
+            self._link(href, match.group(3))
+            end = match.end()
+
+        rest = data[end:]
+        start = max(rest.rfind(b"<a"), rest.rfind(b"<A"))
+
+        if start < 0:
+            start = len(rest) - 1 if rest.endswith(b"<") else len(rest)
+
+        self._buffer = rest[start:]
+
+    def _link(self, href, text):
+        href = html.unescape(href.decode("utf-8", "replace"))
+
+        if "show_organism?" in href and "org=" in href:
+            self._finish()
+            self._record = [_link_text(text), None, ""]
+        elif self._record is None:
+            return
+        elif self._record[1] is None:
+            self._record[1] = _link_text(text)
+        elif not self._record[2] and ("ftp://" in href or "://ftp." in href):
+            self._record[2] = href
+
+    def _finish(self):
+        if self._record and self._record[0]:
+            self.records.append((self._record[0], self._record[1] or "", self._record[2]))
+
+        self._record = None
+
+    def close(self):
+        """
+        finish the last record
+        """
+        self._buffer = b""
+        self._finish()
+
+
+def _link_text(text):
+    return html.unescape(TAG_RE.sub(b"", text).decode("utf-8", "replace")).strip()
+
+
+def parse_org_list(chunks):
+    """
+    parse KEGG organism catalog as it is read
+    :param chunks: iterator of bytes of the page
+    :return: yield (org, name, url)
+    """
+    parser = OrgListParser()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+        while parser.records:
+            yield parser.records.popleft()
+
+    parser.close()
+
+    while parser.records:
+        yield parser.records.popleft()
+
+
+def iter_org_list(url=ORG_LIST_URL, chunk_size=CHUNK_SIZE):
+    """
+    request KEGG organism url and yield the organisms as the page arrives
+    :param url: the url of KEGG organism
+    :param chunk_size: bytes read each time
+    :return: yield (org, name, url)
+    """
+    LOG.info("open url %r to get KEGG org list" % url)
+    response = urllib.request.urlopen(url)
+
+    try:
+        for record in parse_org_list(iter(lambda: response.read(chunk_size), b"")):
+            yield record
+    finally:
+        response.close()
+
+
+def html2org(url=ORG_LIST_URL):
     """
     request KEGG organism url and get the organism abb. name and download url
     :param url: the url of KEGG organism, default is http://www.kegg.jp/kegg/catalog/org_list.html
-    :param out: the output
     :return: dict contain org information
     """
-
     r = {}
 
-    LOG.info("open url %r to get KEGG org list" % url)
-    file = urllib.request.urlopen(url)
-
-    org = name = link = ""
-    n = 0
+    for org, name, link in iter_org_list(url):
+        r[org] = [name, link]
 
-    for line in file:
-        line = line.decode("utf-8").strip()
+    LOG.info("get %s records from KEGG org" % len(r))
 
-        if "show_organism?org=" in line:
+    return r
 
-            if org:
-                r[org] = [name, link]
 
-            org = line.split("</a>")[0].split("'>")[-1]
-            name = link = ""
-            n = 1
-            continue
+def write_org(records, out):
+    """
+    write organisms to .org sorted by org, the last of duplicated organisms is kept like html2org
+    :param records: iterator of (org, name, url)
+    :param out: output file
+    :return: dict {org: [name, url]} written
+    """
+    r = {}
+    tmp = out + ".tmp"
 
-        if n == 1:
-            name = line.split("</a>")[0].split("'>")[-1]
-            n = 2
-            continue
-        if n == 2:
-            if "ftp://" not in line:
-                continue
-            link = line.split("href='")[-1].split("'>")[0]
-            n = 0
+    for org, name, link in records:
+        if org in r:
+            LOG.warning("%r is duplicated in KEGG org list, the last is kept" % org)
 
-    if org:
         r[org] = [name, link]
 
+    LOG.info("output records to %s" % out)
+
+    with open(tmp, "w") as fh:
+        for org, (name, link) in sorted(r.items()):
+            fh.write("%s\t%s\t%s\n" % (org, name, link))
+
+    os.replace(tmp, out)
     LOG.info("get %s records from KEGG org" % len(r))
 
     return r
 
 
+def compare_org(old, new):
+    """
+    compare organisms of an old .org with new records
+    :param old: records read from old .org
+    :param new: dict see html2org
+    :return: (added, removed, url changed) organisms
+    """
+    old = {i[0]: i[2] if len(i) > 2 else "" for i in old}
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(k for k in set(new) & set(old) if new[k][1] != old[k])
+
+    return added, removed, changed
+
+
 def set_args():
 
     args = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -86,13 +210,16 @@ def main():
     )
 
     args = set_args()
-    org_dict = html2org(args.url)
+    old = read_org(args.out) if os.path.exists(args.out) else None
+    org_dict = write_org(iter_org_list(args.url), args.out)
 
-    LOG.info("output records to %s" % args.out)
+    if old is not None:
+        added, removed, changed = compare_org(old, org_dict)
+        LOG.info("compare with the old %r: %s added, %s removed, %s url changed" % (
+            args.out, len(added), len(removed), len(changed)))
 
-    with open(args.out, "w") as fh:
-        for k, v in sorted(org_dict.items()):
-            fh.write("%s\t%s\t%s\n" % (k, v[0], v[1]))
+        for org in changed:
+            LOG.info("url of %s changed, download_proteins.py --manifest will fetch it again" % org)
 
 
 if __name__ == "__main__":
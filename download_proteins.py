@@ -1,77 +1,125 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib.request
 import argparse
 import os.path
 import logging
 import sys
-import time
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from common import read_org, __author__, __email__, __version__
+from downloader import HTTPClient, Manifest, sync_file
+from GzipReader import inflate_members
 
 
 LOG = logging.getLogger(__name__)
 
 
-def download(org, status, output_dir):
+def protein_url(url):
+    """
+    get the url of translated cds from NCBI assembly url, ftp is replaced by https
+    which supports keep-alive and Range requests on the same tree
+    :param url: NCBI assembly url in .org
+    :return: url
+    """
+    if url.startswith("ftp://ftp.ncbi.nlm.nih.gov/"):
+        url = "https://" + url[len("ftp://"):]
+
+    url = url.rstrip("/")
+
+    return "%s/%s_translated_cds.faa.gz" % (url, url.split("/")[-1])
+
+
+def check_gzip(file):
+    """
+    decompress file to check the integrity, raise if file is broken
+    :param file:
+    :return: uncompressed size
+    """
+    size = 0
+
+    with open(file, "rb") as fh:
+        for chunk in inflate_members(fh):
+            size += len(chunk)
+
+    return size
+
+
+def download(client, org, status, output_dir, manifest=None):
     """
     download proteins from NCBI according to KEGG organism url
+    :param client: HTTPClient
     :param org: [organism abbr., organism name, url]
     :param status: download status, m/n
     :param output_dir: output directory
+    :param manifest: Manifest, only new or changed files are downloaded if set
     :return: 0
     """
 
-    time.sleep(2)
-
     o, name, url = org
-    LOG.info("%s get %s proteins from %r" % (status, o, url))
-    url = "%s/%s_translated_cds.faa.gz" % (url, url.split("/")[-1])
-    file = urllib.request.urlopen(url)
     out_file = os.path.join(output_dir, "%s.pep.fasta.gz" % o)
 
-    if not os.path.exists(out_file):
+    if manifest is not None:
+        url = protein_url(url)
+
+        if sync_file(client, url, out_file, manifest, check=check_gzip):
+            LOG.info("%s %s proteins updated from %r" % (status, o, url))
+        else:
+            LOG.info("%s %s not changed" % (status, o))
+
+        return 0
 
-        with open(out_file, "wb") as out:
-            out.write(file.read())
+    if os.path.exists(out_file):
+        LOG.info("%s %s has been downloaded before, skip" % (status, o))
+        return 0
+
+    url = protein_url(url)
+    LOG.info("%s get %s proteins from %r" % (status, o, url))
+    client.download(url, out_file, check=check_gzip)
 
     return 0
 
 
-def get_proteins(orgs, output_dir, concurrent=1):
+def get_proteins(orgs, output_dir, concurrent=1, rate=0, manifest=None):
     """
-    download proteins from NCBI use multiprocessing
+    download proteins from NCBI with threads, interrupted downloads are resumed
     :param orgs: org list read from .org
     :param output_dir: output directory
-    :param concurrent: max concurrent process to download
-    :return: 0
+    :param concurrent: max concurrent threads to download
+    :param rate: max requests per second, 0 means no limit
+    :param manifest: manifest file of incremental sync, see downloader.Manifest
+    :return: list of organisms failed
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    pool = Pool(processes=concurrent)
-    results = []
+    client = HTTPClient(rate=rate)
+    manifest = Manifest(manifest) if manifest else None
     num = len(orgs)
 
-    for n, org in enumerate(orgs):
-
+    def run(n, org):
         index = "%s/%s" % (n + 1, num)
-        results.append(pool.apply_async(download, (org, index, output_dir)))
 
-    pool.close()
-    pool.join()
+        try:
+            return download(client, org, index, output_dir, manifest)
+        except Exception as e:
+            LOG.warning("%s download failed: %s" % (org[0], e))
+            return org[0]
 
-    returns = []
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent) as pool:
+            returns = list(pool.map(run, range(num), orgs))
+    finally:
+        # the connections kept alive by the threads of pool
+        client.close()
 
-    for i, result in enumerate(results):
-        returns.append(result.get())
+        if manifest:
+            manifest.save()
 
     fail = [i for i in returns if i != 0]
     LOG.info("%s success, %s failed" % (len(orgs)-len(fail), len(fail)))
 
-    return 0
+    return fail
 
 
 def set_args():
@@ -87,7 +135,11 @@ contact: %s <%s>\
     args.add_argument("--org", metavar="FILE", required=True, help=".org file created by download_organism.py")
     args.add_argument("--out", metavar="DIR", default=".", help="output directory (default: current directory)")
     args.add_argument("--concurrent", metavar="INT", type=int,
-                      default=1, help="number of download processes concurrent (default: 1)")
+                      default=1, help="number of download threads concurrent (default: 1)")
+    args.add_argument("--rate", metavar="FLOAT", type=float,
+                      default=0.5, help="max requests per second, 0 means no limit (default: 0.5)")
+    args.add_argument("--manifest", metavar="FILE", default=None,
+                      help="manifest of files downloaded, only new or changed files are downloaded if set")
 
     return args.parse_args()
 
@@ -120,7 +172,7 @@ def main():
         allowed_orgs.append(org)
 
     LOG.info("%s records pass, downloading..." % len(allowed_orgs))
-    get_proteins(allowed_orgs, args.out, args.concurrent)
+    get_proteins(allowed_orgs, args.out, args.concurrent, args.rate, args.manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,437 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import http.client
+import urllib.parse
+
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+RETRY_STATUS = (429, 500, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    """
+    error status returned by server
+    """
+
+    def __init__(self, url, status, reason=""):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        Exception.__init__(self, "HTTP %s %s: %s" % (status, reason, url))
+
+
+class TokenBucket(object):
+    """
+    token bucket rate limiter shared by threads
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens added per second, 0 means no limit
+        :param burst: max tokens kept
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        take a token, wait until one is available
+        """
+        if not self.rate:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class HTTPClient(object):
+    """
+    HTTP client keeps alive one connection per host in each thread,
+    requests are rate limited and retried with exponential backoff,
+    the connections of all threads are closed by close
+    """
+
+    def __init__(self, rate=0, retries=3, backoff=1.0, timeout=60):
+        """
+        :param rate: max requests per second of all threads, 0 means no limit
+        :param retries: times to retry a failed request
+        :param backoff: seconds to wait before the first retry, doubled for each retry
+        :param timeout: socket timeout in seconds
+        """
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+        # connections of all threads, the connections of a thread are dropped if they were closed by close
+        self._conns = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc):
+        local = self._local.__dict__
+
+        if local.get("generation") != self._generation:
+            local["conns"] = {}
+            local["generation"] = self._generation
+
+        conns = local["conns"]
+        key = (scheme, netloc)
+
+        if key not in conns:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == "http":
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise ValueError("unsupported url scheme %r" % scheme)
+
+            with self._lock:
+                self._conns.add(conn)
+
+            conns[key] = conn
+
+        return conns[key]
+
+    def _close(self, scheme, netloc):
+        conn = self._local.__dict__.get("conns", {}).pop((scheme, netloc), None)
+
+        if conn:
+            with self._lock:
+                self._conns.discard(conn)
+
+            conn.close()
+
+    def close(self):
+        """
+        close the connections of all threads, a thread opens new connections if it sends requests later
+        """
+        with self._lock:
+            conns = list(self._conns)
+            self._conns.clear()
+            self._generation += 1
+
+        for conn in conns:
+            conn.close()
+
+    def _send(self, url, method, headers):
+        """
+        send one request, a request on a reused connection closed by server is sent again
+        :return: response
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+
+        if parts.query:
+            path += "?" + parts.query
+
+        for n in range(2):
+            conn = self._connection(parts.scheme, parts.netloc)
+            reused = conn.sock is not None
+
+            try:
+                conn.request(method, path, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._close(parts.scheme, parts.netloc)
+
+                if not reused or n:
+                    raise
+
+    def open(self, url, headers=None, method="GET"):
+        """
+        send request and follow redirects, the body of response must be read to reuse the connection
+        :param url:
+        :param headers: dict of request headers
+        :param method:
+        :return: response of status < 300 or 304 Not Modified
+        """
+        headers = dict(headers or {})
+
+        for n in range(MAX_REDIRECTS + 1):
+            self.bucket.acquire()
+            response = self._send(url, method, headers)
+
+            if response.status in REDIRECT_STATUS and response.getheader("Location"):
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+
+            if response.status == 304:
+                response.read()
+                return response
+
+            if response.status >= 300:
+                response.read()
+                raise HTTPError(url, response.status, response.reason)
+
+            return response
+
+        raise HTTPError(url, response.status, "too many redirects")
+
+    def retry(self, func, url):
+        """
+        call func(), retry if connection failed or server is busy
+        :param func: function to send request and read response
+        :param url: url for log
+        :return: the result of func
+        """
+        for n in range(self.retries + 1):
+            try:
+                return func()
+            except HTTPError as e:
+                if e.status not in RETRY_STATUS or n == self.retries:
+                    raise
+
+                error = e
+            except (OSError, http.client.HTTPException) as e:
+                parts = urllib.parse.urlsplit(url)
+                self._close(parts.scheme, parts.netloc)
+
+                if n == self.retries:
+                    raise
+
+                error = e
+
+            wait = self.backoff * 2 ** n
+            LOG.warning("request %r failed: %s, retry in %ss" % (url, error, wait))
+            time.sleep(wait)
+
+    def fetch(self, url, headers=None):
+        """
+        get the body of url
+        :param url:
+        :param headers: dict of request headers
+        :return: bytes
+        """
+        return self.retry(lambda: self.open(url, headers).read(), url)
+
+    def download(self, url, file, headers=None, chunk_size=CHUNK_SIZE, check=None):
+        """
+        download url to file.part in chunks and rename it to file at the end,
+        an existing file.part left by an interrupted download is resumed by Range request,
+        only if file.part.json records the same url, and If-Range with its ETag
+        :param url:
+        :param file: output file
+        :param headers: dict of request headers, such as If-None-Match
+        :param chunk_size: bytes read and written each time
+        :param check: function called with the name of .part before rename, raise if it is broken
+        :return: dict {"size":, "etag":, "last_modified":}, None if server replies 304 Not Modified
+        """
+        part = file + ".part"
+        source = part + ".json"
+        meta = {}
+
+        def run():
+            pos = os.path.getsize(part) if os.path.exists(part) else 0
+            request_headers = dict(headers or {})
+            etag = None
+
+            if pos:
+                try:
+                    with open(source) as fh:
+                        record = json.load(fh)
+                except (OSError, ValueError):
+                    record = {}
+
+                if record.get("url") == url:
+                    etag = record.get("etag")
+                else:
+                    # .part of another url or of unknown source is not resumed
+                    LOG.info("%r is not downloaded from %r, download again" % (part, url))
+                    os.remove(part)
+                    pos = 0
+
+            if pos:
+                request_headers["Range"] = "bytes=%s-" % pos
+
+                # the server sends the whole file if it changed since .part was started
+                if etag:
+                    request_headers["If-Range"] = etag
+
+            try:
+                response = self.open(url, request_headers)
+            except HTTPError as e:
+                # the range starts at the end of file, .part is complete
+                if e.status == 416 and pos:
+                    return pos
+                raise
+
+            if response.status == 304:
+                return None
+
+            meta["etag"] = response.getheader("ETag")
+            meta["last_modified"] = response.getheader("Last-Modified")
+
+            if response.status == 206:
+                mode = "ab"
+                total = response.getheader("Content-Range", "").split("/")[-1]
+            else:
+                pos = 0
+                mode = "wb"
+                total = response.getheader("Content-Length", "")
+
+                with open(source, "w") as fh:
+                    json.dump({"url": url, "etag": meta["etag"]}, fh)
+
+            with open(part, mode) as fh:
+                while True:
+                    chunk = response.read(chunk_size)
+
+                    if not chunk:
+                        break
+
+                    fh.write(chunk)
+                    pos += len(chunk)
+
+            if total.isdigit() and pos != int(total):
+                raise http.client.HTTPException("get %s bytes of %s from %r" % (pos, total, url))
+
+            return pos
+
+        size = self.retry(run, url)
+
+        if size is None:
+            return None
+
+        if check:
+            try:
+                check(part)
+            except Exception:
+                os.remove(part)
+                raise
+
+        os.replace(part, file)
+
+        if os.path.exists(source):
+            os.remove(source)
+        meta["size"] = size
+
+        return meta
+
+
+def file_sha256(file):
+    """
+    :return: hex sha256 of file
+    """
+    sha = hashlib.sha256()
+
+    with open(file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    """
+    local record of the files downloaded, {file name: {"url", "etag", "last_modified", "size", "sha256"}},
+    saved as JSON
+    """
+
+    def __init__(self, file, save_every=100):
+        """
+        :param file: JSON file, created if not exists
+        :param save_every: save the file after this number of changes
+        """
+        self.file = file
+        self.save_every = save_every
+        self.records = {}
+        self._changes = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(file):
+            with open(file) as fh:
+                self.records = json.load(fh)
+
+    def get(self, key):
+        with self._lock:
+            return self.records.get(key)
+
+    def set(self, key, record):
+        with self._lock:
+            self.records[key] = record
+            self._changes += 1
+
+            if self._changes >= self.save_every:
+                self._save()
+
+    def _save(self):
+        tmp = self.file + ".tmp"
+
+        with open(tmp, "w") as fh:
+            json.dump(self.records, fh, indent=1, sort_keys=True)
+
+        os.replace(tmp, self.file)
+        self._changes = 0
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+
+def sync_file(client, url, file, manifest, check=None):
+    """
+    download url to file only if it is new or changed since the last sync:
+    a file recorded with the same url and size is requested with If-None-Match/If-Modified-Since,
+    a file not recorded but exists is adopted if its size equals the Content-Length of HEAD
+    :param client: HTTPClient
+    :param url:
+    :param file: output file
+    :param manifest: Manifest
+    :param check: see HTTPClient.download
+    :return: True if file is changed
+    """
+    key = os.path.basename(file)
+    record = manifest.get(key)
+    headers = {}
+    complete = os.path.exists(file) and not os.path.exists(file + ".part")
+
+    if complete and record and record.get("url") == url and record.get("size") == os.path.getsize(file):
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+    elif complete and not record:
+        response = client.retry(lambda: client.open(url, method="HEAD"), url)
+        response.read()
+
+        if response.getheader("Content-Length") == str(os.path.getsize(file)):
+            manifest.set(key, {
+                "url": url, "etag": response.getheader("ETag"),
+                "last_modified": response.getheader("Last-Modified"),
+                "size": os.path.getsize(file), "sha256": file_sha256(file)})
+            return False
+
+    meta = client.download(url, file, headers=headers, check=check)
+
+    if meta is None:
+        return False
+
+    meta["url"] = url
+    meta["sha256"] = file_sha256(file)
+    manifest.set(key, meta)
+
+    return not record or record.get("sha256") != meta["sha256"]
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import math
+import pickle
+import argparse
+import logging
+from array import array
+
+from common import file_stamp, process_pool, __author__, __email__, __version__
+from make_keg import cluster_protein, is_ko_table, load_hierarchy, read_annotation, read_ko_table, sample_name
+
+LOG = logging.getLogger(__name__)
+
+__all__ = []
+
+# the background shared by the samples scored in a worker
+_BACKGROUND = None
+_NAMES = None
+
+
+class Background(object):
+    """
+    proteins of each pathway in the background database, such as {out}.pep2ko.txt of makedb.py,
+    a row of the database is a protein, as the same gene id may be in many organisms
+    """
+    VERSION = 1
+
+    def __init__(self, paths, counts, total, stamp=(0, 0)):
+        """
+        :param paths: list of pathways
+        :param counts: array of the number of proteins of each pathway
+        :param total: number of proteins in any pathway
+        :param stamp: (mtime_ns, size) of the database
+        """
+        self.paths = paths
+        self.counts = counts
+        self.total = total
+        self.stamp = stamp
+        self._index = {p: n for n, p in enumerate(paths)}
+
+    @classmethod
+    def from_annotation(cls, file):
+        """
+        count the proteins of pathways in pep2ko, text or columnar
+        :param file: pep2ko of makedb.py
+        :return: Background
+        """
+        LOG.info("count the background proteins of pathways in %r" % file)
+
+        if is_ko_table(file):
+            table = read_ko_table(file)
+            path_ptr, path_idx = table.path_ptr, table.path_idx
+            counts = array("I", [0]) * len(table.paths)
+            total = 0
+
+            for n in range(len(table)):
+                start, end = path_ptr[n], path_ptr[n+1]
+
+                if end - start == 1:
+                    counts[path_idx[start]] += 1
+                elif end > start:
+                    for p in set(path_idx[start:end]):
+                        counts[p] += 1
+                else:
+                    continue
+
+                total += 1
+
+            return cls(list(table.paths), counts, total, file_stamp(file))
+
+        ids = {}
+        counts = array("I")
+        total = 0
+
+        for protein, ko, pathway in read_annotation(file):
+            paths = set(i for i in pathway.split(";") if i)
+
+            if not paths:
+                continue
+
+            for path in paths:
+                p = ids.get(path)
+
+                if p is None:
+                    p = ids[path] = len(ids)
+                    counts.append(0)
+
+                counts[p] += 1
+
+            total += 1
+
+        return cls(sorted(ids, key=ids.get), counts, total, file_stamp(file))
+
+    def count(self, path):
+        """
+        :return: number of proteins of pathway, 0 if not in background
+        """
+        n = self._index.get(path)
+
+        return 0 if n is None else self.counts[n]
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def load_background(file, cache_dir=None):
+    """
+    count the background proteins of pathways through a pickled cache,
+    the cache is rebuilt if the mtime or size of file changes
+    :param file: pep2ko of makedb.py
+    :param cache_dir: directory of cache, no cache is used if None
+    :return: Background
+    """
+    if not cache_dir:
+        return Background.from_annotation(file)
+
+    stamp = file_stamp(file)
+    cache = os.path.join(cache_dir, os.path.basename(file) + ".bg.pkl")
+
+    if os.path.exists(cache):
+        try:
+            with open(cache, "rb") as fh:
+                version, cache_stamp, paths, counts, total = pickle.load(fh)
+
+            if version == Background.VERSION and cache_stamp == stamp:
+                return Background(paths, counts, total, stamp)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, OSError) as e:
+            LOG.warning("cache %r is broken: %s" % (cache, e))
+
+    background = Background.from_annotation(file)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    tmp = "%s.%s.tmp" % (cache, os.getpid())
+
+    with open(tmp, "wb") as fh:
+        pickle.dump((background.VERSION, background.stamp, background.paths, background.counts,
+                     background.total), fh, pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp, cache)
+
+    return background
+
+
+def _log_comb(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def _hypergeom_sf(k, total, good, drawn):
+    """
+    P(X >= k) of one hypergeometric test, the terms are summed from k away from the mode,
+    each term is got from the last by their ratio
+    """
+    low = max(0, drawn - (total - good))
+    high = min(good, drawn)
+
+    if k <= low:
+        return 1.0
+
+    if k > high:
+        return 0.0
+
+    rest = total - good - drawn
+    mode = (drawn + 1) * (good + 1) // (total + 2)
+    start = k if k > mode else k - 1
+    term = 1.0
+    r = 1.0
+
+    if k > mode:
+        # term of i + 1 from term of i
+        for i in range(k, high):
+            term *= (good - i) * (drawn - i) / ((i + 1.0) * (rest + i + 1))
+            r += term
+
+            if term < r * 1e-17:
+                break
+    else:
+        # term of i - 1 from term of i, P(X >= k) is 1 - P(X < k)
+        for i in range(k - 1, low, -1):
+            term *= i * (rest + i) / ((good - i + 1.0) * (drawn - i + 1))
+            r += term
+
+            if term < r * 1e-17:
+                break
+
+    r *= math.exp(_log_comb(good, start) + _log_comb(total - good, drawn - start) - _log_comb(total, drawn))
+
+    return min(1.0, r) if k > mode else max(0.0, 1.0 - r)
+
+
+def hypergeom_sf(hits, goods, drawns, total):
+    """
+    p-values of over-representation, P(X >= hit) of hypergeometric distributions of a batch of tests
+    :param hits: list of proteins of sample in each pathway
+    :param goods: list of proteins of background in each pathway
+    :param drawns: list of proteins of sample
+    :param total: proteins of background
+    :return: list of p-values
+    """
+    return [_hypergeom_sf(hit, total, good, drawn) for hit, good, drawn in zip(hits, goods, drawns)]
+
+
+def bh_fdr(pvalues):
+    """
+    q-values of Benjamini-Hochberg false discovery rate
+    :param pvalues: list of p-values
+    :return: list of q-values in the order of pvalues
+    """
+    num = len(pvalues)
+    order = sorted(range(num), key=pvalues.__getitem__, reverse=True)
+    r = [0.0] * num
+    q = 1.0
+
+    for rank, i in zip(range(num, 0, -1), order):
+        q = min(q, pvalues[i] * num / rank)
+        r[i] = q
+
+    return r
+
+
+def enrich(background, path_dict):
+    """
+    test the over-representation of the proteins of a sample in pathways of background
+    :param background: Background
+    :param path_dict: dict {pathway: {ko: [proteins]}}, see make_keg.cluster_protein
+    :return: list of (pathway, hits, proteins of sample, hits of background, proteins of background,
+             fold, p-value, q-value) sorted by p-value, pathways without hits are not tested
+    """
+    hits = {}
+    proteins = set()
+
+    for path, kos in path_dict.items():
+        if path not in background:
+            continue
+
+        members = set()
+
+        for ko in kos.values():
+            members.update(ko)
+
+        hits[path] = len(members)
+        proteins |= members
+
+    drawn = len(proteins)
+    total = background.total
+    paths = [p for p in hits if hits[p]]
+    goods = [background.count(p) for p in paths]
+    counts = [hits[p] for p in paths]
+
+    # a sample not annotated by the same database may have more proteins than the background
+    if any(h > g for h, g in zip(counts, goods)) or drawn > total:
+        LOG.warning("the sample has more proteins than the background in some pathways, "
+                    "the background is raised to the sample")
+        goods = [max(h, g) for h, g in zip(counts, goods)]
+        total = max(total, drawn)
+
+    pvalues = hypergeom_sf(counts, goods, [drawn] * len(paths), total)
+    qvalues = bh_fdr(pvalues)
+    r = []
+
+    for path, hit, good, p, q in zip(paths, counts, goods, pvalues, qvalues):
+        fold = (hit / drawn) / (good / total) if good else float("inf")
+        r.append((path, hit, drawn, good, total, fold, p, q))
+
+    r.sort(key=lambda i: (i[6], i[0]))
+
+    return r
+
+
+def pathway_names(keg, cache_dir=None):
+    """
+    names of pathways in ko00001.keg, such as {"ko00010": "Glycolysis / Gluconeogenesis"}
+    :param keg: ko00001.keg
+    :param cache_dir: directory to cache parsed ko00001.keg
+    :return: dict {pathway: name}
+    """
+    r = {}
+
+    for text, path_id, entries in load_hierarchy(keg, cache_dir).blocks:
+        if path_id and path_id not in r:
+            # the C line of the pathway is the last line of the text of block
+            name = text.rstrip("\n").rsplit("\n", 1)[-1].split(None, 2)[-1]
+            r[path_id] = name.split(" [PATH:")[0]
+
+    return r
+
+
+def write_enrich(rows, file, names=None):
+    """
+    write the enrichment of a sample
+    :param rows: see enrich
+    :param file: output file
+    :param names: dict {pathway: name}, see pathway_names
+    :return: 0
+    """
+    names = names or {}
+
+    with open(file, "w") as fh:
+        fh.write("#pathway\tname\thits\tsample\tbackground_hits\tbackground\tfold\tpvalue\tqvalue\n")
+
+        for path, hit, drawn, good, total, fold, p, q in rows:
+            fh.write("%s\t%s\t%s\t%s\t%s\t%s\t%.4g\t%.6g\t%.6g\n" % (
+                path, names.get(path, ""), hit, drawn, good, total, fold, p, q))
+
+    return 0
+
+
+def _init_worker(background, names):
+    global _BACKGROUND, _NAMES
+    _BACKGROUND = background
+    _NAMES = names
+
+
+def enrich_sample(file, output):
+    """
+    test the enrichment of a sample with the shared background
+    :param file: kegg annotation result
+    :param output: output file
+    :return: (file, number of pathways with q-value < 0.05)
+    """
+    rows = enrich(_BACKGROUND, cluster_protein(file))
+    write_enrich(rows, output, _NAMES)
+
+    return file, sum(1 for i in rows if i[7] < 0.05)
+
+
+def _enrich_sample(args):
+    return enrich_sample(*args)
+
+
+def enrich_samples(background, files, prefix, threads=1, names=None):
+    """
+    test the enrichment of many samples with the background counted once
+    :param background: Background
+    :param files: list of kegg annotation results
+    :param prefix: output prefix, outputs are {prefix}.enrich.tsv for one file, {prefix}.{sample}.enrich.tsv for more
+    :param threads: number of processes
+    :param names: dict {pathway: name}, see pathway_names
+    :return: list of output files
+    """
+    tasks = []
+
+    for file in files:
+        if len(files) == 1:
+            tasks.append((file, prefix + ".enrich.tsv"))
+        else:
+            tasks.append((file, "%s.%s.enrich.tsv" % (prefix, sample_name(file))))
+
+    # the background is sent once to each worker instead of with each sample
+    with process_pool(threads, _init_worker, (background, names)) as imap:
+        for n, (file, num) in enumerate(imap(_enrich_sample, tasks, ordered=False)):
+            LOG.info("%s/%s %r has %s pathways enriched (q < 0.05)" % (n+1, len(tasks), file, num))
+
+    return [i[1] for i in tasks]
+
+
+def set_args():
+
+    args = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                   description="""
+test the enrichment of pathways of kegg annotation results against the background database,
+by hypergeometric test and Benjamini-Hochberg false discovery rate
+
+version: %s
+contact: %s <%s>\
+    """ % (__version__, " ".join(__author__), __email__))
+
+    args.add_argument("--background", metavar="FILE", required=True,
+                      help="pep2ko of the database created by makedb.py, text or columnar .pep2ko.kgt")
+    args.add_argument("--in", metavar="FILE", dest="input", nargs="+", required=True,
+                      help="KEGG annotation result consist protein id, KO, pathway joined with '\t', "
+                           "many files are output to {out}.{sample}.enrich.tsv")
+    args.add_argument("--keg", metavar="FILE", default=None,
+                      help="KO file downloaded from KEGG to name the pathways, usually named 'ko00001.keg'")
+    args.add_argument("--out", metavar="STR", default="out", help="output prefix (default: out)")
+    args.add_argument("--threads", metavar="INT", type=int, default=1,
+                      help="number of processes to test samples (default: 1)")
+    args.add_argument("--cache", metavar="DIR", default=None,
+                      help="directory to cache the background counts and parsed KO file, "
+                           "reused if they not changed (default: no cache)")
+
+    return args.parse_args()
+
+
+def main():
+
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format="[%(levelname)s] %(message)s"
+    )
+
+    args = set_args()
+    background = load_background(args.background, args.cache)
+    names = pathway_names(args.keg, args.cache) if args.keg else None
+    enrich_samples(background, args.input, args.out, args.threads, names)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import mmap
+import struct
 import argparse
 import logging
-import string
 import sys
+from array import array
+from bisect import bisect_left
 
-from common import __version__, __email__, __author__
+from common import file_stamp, map_array, map_file, __version__, __email__, __author__
+from htext import LEVELS, open_htext
 
 
 LOG = logging.getLogger(__name__)
 __all__ = []
 
+# header of taxon index: magic, version, mtime_ns and size of taxon file, number of taxon ids,
+# the header and arrays are little endian on any machine
+TAXON_INDEX_MAGIC = b"KGTX"
+TAXON_INDEX_VERSION = 2
+TAXON_INDEX_HEADER = struct.Struct("<4sIqQQ")
+# the level below each level of htext
+CHILD = {i: chr(ord(i) + 1) for i in LEVELS}
+
 
 def read_kegg_org(file):
     """
@@ -22,68 +35,236 @@ def read_kegg_org(file):
     r = {}
 
     taxon = ""
-    level = "A"
-    levels = {k: n for n, k in enumerate(string.ascii_uppercase)}
+    # organisms are the level right below the taxon
+    child = "B"
+
+    # every line is read, taking the tag here is faster than pairing it in htext
+    with open_htext(file, tags=False) as lines:
+        for line in lines:
+            tag = line[0]
+
+            if "TAX:" in line:
+                if tag in CHILD:
+                    child = CHILD[tag]
+                    taxon = line.rpartition("TAX:")[2].partition("]")[0]
+            elif tag == child:
+                if taxon:
+                    org = line.split(None, 2)[1]
+
+                    if not org.isdigit():
+                        r[org] = taxon
+            elif tag in CHILD:
+                taxon = ""
 
-    for line in open(file):
-        line = line.strip()
+    return r
 
-        tag = line[0]
 
-        if tag not in levels:
-            continue
+def read_taxon(file, taxon_ids=None):
+    """
+    read NCBI taxonomy ranks file
+    :param file: taxon_id and ranks separated with tab
+    :param taxon_ids: set of taxon ids to keep, all lines are kept if None
+    :return: dict {taxon_id: line}
+    """
+    r = {}
 
-        if "TAX:" in line:
-            taxon = line.split("TAX:")[-1].split("]")[0]
-            level = tag
+    for line in open(file):
+
+        if line.startswith("#"):
             continue
 
-        if levels[tag] - levels[level] == 1:
-            if taxon:
-                # print("%s\t %s" % (line.split()[1], taxon))
-                org = line.split()[1]
+        taxon_id = line.split(None, 1)[0] if line.strip() else ""
 
-                if not org.isdigit():
-                    r[org] = taxon
-        else:
-            taxon = ""
+        if taxon_ids is None or taxon_id in taxon_ids:
+            r[taxon_id] = line.rstrip("\n")
 
     return r
 
 
-def read_taxon(file):
+def build_taxon_index(file, index):
+    """
+    index the lines of NCBI taxonomy ranks file by numeric taxon id,
+    the index is a header, the sorted taxon ids and the offsets of their lines
+    :param file: taxon_id and ranks separated with tab
+    :param index: output index file
+    :return: number of taxon ids
+    """
+    ids = array("Q")
+    offsets = array("Q")
+    pos = 0
+    skipped = 0
 
-    r = {}
+    LOG.info("index NCBI taxon ranks %r to %r" % (file, index))
 
-    for line in open(file):
+    with open(file, "rb") as fh:
+        for line in fh:
+            taxon_id = line.split(None, 1)[0] if not line.startswith(b"#") and line.strip() else b""
 
-        if line.startswith("#"):
-            continue
+            if taxon_id.isdigit():
+                ids.append(int(taxon_id))
+                offsets.append(pos)
+            elif taxon_id:
+                skipped += 1
 
-        line = line.rstrip("\n")
-        taxon_id = line.split()[0]
-        r[taxon_id] = line
+            pos += len(line)
 
-    return r
+    if skipped:
+        LOG.warning("%s lines without numeric taxon id are not indexed" % skipped)
+
+    # the NCBI dump is usually sorted already
+    if any(ids[i] > ids[i+1] for i in range(len(ids) - 1)):
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        ids = array("Q", [ids[i] for i in order])
+        offsets = array("Q", [offsets[i] for i in order])
+
+    stamp = file_stamp(file)
+    tmp = "%s.%s.tmp" % (index, os.getpid())
+
+    with open(tmp, "wb") as fh:
+        fh.write(TAXON_INDEX_HEADER.pack(TAXON_INDEX_MAGIC, TAXON_INDEX_VERSION, stamp[0], stamp[1], len(ids)))
+
+        for a in (ids, offsets):
+            if sys.byteorder == "big":
+                a.byteswap()
+
+            a.tofile(fh)
+
+    os.replace(tmp, index)
+
+    return len(ids)
+
+
+class TaxonIndex(object):
+    """
+    query NCBI taxonomy ranks file by the index of build_taxon_index,
+    the index and the file are mapped and a taxon id is found by binary search
+    """
+
+    def __init__(self, file, index):
+        """
+        :param file: taxon_id and ranks separated with tab
+        :param index: index of file
+        """
+        self._file = map_file(file)
+        self._index = map_file(index)
 
+        if len(self._index) < TAXON_INDEX_HEADER.size:
+            raise ValueError("%r is not a taxon index" % index)
 
-def org2taxon(org, taxon):
+        magic, version, mtime, size, self._num = TAXON_INDEX_HEADER.unpack_from(self._index, 0)
 
+        if magic != TAXON_INDEX_MAGIC or version != TAXON_INDEX_VERSION:
+            raise ValueError("%r is not a taxon index" % index)
+
+        if len(self._index) != TAXON_INDEX_HEADER.size + 16 * self._num:
+            raise ValueError("%r is truncated or broken" % index)
+
+        self.stamp = (mtime, size)
+        self._ids = map_array(self._index, TAXON_INDEX_HEADER.size, "Q", self._num)
+        self._offsets = map_array(self._index, TAXON_INDEX_HEADER.size + 8 * self._num, "Q", self._num)
+
+    def get(self, taxon_id):
+        """
+        :param taxon_id: str or int
+        :return: the line of taxon_id without line end, None if not found
+        """
+        taxon_id = str(taxon_id)
+
+        if not taxon_id.isdigit():
+            return None
+
+        n = bisect_left(self._ids, int(taxon_id))
+
+        if n >= self._num or self._ids[n] != int(taxon_id):
+            return None
+
+        start = self._offsets[n]
+        end = self._file.find(b"\n", start)
+
+        return self._file[start:end if end >= 0 else len(self._file)].decode().rstrip("\r")
+
+    def __contains__(self, taxon_id):
+        return self.get(taxon_id) is not None
+
+    def __len__(self):
+        return self._num
+
+    def close(self):
+        # views of the map on little endian machines
+        for a in (self._ids, self._offsets):
+            if isinstance(a, memoryview):
+                a.release()
+
+        for i in (self._file, self._index):
+            if isinstance(i, mmap.mmap):
+                i.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_taxon_index(file, index=None):
+    """
+    open the index of NCBI taxonomy ranks file, the index is built if not exists or file changed
+    :param file: taxon_id and ranks separated with tab
+    :param index: index file, default is {file}.idx
+    :return: TaxonIndex
+    """
+    index = index or file + ".idx"
+
+    if os.path.exists(index):
+        try:
+            taxon_index = TaxonIndex(file, index)
+
+            if taxon_index.stamp == file_stamp(file):
+                return taxon_index
+
+            taxon_index.close()
+            LOG.info("%r changed, index again" % file)
+        except ValueError as e:
+            LOG.warning("index %r is broken: %s" % (index, e))
+
+    build_taxon_index(file, index)
+
+    return TaxonIndex(file, index)
+
+
+def org2taxon(org, taxon, index=False):
+    """
+    get the ranks of KEGG organisms
+    :param org: br08610.keg
+    :param taxon: NCBI taxonomy ranks file
+    :param index: query taxon by the index {taxon}.idx instead of reading the file
+    :return: dict {org: line of ranks}
+    """
     r = {}
 
     LOG.info("reading KEGG Organisms taxon from %r" % org)
     org = read_kegg_org(org)
-    LOG.info("reading NCBI taxon ranks from %r" % taxon)
-    taxon = read_taxon(taxon)
+
+    if index:
+        LOG.info("query NCBI taxon ranks by index of %r" % taxon)
+        taxon = open_taxon_index(taxon)
+    else:
+        LOG.info("reading NCBI taxon ranks from %r" % taxon)
+        # only the taxon ids of KEGG organisms are kept
+        taxon = read_taxon(taxon, set(org.values()))
 
     LOG.info("process KEGG Organisms ranks")
     for o, t in org.items():
+        line = taxon.get(t)
 
-        if t in taxon:
-            r[o] = taxon[t]
+        if line is not None:
+            r[o] = line
         else:
             LOG.info("taxon_id %r not in taxon file" % t)
 
+    if index:
+        taxon.close()
+
     return r
 
 
@@ -101,6 +282,9 @@ contact: %s <%s>\
     args.add_argument("--taxon", metavar="FILE", required=True,
                       help="NCBI Taxonomy file, taxon_id, rank information separated with tab")
     args.add_argument("--out", metavar="FILE", default="KEGG.ranks", help="output file (default: KEGG.ranks)")
+    args.add_argument("--index", action="store_true",
+                      help="query taxon file by a sorted index {taxon}.idx, which is built at the first run "
+                           "and reused until the taxon file changes")
 
     return args.parse_args()
 
@@ -115,7 +299,7 @@ def main():
 
     args = set_args()
 
-    org_dict = org2taxon(args.keg, args.taxon)
+    org_dict = org2taxon(args.keg, args.taxon, args.index)
 
     LOG.info("output result to %r" % args.out)
 
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+
+import string
+from operator import itemgetter
+from itertools import compress, count, tee
+from contextlib import contextmanager
+
+
+LEVELS = string.ascii_uppercase
+_first = itemgetter(slice(0, 1))
+_tag = itemgetter(0)
+
+
+def iter_htext(lines, levels=None, numbers=False, tags=True):
+    """
+    parse KEGG htext (.keg) in one pass, lines are streamed through C iterators which strip them,
+    select them by tag and pair them with their tags, so no Python code runs for each line before the caller
+    :param lines: iterator of lines of .keg, such as an opened file, see open_htext
+    :param levels: tags of lines to yield, such as "CD", the tag is the first char of the stripped line,
+                   all lines not empty are yielded if None, including the header lines like "+D", "#" and "!"
+    :param numbers: yield the line number before the tag
+    :param tags: pair lines with their tags, a reader of every line is faster taking line[0] itself
+    :return: iterator of (tag, line without spaces at both ends), or (line number, tag, line), in file order,
+             the tag is left out if not tags
+    """
+    lines = map(str.strip, lines)
+
+    if levels is None and not numbers:
+        # most files are read whole, the empty lines are the only ones dropped
+        lines = filter(None, lines)
+
+        if not tags:
+            return lines
+
+        lines, keys = tee(lines)
+
+        return zip(map(_tag, keys), lines)
+
+    lines, keys = tee(lines)
+
+    if levels is None:
+        selected = map(bool, keys)
+    else:
+        selected = map(frozenset(levels).__contains__, map(_first, keys))
+
+    if numbers:
+        selected, marks = tee(selected)
+
+    # the lines selected are never empty
+    lines = compress(lines, selected)
+
+    if numbers:
+        marks = compress(count(1), marks)
+
+    if not tags:
+        return zip(marks, lines) if numbers else lines
+
+    lines, keys = tee(lines)
+
+    if numbers:
+        return zip(marks, map(_tag, keys), lines)
+
+    return zip(map(_tag, keys), lines)
+
+
+@contextmanager
+def open_htext(file, levels=None, numbers=False, tags=True):
+    """
+    open .keg and stream it by iter_htext, the file is closed at the end of with
+    :param file: .keg file name
+    :return: see iter_htext
+    """
+    with open(file) as fh:
+        yield iter_htext(fh, levels, numbers, tags)
+
+
+def level_name(line):
+    """
+    name of A, B, C line, such as "Metabolism" of "A<b>Metabolism</b>"
+    """
+    name = line[1:].strip()
+
+    if name.startswith("<b>") and name.endswith("</b>"):
+        name = name[3:-4]
+
+    return name
@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import mmap
+import heapq
+import pickle
 import argparse
 import logging
+import tempfile
+from array import array
+from bisect import bisect_left
+from itertools import chain, islice, repeat
+from operator import sub
+from collections import defaultdict, deque
+from collections.abc import Mapping
 
-from common import __author__, __email__, __version__
+from common import KO_TABLE_MAGIC, MappedNames, file_stamp, load_ko_table, __author__, __email__, __version__
+from htext import open_htext
 
 LOG = logging.getLogger(__name__)
 
 __all__ = []
 
+# (pathway, ko, protein) of ProteinClusters is packed to a 64 bit key in these bits
+PATH_BITS = 14
+KO_BITS = 18
+PROTEIN_BITS = 32
+SPILL_SIZE = 1 << 20
+
 
 def read_tbl(file):
     """
@@ -28,12 +46,123 @@ def read_tbl(file):
         yield line.split("\t")
 
 
+def is_ko_table(file):
+    """
+    whether file is a binary columnar table written by common.dump_ko_table, such as {out}.pep2ko.kgt of makedb.py
+    """
+    with open(file, "rb") as fh:
+        return fh.read(len(KO_TABLE_MAGIC)) == KO_TABLE_MAGIC
+
+
+def read_ko_table(file):
+    """
+    read columnar pep2ko written by makedb.py --columnar, the file is mapped and only the names are decoded
+    :param file: .pep2ko.kgt
+    :return: common.KoTable, a row each protein
+    """
+    return load_ko_table(file)[0]
+
+
+def read_annotation(file):
+    """
+    read kegg annotation result of text or columnar format
+    :param file: kegg annotation result, see cluster_protein
+    :return: yield (protein, ko, pathways joined with ";")
+    """
+    if not is_ko_table(file):
+        for protein, ko, pathway in read_tbl(file):
+            yield protein, ko, pathway
+
+        return
+
+    for protein, kos, paths in read_ko_table(file).items():
+        yield protein, ";".join(kos) if kos else "-", ";".join(paths)
+
+
+class KoTableClusters(Mapping):
+    """
+    proteins of columnar pep2ko clustered by pathway and ko, a read only mapping
+    {pathway: {ko: [proteins]}} like the dict of cluster_protein.
+    the proteins of each pathway are indexed by arrays transposed from the CSR arrays of KoTable,
+    the dict of a pathway is only built when it is accessed, so no list of proteins is kept for all pathways
+    """
+
+    def __init__(self, table):
+        """
+        :param table: common.KoTable
+        """
+        self.table = table
+        ko_ptr, ko_idx = table.ko_ptr, table.ko_idx
+        path_ptr = table.path_ptr
+        # the ko of gene n is self.kos[self._labels[n]], KOs of a gene are joined with ";" and interned after the KOs
+        self.kos = list(table.kos)
+        ids = {}
+        self._labels = labels = array("I", [0]) * len(table.genes)
+
+        for n in range(len(table.genes)):
+            start, end = ko_ptr[n], ko_ptr[n+1]
+
+            if end - start == 1:
+                labels[n] = ko_idx[start]
+                continue
+
+            ko = ";".join([table.kos[i] for i in ko_idx[start:end]]) if end > start else "-"
+            k = ids.get(ko)
+
+            if k is None:
+                k = ids[ko] = len(self.kos)
+                self.kos.append(ko)
+
+            labels[n] = k
+
+        # the row of each pathway entry of table
+        rows = chain.from_iterable(map(repeat, range(len(table.genes)), map(sub, path_ptr[1:], path_ptr[:-1])))
+        # the rows of pathway p in the order of table, appended by C iterators, deque(maxlen=0) only runs them
+        self._rows = [array("I") for i in table.paths]
+        deque(map(array.append, map(self._rows.__getitem__, table.path_idx), rows), 0)
+        self._path_ids = {path: p for p, path in enumerate(table.paths) if self._rows[p]}
+        self._last = (None, None)
+
+    def __getitem__(self, path):
+        if self._last[0] == path:
+            return self._last[1]
+
+        genes = self.table.genes
+        rows = self._rows[self._path_ids[path]]
+        # {ko label: [rows]} in the order kos are first seen
+        groups = defaultdict(list)
+        deque(map(list.append, map(groups.__getitem__, map(self._labels.__getitem__, rows)), rows), 0)
+
+        if isinstance(genes, MappedNames):
+            r = {self.kos[k]: genes.take(i) for k, i in groups.items()}
+        else:
+            r = {self.kos[k]: [genes[n] for n in i] for k, i in groups.items()}
+
+        self._last = (path, r)
+
+        return r
+
+    def __contains__(self, path):
+        return path in self._path_ids
+
+    def __iter__(self):
+        return iter(self._path_ids)
+
+    def __len__(self):
+        return len(self._path_ids)
+
+
 def cluster_protein(file):
     """
     cluster protein by pathway and ko
-    :param file: kegg annotation result consist protein id, ko and pathways joined with "\t"
-    :return: dict {pathway: {ko: [proteins]}}
+    :param file: kegg annotation result consist protein id, ko and pathways joined with "\t",
+                 or the columnar .pep2ko.kgt of makedb.py
+    :return: dict {pathway: {ko: [proteins]}}, or KoTableClusters of .pep2ko.kgt
     """
+    if is_ko_table(file):
+        LOG.info("reading columnar kegg result from %r" % file)
+        return KoTableClusters(read_ko_table(file))
+
     path_dict = {}
     LOG.info("reading kegg result from '%r'" % file)
 
@@ -52,53 +181,459 @@ def cluster_protein(file):
     return path_dict
 
 
+def _read_keys(fh, size=1 << 16):
+    """
+    yield the keys of a run written by array.tofile
+    """
+    fh.seek(0)
+
+    while True:
+        keys = array("Q")
+
+        try:
+            keys.fromfile(fh, size)
+        except EOFError:
+            pass
+
+        if not keys:
+            break
+
+        for key in keys:
+            yield key
+
+
+class ProteinClusters(Mapping):
+    """
+    proteins clustered by pathway and ko for huge annotation results, a read only mapping
+    {pathway: {ko: [proteins]}} like the dict of cluster_protein.
+    kos and pathways are interned to integers, proteins are numbered by line and their names are kept on disk,
+    each (pathway, ko, protein) is a 64 bit key sorted in runs of temporary files and merged by finish,
+    then only the pathway accessed is loaded, so memory is bounded by spill_size and the largest pathway
+    """
+
+    def __init__(self, spill_size=SPILL_SIZE, tmp_dir=None):
+        """
+        :param spill_size: keys kept in memory before written to a run
+        :param tmp_dir: directory of temporary files, see tempfile
+        """
+        self.spill_size = spill_size
+        self.tmp_dir = tmp_dir
+        self.kos = []
+        self.paths = []
+        self._ko_ids = {}
+        self._path_ids = {}
+        # {pathways joined with ";": [shifted pathway ids]}, the same pathways repeat in many lines
+        self._path_keys = {}
+        self._proteins = 0
+        self._names = tempfile.TemporaryFile(dir=tmp_dir)
+        self._name_list = []
+        self._name_pos = 0
+        self._name_offsets = tempfile.TemporaryFile(dir=tmp_dir)
+        self._offsets = array("Q")
+        self._keys = array("Q")
+        self._runs = []
+        # {pathway id: (start, end)} of the merged keys
+        self._index = None
+        self._maps = []
+        self._last = (None, None)
+
+    def _intern(self, name, names, ids, bits, kind):
+        i = ids.get(name)
+
+        if i is None:
+            i = len(names)
+
+            if i >> bits:
+                raise ValueError("%r is over the %s distinct %s of the %s bits in a key, cluster without --spill" % (
+                    name, 1 << bits, kind, bits))
+
+            ids[name] = i
+            names.append(name)
+
+        return i
+
+    def add(self, protein, ko, pathway):
+        """
+        add a line of annotation result
+        :param protein: protein id
+        :param ko: ko
+        :param pathway: pathways joined with ";"
+        """
+        if self._index is not None:
+            raise ValueError("proteins added after finish")
+
+        n = self._proteins
+
+        if n >> PROTEIN_BITS:
+            raise ValueError("%r is over the %s proteins of the %s bits in a key, cluster without --spill" % (
+                protein, 1 << PROTEIN_BITS, PROTEIN_BITS))
+
+        self._proteins += 1
+        name = protein.encode() + b"\n"
+        self._offsets.append(self._name_pos)
+        self._name_list.append(name)
+        self._name_pos += len(name)
+
+        ko_id = self._ko_ids.get(ko)
+
+        if ko_id is None:
+            ko_id = self._intern(ko, self.kos, self._ko_ids, KO_BITS, "kos")
+
+        paths = self._path_keys.get(pathway)
+
+        if paths is None:
+            paths = self._path_keys[pathway] = [
+                self._intern(i, self.paths, self._path_ids, PATH_BITS, "pathways") << (KO_BITS + PROTEIN_BITS)
+                for i in pathway.split(";")]
+
+        key = ko_id << PROTEIN_BITS | n
+        self._keys.extend([i | key for i in paths])
+
+        if len(self._keys) >= self.spill_size:
+            self._spill()
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        array("Q", sorted(self._keys)).tofile(run)
+        self._runs.append(run)
+        self._keys = array("Q")
+        self._names.writelines(self._name_list)
+        self._name_list = []
+        self._offsets.tofile(self._name_offsets)
+        self._offsets = array("Q")
+
+    def finish(self):
+        """
+        merge the runs, no protein can be added after it
+        :return: self
+        """
+        self._spill()
+        array("Q", [self._name_pos]).tofile(self._name_offsets)
+
+        if len(self._runs) == 1:
+            merged = self._runs[0]
+        else:
+            merged = tempfile.TemporaryFile(dir=self.tmp_dir)
+            keys = heapq.merge(*[_read_keys(i) for i in self._runs])
+
+            while True:
+                chunk = array("Q", islice(keys, 1 << 16))
+
+                if not chunk:
+                    break
+
+                chunk.tofile(merged)
+
+            for run in self._runs:
+                run.close()
+
+        self._runs = []
+        self._keys = self._map(merged, "Q")
+        self._offsets = self._map(self._name_offsets, "Q")
+        self._names = self._map(self._names)
+        self._index = {}
+        shift = KO_BITS + PROTEIN_BITS
+
+        for n in range(len(self.paths)):
+            start = bisect_left(self._keys, n << shift)
+            end = bisect_left(self._keys, (n + 1) << shift, start)
+
+            if end > start:
+                self._index[n] = (start, end)
+
+        return self
+
+    def _map(self, fh, format=None):
+        fh.flush()
+
+        if not os.fstat(fh.fileno()).st_size:
+            fh.close()
+            return memoryview(b"").cast(format) if format else b""
+
+        r = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+        self._maps.append(r)
+
+        return memoryview(r).cast(format) if format else r
+
+    def protein(self, n):
+        """
+        :return: the name of protein number n
+        """
+        return self._names[self._offsets[n]:self._offsets[n+1]-1].decode()
+
+    def __getitem__(self, path):
+        if self._last[0] == path:
+            return self._last[1]
+
+        n = self._path_ids.get(path)
+
+        if self._index is None or n not in self._index:
+            raise KeyError(path)
+
+        start, end = self._index[n]
+        kos = self.kos
+        names = self._names
+        offsets = self._offsets
+        ko_mask = (1 << KO_BITS) - 1
+        protein_mask = (1 << PROTEIN_BITS) - 1
+        r = {}
+        ko_id = proteins = None
+
+        # keys of a pathway are sorted by ko then protein, the proteins of a ko keep the order of lines
+        for key in self._keys[start:end]:
+            if key >> PROTEIN_BITS & ko_mask != ko_id:
+                ko_id = key >> PROTEIN_BITS & ko_mask
+                proteins = r[kos[ko_id]] = []
+
+            p = key & protein_mask
+            proteins.append(names[offsets[p]:offsets[p+1]-1].decode())
+
+        self._last = (path, r)
+
+        return r
+
+    def __contains__(self, path):
+        return self._index is not None and self._path_ids.get(path) in self._index
+
+    def __iter__(self):
+        for n in sorted(self._index or ()):
+            yield self.paths[n]
+
+    def __len__(self):
+        return len(self._index or ())
+
+    def close(self):
+        """
+        release the mapped temporary files
+        """
+        for i in (self._keys, self._offsets):
+            if isinstance(i, memoryview):
+                i.release()
+
+        for i in self._maps:
+            i.close()
+
+        self._maps = []
+        self._last = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def cluster_protein_spill(file, spill_size=SPILL_SIZE, tmp_dir=None):
+    """
+    cluster protein by pathway and ko with bounded memory
+    :param file: kegg annotation result consist protein id, ko and pathways joined with "\t"
+    :param spill_size: see ProteinClusters
+    :param tmp_dir: directory of temporary files
+    :return: ProteinClusters, should be closed after use
+    """
+    r = ProteinClusters(spill_size, tmp_dir)
+    LOG.info("reading kegg result from %r with proteins spilled to disk" % file)
+
+    for protein, ko, pathway in read_annotation(file):
+        r.add(protein, ko, pathway)
+
+    return r.finish()
+
+
+class KoHierarchy(object):
+    """
+    the parsed KO hierarchy of ko00001.keg, split to blocks of
+    (lines not D, pathway id, [(ko, name)] of D lines under the pathway),
+    so that output only visits the D lines of pathways with proteins
+    """
+    VERSION = 1
+
+    def __init__(self, blocks, stamp=(0, 0)):
+        self.blocks = blocks
+        self.stamp = stamp
+
+    @classmethod
+    def from_keg(cls, keg):
+        """
+        parse ko00001.keg
+        :param keg:
+        :return: KoHierarchy
+        """
+        blocks = []
+        lines = []
+        entries = []
+        path_id = ""
+
+        LOG.info("reading KO hierarchy from %r" % keg)
+
+        with open_htext(keg) as events:
+            for tag, line in events:
+
+                if tag == "D":
+                    mess = line.split(None, 2)
+                    name = mess[2] if len(mess) == 3 else ""
+
+                    # names are joined by single spaces like " ".join(line.split()[2:])
+                    if "  " in name or "\t" in name:
+                        name = " ".join(name.split())
+
+                    entries.append((mess[1], name))
+                    continue
+
+                if entries:
+                    blocks.append(("".join(lines), path_id, entries))
+                    lines = []
+                    entries = []
+
+                if tag == "C":
+                    path_id = "ko" + line.split(None, 2)[1]
+
+                lines.append("%s\n" % line)
+
+        blocks.append(("".join(lines), path_id, entries))
+
+        return cls(blocks, file_stamp(keg))
+
+    def write(self, path_dict, fh):
+        """
+        write .keg of kegg annotation result
+        :param path_dict: see function cluster_protein
+        :param fh: output stream
+        :return: 0
+        """
+        parts = []
+
+        for text, path_id, entries in self.blocks:
+            parts.append(text)
+
+            if path_id not in path_dict:
+                continue
+
+            kos = path_dict[path_id]
+
+            for ko, name in entries:
+
+                if ko not in kos:
+                    continue
+
+                if ko == "-":
+                    parts += ["D      %s\t\n" % p for p in kos[ko]]
+                else:
+                    parts += ["D      %s\t%s %s\n" % (p, ko, name) for p in kos[ko]]
+
+            # written in pieces, the output of huge results may not fit in memory
+            if len(parts) >= 1 << 16:
+                fh.write("".join(parts))
+                parts = []
+
+        fh.write("".join(parts))
+
+        return 0
+
+
+def load_hierarchy(keg, cache_dir=None):
+    """
+    read ko00001.keg through a pickled cache, the cache is rebuilt if the mtime or size of keg changes
+    :param keg: ko00001.keg
+    :param cache_dir: directory of cache, no cache is used if None
+    :return: KoHierarchy
+    """
+    if not cache_dir:
+        return KoHierarchy.from_keg(keg)
+
+    stamp = file_stamp(keg)
+    cache = os.path.join(cache_dir, os.path.basename(keg) + ".pkl")
+
+    if os.path.exists(cache):
+        try:
+            # plain tuples are pickled, so the cache does not depend on the module name of KoHierarchy
+            with open(cache, "rb") as fh:
+                version, cache_stamp, blocks = pickle.load(fh)
+
+            if version == KoHierarchy.VERSION and cache_stamp == stamp:
+                return KoHierarchy(blocks, stamp)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, OSError) as e:
+            LOG.warning("cache %r is broken: %s" % (cache, e))
+
+    hierarchy = KoHierarchy.from_keg(keg)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    tmp = "%s.%s.tmp" % (cache, os.getpid())
+
+    with open(tmp, "wb") as fh:
+        pickle.dump((hierarchy.VERSION, hierarchy.stamp, hierarchy.blocks), fh, pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp, cache)
+
+    return hierarchy
+
+
 def output_keg(keg, path_dict, output):
     """
     output .keg by kegg annotation result
-    :param keg: ko00001.keg
+    :param keg: ko00001.keg or KoHierarchy
     :param path_dict: see function cluster_protein
     :param output: output file
     :return: 0
     """
-    path_id = ""
+    if not isinstance(keg, KoHierarchy):
+        keg = KoHierarchy.from_keg(keg)
 
     LOG.info("output kegg map to '%r'" % output)
-    fh = open(output, "w")
 
-    for line in open(keg):
-        line = line.strip()
+    with open(output, "w") as fh:
+        keg.write(path_dict, fh)
 
-        if not line:
-            continue
+    return 0
 
-        tag = line[0]
 
-        if tag == "C":
-            path_id = "ko" + line.split()[1]
-            fh.write("%s\n" % line)
-            continue
-        elif tag == "D":
+def sample_name(file):
+    """
+    name of sample from the file name of annotation result, such as "human" of "human.pep2ko.txt"
+    :param file:
+    :return: str
+    """
+    name = os.path.basename(file)
 
-            if path_id not in path_dict:
-                continue
+    for suffix in (".pep2ko.txt", ".pep2ko.kgt", ".txt", ".tsv", ".kgt"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
 
-            mess = line.split()
-            ko = mess[1]
-            name = " ".join(mess[2:])
+    return name
 
-            if ko not in path_dict[path_id]:
-                continue
 
-            for p in path_dict[path_id][ko]:
+def make_kegs(keg, files, prefix, cache_dir=None, spill_dir=None):
+    """
+    output .keg of many annotation results with the KO hierarchy read once
+    :param keg: ko00001.keg
+    :param files: list of kegg annotation results
+    :param prefix: output prefix, outputs are {prefix}.keg for one file, {prefix}.{sample}.keg for more
+    :param cache_dir: directory to cache parsed ko00001.keg
+    :param spill_dir: cluster proteins in temporary files of this directory, see cluster_protein_spill
+    :return: list of output files
+    """
+    hierarchy = load_hierarchy(keg, cache_dir)
+    r = []
+
+    for file in files:
 
-                if ko == "-":
-                    fh.write("D      %s\t\n" % p)
-                else:
-                    fh.write("D      %s\t%s %s\n" % (p, ko, name))
+        if len(files) == 1:
+            output = prefix + ".keg"
         else:
-            fh.write("%s\n" % line)
+            output = "%s.%s.keg" % (prefix, sample_name(file))
 
-    return 0
+        if spill_dir:
+            with cluster_protein_spill(file, tmp_dir=spill_dir) as path_dict:
+                output_keg(hierarchy, path_dict, output)
+        else:
+            output_keg(hierarchy, cluster_protein(file), output)
+
+        r.append(output)
+
+    return r
 
 
 def set_args():
@@ -113,9 +648,15 @@ contact: %s <%s>\
 
     args.add_argument("--keg", metavar="FILE", required=True,
                       help="KO file downloaded from KEGG, usually named 'ko00001.keg'")
-    args.add_argument("--in", metavar="FILE", dest="input", required=True,
-                      help="KEGG annotation result consist protein id, KO, pathway joined with '\t'")
+    args.add_argument("--in", metavar="FILE", dest="input", nargs="+", required=True,
+                      help="KEGG annotation result consist protein id, KO, pathway joined with '\t', "
+                           "or .pep2ko.kgt of makedb.py --columnar, many files are output to {out}.{sample}.keg")
     args.add_argument("--out", metavar="STR", default="out", help="output prefix (default: out)")
+    args.add_argument("--cache", metavar="DIR", default=None,
+                      help="directory to cache parsed KO file, reused if it not changed (default: no cache)")
+    args.add_argument("--spill", metavar="DIR", default=None,
+                      help="cluster proteins in temporary files of DIR with bounded memory, "
+                           "for annotation results of huge number of proteins (default: in memory)")
 
     return args.parse_args()
 
@@ -130,8 +671,7 @@ def main():
 
     args = set_args()
 
-    path_dict = cluster_protein(args.input)
-    output_keg(args.keg, path_dict, args.out+".keg")
+    make_kegs(args.keg, args.input, args.out, args.cache, args.spill)
 
 
 if __name__ == "__main__":
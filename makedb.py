@@ -4,9 +4,13 @@
 import os.path
 import sys
 import argparse
+import heapq
 import logging
 
-from common import read_org, read_org_ko, __email__, __version__, __author__
+from common import read_org, load_org_ko_table, dump_ko_table, process_pool, KoTableBuilder, RankIndex, \
+    __email__, __version__, __author__
+from FastaReader import yield_fasta_index
+from ProteinDB import ProteinIndexWriter
 
 
 LOG = logging.getLogger(__name__)
@@ -14,33 +18,293 @@ LOG = logging.getLogger(__name__)
 
 __all__ = []
 
+BUFFER_SIZE = 1 << 20
 
-def cat_proteins(org, pep, keg, out):
 
-    pep_out = open(out+".pep.fasta", "w")
-    ko_out = open(out+".pep2ko.txt", "w")
-    num = len(org)
+def copy_file(file, fd):
+    """
+    append file to the file descriptor fd, copied in kernel if possible
+    :param file: input file name
+    :param fd: file descriptor opened for writing
+    :return: bytes copied
+    """
+    size = os.path.getsize(file)
+    done = 0
+
+    with open(file, "rb") as fh:
+        src = fh.fileno()
+
+        try:
+            if hasattr(os, "copy_file_range"):
+                copy = os.copy_file_range
+            else:
+                copy = lambda i, o, n: os.sendfile(o, i, None, n)
+
+            while done < size:
+                sent = copy(src, fd, size - done)
+
+                if not sent:
+                    break
+
+                done += sent
+        except OSError:
+            # the file system or platform does not support copy in kernel
+            pass
+
+        fh.seek(done)
+
+        while True:
+            chunk = fh.read(BUFFER_SIZE)
+
+            if not chunk:
+                break
+
+            done += len(chunk)
+            chunk = memoryview(chunk)
+
+            # os.write may write only a part of chunk, such as to a pipe or when interrupted
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+
+    return done
+
+
+def format_pep2ko(args):
+    """
+    format the genes of .keg as lines of pep2ko
+    :param args: (.keg file, cache directory)
+    :return: str
+    """
+    keg_file, cache = args
+    lines = []
+
+    for k, kos, paths in load_org_ko_table(keg_file, cache).items():
+        if kos:
+            ko = ";".join(kos)
+        else:
+            ko = "-"
+
+        lines.append("%s\t%s\t%s\n" % (k, ko, ";".join(paths)))
+
+    return "".join(lines)
+
+
+def add_pep2ko(builder, text):
+    """
+    add pep2ko lines to a columnar table, "-" of no KO is stored as no KO
+    :param builder: KoTableBuilder
+    :param text: pep2ko lines, see format_pep2ko
+    :return: number of rows added
+    """
+    num = 0
+
+    for line in text.splitlines():
+        gene, ko, path = line.split("\t")
+        builder.add(gene, [] if ko == "-" else ko.split(";"), path.split(";") if path else [])
+        num += 1
+
+    return num
+
+
+def index_proteins(pep_file, offset, text, fai, index):
+    """
+    add the proteins of an organism to .fai and protein index
+    :param pep_file: {org}.pep.fasta
+    :param offset: offset of pep_file in the database
+    :param text: pep2ko lines of the organism, see format_pep2ko
+    :param fai: output stream of .fai
+    :param index: ProteinIndexWriter
+    :return: 0
+    """
+    genes = {}
+
+    for line in text.splitlines():
+        gene, ko, path = line.split("\t")
+        genes[gene] = (ko, path)
+
+    with open(pep_file, "rb") as fh:
+        for entry in yield_fasta_index(fh, offset):
+            fai.write("%s\t%s\t%s\t%s\t%s\n" % entry)
+            # proteins are named as {org}:{gene}
+            ko, path = genes.get(entry[0].split(":", 1)[-1], ("", ""))
+            index.add(entry[0], ko, path, *entry[1:])
+
+    return 0
+
+
+def select_orgs(org, pep, keg):
+    """
+    get organisms have both .pep.fasta and .keg, duplicates are removed and the order is kept
+    :param org: list of organism abbr.
+    :param pep: directory contains {org}.pep.fasta
+    :param keg: directory contains {org}00001.keg
+    :return: list of (org, pep file, keg file)
+    """
+    r = []
+    seen = set()
+
+    for o in org:
+        if o in seen:
+            continue
+
+        seen.add(o)
 
-    for n, o in enumerate(set(org)):
-        LOG.info("%s/%s process %s" % (n+1, num, o))
         pep_file = os.path.join(pep, "%s.pep.fasta" % o)
         keg_file = os.path.join(keg, "%s00001.keg" % o)
 
         if os.path.exists(pep_file) and os.path.exists(keg_file):
-            pep_out.write(open(pep_file).read())
+            r.append((o, pep_file, keg_file))
+        else:
+            LOG.warning("%r has no .keg or .pep.fasta" % o)
 
-            for k, v in read_org_ko(keg_file).items():
-                if v["ko"]:
-                    ko = ";".join(v["ko"])
-                else:
-                    ko = "-"
+    return r
 
-                ko_out.write("%s\t%s\t%s\n" % (k, ko, ";".join(v["path"])))
-        else:
-            LOG.warning("%r has no .keg or .pep.fasta")
 
-    pep_out.close()
-    ko_out.close()
+def cat_proteins(org, pep, keg, out, cache=None, threads=1, index=False, columnar=False):
+    """
+    concatenate proteins and KOs of organisms in the order of org,
+    .keg are parsed in a process pool while proteins are copied
+    :param org: list of organism abbr.
+    :param pep: directory contains {org}.pep.fasta
+    :param keg: directory contains {org}00001.keg
+    :param out: output prefix
+    :param cache: directory to cache parsed .keg
+    :param threads: number of processes to parse .keg
+    :param index: create {out}.pep.fasta.fai and {out}.pep.idx for ProteinDB
+    :param columnar: also write pep2ko to the binary columnar {out}.pep2ko.kgt, see common.dump_ko_table
+    :return: 0
+    """
+    orgs = select_orgs(org, pep, keg)
+    tasks = [(keg_file, cache) for o, pep_file, keg_file in orgs]
+
+    num = len(orgs)
+    pep_out = os.open(out+".pep.fasta", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    ko_out = open(out+".pep2ko.txt", "w")
+    offset = 0
+    builder = KoTableBuilder() if columnar else None
+
+    if index:
+        fai = open(out+".pep.fasta.fai", "w")
+        writer = ProteinIndexWriter(out+".pep.idx")
+
+    try:
+        with process_pool(threads) as imap:
+            for n, ((o, pep_file, keg_file), text) in enumerate(zip(orgs, imap(format_pep2ko, tasks))):
+                LOG.info("%s/%s process %s" % (n+1, num, o))
+                size = copy_file(pep_file, pep_out)
+                ko_out.write(text)
+
+                if builder is not None:
+                    add_pep2ko(builder, text)
+
+                if index:
+                    index_proteins(pep_file, offset, text, fai, writer)
+
+                offset += size
+
+        if index:
+            LOG.info("write index of %s proteins" % writer.close())
+
+        if builder is not None:
+            LOG.info("write %s rows of pep2ko to %s" % (len(builder), out+".pep2ko.kgt"))
+            dump_ko_table(builder.table(), out+".pep2ko.kgt")
+    finally:
+        os.close(pep_out)
+        ko_out.close()
+
+        if index:
+            fai.close()
+
+    return 0
+
+
+def count_proteins(pep_file):
+    """
+    count proteins and residues of fasta
+    :param pep_file:
+    :return: (proteins, residues)
+    """
+    proteins = residues = 0
+
+    with open(pep_file, "rb") as fh:
+        for entry in yield_fasta_index(fh):
+            proteins += 1
+            residues += entry[1]
+
+    return proteins, residues
+
+
+def split_shards(sizes, num):
+    """
+    assign items to shards balanced by size, the largest item goes to the lightest shard first
+    :param sizes: list of item size
+    :param num: number of shards
+    :return: list of the shard of each item
+    """
+    r = [0] * len(sizes)
+    heap = [(0, i) for i in range(num)]
+
+    for n in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        load, shard = heapq.heappop(heap)
+        r[n] = shard
+        heapq.heappush(heap, (load + sizes[n], shard))
+
+    return r
+
+
+def _cat_proteins(args):
+    return cat_proteins(*args)
+
+
+def shard_proteins(org, pep, keg, out, shards, cache=None, threads=None, index=False, columnar=False):
+    """
+    split organisms to shards balanced by residues and build the database of each shard concurrently,
+    shard n is written to {out}.{n}.pep.fasta and {out}.{n}.pep2ko.txt, listed in {out}.shards.txt
+    with the .pep2ko.kgt, .pep.fasta.fai and .pep.idx of the shard if they are created
+    :param org: list of organism abbr.
+    :param pep: directory contains {org}.pep.fasta
+    :param keg: directory contains {org}00001.keg
+    :param out: output prefix
+    :param shards: number of shards
+    :param cache: directory to cache parsed .keg
+    :param threads: number of processes, min(shards, number of CPUs) if None
+    :param index: create index of each shard, see cat_proteins
+    :param columnar: also write {out}.{n}.pep2ko.kgt, see cat_proteins
+    :return: 0
+    """
+    orgs = select_orgs(org, pep, keg)
+
+    if threads is None:
+        threads = min(shards, os.cpu_count() or 1)
+
+    with process_pool(threads) as imap:
+        LOG.info("count residues of %s organisms" % len(orgs))
+        counts = list(imap(count_proteins, [i[1] for i in orgs]))
+        assign = split_shards([i[1] for i in counts], shards)
+        tasks = []
+        stats = []
+
+        for n in range(shards):
+            members = [i for i, s in enumerate(assign) if s == n]
+            prefix = "%s.%s" % (out, n + 1)
+            # organisms keep the order of org in each shard
+            tasks.append(([orgs[i][0] for i in members], pep, keg, prefix, cache, 1, index, columnar))
+            stats.append((prefix, len(members), sum(counts[i][0] for i in members),
+                          sum(counts[i][1] for i in members)))
+
+        LOG.info("write %s shards" % shards)
+        list(imap(_cat_proteins, tasks))
+
+    with open(out + ".shards.txt", "w") as fh:
+        # the files of --columnar and --index are "-" if not created
+        fh.write("#shard\tpep\tpep2ko\torganisms\tproteins\tresidues\tpep2ko_kgt\tfai\tidx\n")
+
+        for n, (prefix, num, proteins, residues) in enumerate(stats):
+            fh.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+                n + 1, prefix + ".pep.fasta", prefix + ".pep2ko.txt", num, proteins, residues,
+                prefix + ".pep2ko.kgt" if columnar else "-",
+                prefix + ".pep.fasta.fai" if index else "-",
+                prefix + ".pep.idx" if index else "-"))
 
     return 0
 
@@ -55,13 +319,31 @@ version: %s
 contact: %s <%s>\
     """ % (__version__, " ".join(__author__), __email__))
 
-    args.add_argument("--org", metavar="FILE", required=True,
+    args.add_argument("--org", metavar="FILE", default=None,
                       help="a list of KEGG organism abbr. at the first column")
+    args.add_argument("--ranks", metavar="FILE", default=None,
+                      help="KEGG.ranks created by get_ranks.py, used with --rank")
+    args.add_argument("--rank", metavar="STR", action="append", default=[],
+                      help="select organisms by rank in --ranks, such as 'Bacteria' or 'genus=Escherichia', "
+                           "can be set many times to select organisms matched all")
     args.add_argument("--keg", metavar="DIR", required=True,
                       help="directory contains {org}00001.keg")
     args.add_argument("--pep", metavar="DIR", required=True,
                       help="directory contains {org}.pep.fasta.gz from NCBI")
     args.add_argument("--out", metavar="STR", default="kegg", help="output prefix (default: kegg)")
+    args.add_argument("--cache", metavar="DIR", default=None,
+                      help="directory to cache parsed .keg, reused if .keg not changed (default: no cache)")
+    args.add_argument("--threads", metavar="INT", type=int, default=None,
+                      help="number of processes to parse .keg, or to build shards in parallel with --shards "
+                           "(default: 1, min(shards, CPUs) with --shards)")
+    args.add_argument("--shards", metavar="INT", type=int, default=1,
+                      help="split database to shards balanced by residues, written to {out}.{n}.* and "
+                           "listed in {out}.shards.txt (default: 1)")
+    args.add_argument("--index", action="store_true",
+                      help="create {out}.pep.fasta.fai and sorted index {out}.pep.idx for random access")
+    args.add_argument("--columnar", action="store_true",
+                      help="also write {out}.pep2ko.kgt, a binary columnar pep2ko loaded by make_keg.py "
+                           "much faster than the text")
 
     return args.parse_args()
 
@@ -76,9 +358,30 @@ def main():
 
     args = set_args()
 
-    orgs = read_org(args.org)
+    if not args.org and not args.rank:
+        raise Exception("--org or --rank is required")
+
+    orgs = [i[0] for i in read_org(args.org)] if args.org else None
+
+    if args.rank:
+        if not args.ranks:
+            raise Exception("--ranks is required by --rank")
+
+        selected = RankIndex(args.ranks).select(args.rank)
+
+        if orgs is None:
+            orgs = selected
+        else:
+            selected = set(selected)
+            orgs = [i for i in orgs if i in selected]
+
+        LOG.info("%s organisms selected" % len(orgs))
 
-    cat_proteins([i[0] for i in orgs], args.pep, args.keg, args.out)
+    if args.shards > 1:
+        shard_proteins(orgs, args.pep, args.keg, args.out, args.shards, args.cache, args.threads,
+                       args.index, args.columnar)
+    else:
+        cat_proteins(orgs, args.pep, args.keg, args.out, args.cache, args.threads or 1, args.index, args.columnar)
 
 
 if __name__ == "__main__":
@@ -4,15 +4,26 @@
 
 import argparse
 import logging
+import math
 import sys
+from array import array
 from collections import OrderedDict
+from xml.sax.saxutils import escape
 
 from common import __author__, __email__, __version__
+from htext import level_name, open_htext
 
 LOG = logging.getLogger(__name__)
 
 __all__ = []
 
+COLORS = ["blue", "green", "red", "purple", "skyblue", "orange", "gray"]
+FONT_FAMILY = "Arial"
+# FontProperties by size, see _font
+_FONTS = {}
+# text paths of labels by (text, font size), the names of pathways are the same in every figure
+_TEXT_PATHS = {}
+
 
 def stat_keg(keg):
     """
@@ -25,54 +36,350 @@ def stat_keg(keg):
     LOG.info("reading kegg map from %r" % keg)
 
     path1 = ""
-    path2 = ""
+    proteins = None
+
+    # D lines are the most, they are appended to the list of the last B
+    with open_htext(keg, "ABD") as events:
+        for tag, line in events:
+
+            if tag == "D":
+                proteins.append(line.split(None, 2)[1])
+            elif "<b>" not in line:
+                continue
+            elif tag == "A":
+                path1 = line[4:-4]
+                r[path1] = OrderedDict()
+            else:
+                proteins = r[path1][line[6:-4]] = []
+
+    return r
+
 
-    for line in open(keg):
-        line = line.strip()
+class KegCounts(object):
+    """
+    the number of distinct proteins in each A, B and C level of .keg,
+    rows are in the order of .keg, a row is identified by the names from A to its level
+    """
+    LEVELS = "ABC"
+
+    def __init__(self, rows, parents, counts):
+        """
+        :param rows: list of (level, names from A to the level)
+        :param parents: row number of the parent of each row, -1 for A
+        :param counts: number of distinct proteins of each row
+        """
+        self.rows = rows
+        self.parents = parents
+        self.counts = counts
+
+    @classmethod
+    def from_keg(cls, keg):
+        """
+        count proteins of .keg in one pass, proteins are interned to integers
+        :param keg: .keg file
+        :return: KegCounts
+        """
+        LOG.info("counting proteins of %r" % keg)
+
+        with open_htext(keg, "ABCD") as events:
+            return cls.from_events((tag, line.split(None, 2)[1] if tag == "D" else line) for tag, line in events)
+
+    @classmethod
+    def from_hierarchy(cls, hierarchy, path_dict):
+        """
+        count proteins of the .keg written by hierarchy.write(path_dict, fh) without reading it again
+        :param hierarchy: make_keg.KoHierarchy
+        :param path_dict: see make_keg.cluster_protein
+        :return: KegCounts
+        """
+        return cls.from_events(cls._hierarchy_events(hierarchy, path_dict))
+
+    @classmethod
+    def _hierarchy_events(cls, hierarchy, path_dict):
+        for text, path_id, entries in hierarchy.blocks:
+            for line in text.splitlines():
+                if line[0] in cls.LEVELS:
+                    yield line[0], line
+
+            if path_id not in path_dict:
+                continue
 
-        if not line:
-            continue
+            kos = path_dict[path_id]
+
+            for ko, name in entries:
+                if ko in kos:
+                    for protein in kos[ko]:
+                        yield "D", protein
+
+    @classmethod
+    def from_events(cls, events):
+        """
+        count proteins of htext lines, proteins are interned to integers
+        :param events: (tag, line) of A, B and C lines and (tag, protein) of D lines in the order of .keg
+        :return: KegCounts
+        """
+        rows = []
+        parents = array("i")
+        ids = {}
+        # {row key: row number}, rows of the same names are merged
+        row_ids = {}
+        # the row and the protein number of each D line
+        hit_rows = array("I")
+        hit_proteins = array("I")
+        current = [-1, -1, -1]
+
+        for tag, line in events:
+
+            if tag == "D":
+                row = max(current)
+
+                if row < 0:
+                    continue
+
+                n = ids.get(line)
+
+                if n is None:
+                    n = ids[line] = len(ids)
+
+                hit_rows.append(row)
+                hit_proteins.append(n)
+                continue
 
-        tag = line[0]
+            name = level_name(line)
 
-        if tag == "A" and "<b>" in line:
-            path1 = line[4:-4]
-            r[path1] = OrderedDict()
-            continue
+            # the empty B lines only separate categories
+            if not name:
+                continue
 
-        if tag == "B" and "<b>" in line:
-            path2 = line[6:-4]
-            r[path1][path2] = []
-            continue
+            level = cls.LEVELS.index(tag)
+            parent = current[level-1] if level else -1
 
-        if tag == "D":
-            r[path1][path2].append(line.split()[1])
+            if level and parent < 0:
+                continue
 
-    return r
+            key = (parent, name)
+
+            if key not in row_ids:
+                row_ids[key] = len(rows)
+                names = rows[parent][1] + (name,) if level else (name,)
+                rows.append((tag, names))
+                parents.append(parent)
+
+            current[level] = row_ids[key]
+
+            for i in range(level + 1, len(current)):
+                current[i] = -1
+
+        return cls(rows, parents, count_distinct(hit_rows, hit_proteins, parents, len(ids)))
+
+    @classmethod
+    def from_dict(cls, keg_dict):
+        """
+        :param keg_dict: see stat_keg
+        :return: KegCounts of A and B levels
+        """
+        rows = []
+        parents = array("i")
+        counts = array("I")
+
+        for path1 in keg_dict:
+            parent = len(rows)
+            rows.append(("A", (path1,)))
+            parents.append(-1)
+            counts.append(len(set(p for i in keg_dict[path1].values() for p in i)))
+
+            for path2 in keg_dict[path1]:
+                rows.append(("B", (path1, path2)))
+                parents.append(parent)
+                counts.append(len(set(keg_dict[path1][path2])))
+
+        return cls(rows, parents, counts)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        """
+        :return: yield (level, names, number of proteins)
+        """
+        for (level, names), count in zip(self.rows, self.counts):
+            yield level, names, int(count)
+
+    def select(self, level):
+        """
+        :param level: "A", "B" or "C"
+        :return: list of (names, number of proteins) of the level
+        """
+        return [(names, count) for tag, names, count in self if tag == level]
+
+    def write(self, file):
+        """
+        write the counts as TSV: level, A, B, C, number of proteins
+        :param file: output file
+        :return: 0
+        """
+        LOG.info("output protein counts to %r" % file)
+
+        with open(file, "w") as fh:
+            fh.write("#level\tA\tB\tC\tproteins\n")
+
+            for level, names, count in self:
+                names = names + ("",) * (len(self.LEVELS) - len(names))
+                fh.write("%s\t%s\t%s\n" % (level, "\t".join(names), count))
+
+        return 0
+
+
+def count_distinct(rows, proteins, parents, num):
+    """
+    count distinct proteins of each row and its ancestors,
+    numpy is used if available
+    :param rows: row of each hit
+    :param proteins: protein number of each hit
+    :param parents: parent of each row, -1 for no parent
+    :param num: number of distinct proteins
+    :return: array of the number of proteins of each row
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is None:
+        return _count_sets(rows, proteins, parents)
+
+    return _count_numpy(np, rows, proteins, parents, num)
+
+
+def _count_sets(rows, proteins, parents):
+    sets = [set() for i in parents]
+
+    for row, protein in zip(rows, proteins):
+        while row >= 0:
+            sets[row].add(protein)
+            row = parents[row]
+
+    return array("I", [len(i) for i in sets])
+
+
+def _count_numpy(np, rows, proteins, parents, num):
+    parents = np.frombuffer(parents, dtype=np.int32) if len(parents) else np.zeros(0, dtype=np.int32)
+    rows = np.frombuffer(rows, dtype=np.uint32).astype(np.int64) if len(rows) else np.zeros(0, dtype=np.int64)
+    proteins = np.frombuffer(proteins, dtype=np.uint32).astype(np.int64) if len(proteins) else rows
+    all_rows = [rows]
+    all_proteins = [proteins]
+
+    # hits are expanded to all their ancestors first, as a protein may be hit at many depths of a branch
+    while len(rows):
+        up = parents[rows]
+        keep = up >= 0
+        rows, proteins = up[keep].astype(np.int64), proteins[keep]
+        all_rows.append(rows)
+        all_proteins.append(proteins)
+
+    keys = np.unique(np.concatenate(all_rows) * max(num, 1) + np.concatenate(all_proteins))
+
+    return np.bincount(keys // max(num, 1), minlength=len(parents))
+
+
+def count_keg(keg):
+    """
+    count distinct proteins of each A, B and C level of .keg
+    :param keg: .keg file
+    :return: KegCounts
+    """
+    return KegCounts.from_keg(keg)
+
+
+def plot_groups(keg_dict):
+    """
+    the bars to plot
+    :param keg_dict: KegCounts, or the dict of stat_keg
+    :return: list of (pathway_A, [(pathway_B, number of proteins)]), pathway_B without protein is not included
+    """
+    if not isinstance(keg_dict, KegCounts):
+        keg_dict = KegCounts.from_dict(keg_dict)
+
+    groups = OrderedDict()
+
+    for level, names, num in keg_dict:
+        if level == "A":
+            groups[names[0]] = []
+        elif level == "B" and num:
+            groups[names[0]].append((names[1], num))
+
+    return list(groups.items())
+
+
+def _font(size):
+    """
+    FontProperties of FONT_FAMILY shared by all texts of a size, the family is looked up only once
+    and replaced by the default family if it is not installed
+    """
+    if size in _FONTS:
+        return _FONTS[size]
+
+    from matplotlib.font_manager import FontProperties, findfont
+
+    if "family" not in _FONTS:
+        try:
+            findfont(FontProperties(family=FONT_FAMILY), fallback_to_default=False)
+            _FONTS["family"] = FONT_FAMILY
+        except ValueError:
+            LOG.warning("font %r not found, use the default font" % FONT_FAMILY)
+            _FONTS["family"] = FontProperties().get_family()
+
+    _FONTS[size] = FontProperties(family=_FONTS["family"], size=size)
+
+    return _FONTS[size]
+
+
+def _text_collection(fig, ax, labels, font):
+    """
+    one collection of text paths for many labels, left aligned and vertically centered at their positions
+    :param fig: the Figure
+    :param ax: the Axes of the positions
+    :param labels: list of (x, y, text, color)
+    :param font: FontProperties
+    :return: PathCollection
+    """
+    from matplotlib.collections import PathCollection
+    from matplotlib.textpath import TextPath
+    from matplotlib.transforms import Affine2D
+
+    size = font.get_size_in_points()
+    paths = []
+
+    for x, y, text, color in labels:
+        if (text, size) not in _TEXT_PATHS:
+            # the path is in points from the baseline, about half of the cap height is below the center
+            _TEXT_PATHS[text, size] = TextPath((0, size * -0.3), text, prop=font)
+
+        paths.append(_TEXT_PATHS[text, size])
+
+    return PathCollection(paths, offsets=[(x, y) for x, y, text, color in labels], offset_transform=ax.transData,
+                          transform=Affine2D().scale(1 / 72) + fig.dpi_scale_trans,
+                          facecolors=[color for x, y, text, color in labels], edgecolors="none", clip_on=False)
 
 
 def plot_keg(keg_dict, out):
     """
-    plot function
-    :param keg_dict: see stat_keg
-    :param out: output filename
+    plot function, the figure is drawn by the canvas of the output format without pyplot
+    :param keg_dict: KegCounts, or the dict of stat_keg
+    :param out: output filename, the format is decided by the extension
     :return: 0
     """
+    groups = plot_groups(keg_dict)
     x = []
     y = []
     n = 1
 
-    for path1 in keg_dict:
+    for path1, paths in groups:
         x.append(n)
         y.append(0)
         n += 1
 
-        for path2 in keg_dict[path1]:
-            num = len(set(keg_dict[path1][path2]))
-
-            if not num:
-                continue
-
+        for path2, num in paths:
             x.append(n)
             y.append(num)
             n += 1
@@ -80,47 +387,138 @@ def plot_keg(keg_dict, out):
     y_max = max(y) * 1.1
 
     colors = []
-    color = ["", "blue", "green", "red", "purple", "skyblue", "orange", "gray"]
     lv = 0
     n = 1
 
     LOG.info("plot KEGG annotation result to %r" % out)
-    from matplotlib import pyplot as plt
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    fig = plt.figure(figsize=(8, 8))
+    fig = Figure(figsize=(8, 8))
+    FigureCanvasAgg(fig)
     ax = fig.add_subplot(111, )
+    font = _font(8)
+    # all labels are (x, y, text, color), drawn as one collection instead of an artist per label
+    labels = []
 
-    for path1 in keg_dict:
+    for path1, paths in groups:
 
         colors.append("white")
         lv += 1
-        ax.text(y_max / -1.7, n, path1, fontsize=8, verticalalignment='center', horizontalalignment='left', family="Arial",
-                color=color[lv])
+        color = COLORS[(lv - 1) % len(COLORS)]
+        labels.append((y_max / -1.7, n, path1, color))
         n += 1
 
-        for path2 in keg_dict[path1]:
+        for path2, num in paths:
 
-            num = len(set(keg_dict[path1][path2]))
-
-            if not num:
-                continue
-
-            ax.text(num, n, num, fontsize=8, verticalalignment='center', family="Arial",)
-            ax.text(y_max / -1.8, n, path2, fontsize=8, verticalalignment='center', horizontalalignment='left', family="Arial",
-                    color=color[lv])
-            colors.append(color[lv])
+            labels.append((num, n, str(num), "black"))
+            labels.append((y_max / -1.8, n, path2, color))
+            colors.append(color)
             n += 1
 
+    ax.add_collection(_text_collection(fig, ax, labels, font), autolim=False)
     ax.barh(x, y, color=colors, alpha=0.5)
     ax.set_xlim([y_max / -100, y_max])
     ax.set_ylim([0, ax.get_ylim()[1]])
-    plt.xticks(fontsize=8, family="Arial",)
+
+    for label in ax.get_xticklabels():
+        label.set_fontproperties(font)
+
     ax.set_yticks([])
-    plt.subplots_adjust(top=0.95, left=0.35, right=0.95, bottom=0.05)
-    plt.xlabel("Number of Genes", fontsize=10, family="Arial",)
+    fig.subplots_adjust(top=0.95, left=0.35, right=0.95, bottom=0.05)
+    ax.set_xlabel("Number of Genes", fontproperties=_font(10))
 
     ax.invert_yaxis()
-    plt.savefig(out)
+    # savefig switches to the canvas of the format, such as pdf
+    fig.savefig(out)
+
+    return 0
+
+
+def _nice_step(value, num=8):
+    """
+    a step of 1, 2, 2.5 or 5 times power of 10 to split value into about num ticks
+    """
+    step = value / num
+    power = 10 ** math.floor(math.log10(step)) if step > 0 else 1
+
+    for i in (1, 2, 2.5, 5, 10):
+        if step <= i * power:
+            return i * power
+
+    return 10 * power
+
+
+def write_svg(keg_dict, out, width=576, height=576):
+    """
+    write the plot of plot_keg as SVG without matplotlib
+    :param keg_dict: KegCounts, or the dict of stat_keg
+    :param out: output filename
+    :param width: width in points
+    :param height: height in points
+    :return: 0
+    """
+    groups = plot_groups(keg_dict)
+    rows = sum(len(paths) + 1 for path1, paths in groups)
+    y_max = max([num for path1, paths in groups for path2, num in paths] or [0]) * 1.1 or 1
+    x_min = y_max / -100
+    # the axes and data limits are the same as plot_keg
+    left, right, top, bottom = width * 0.35, width * 0.95, height * 0.05, height * 0.95
+
+    def px(value):
+        return left + (value - x_min) / (y_max - x_min) * (right - left)
+
+    def py(row):
+        # the bars of rows 1 to rows have 5% margins like the autoscale of matplotlib
+        return top + row / (rows + 0.4 + 0.05 * (rows - 0.2)) * (bottom - top)
+
+    LOG.info("plot KEGG annotation result to %r" % out)
+    font = 'font-family="%s, Helvetica, sans-serif"' % FONT_FAMILY
+    bar = (py(1) - py(0)) * 0.8
+    parts = ['<g %s font-size="8" dominant-baseline="central">\n' % font]
+    bars = [
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%spt" height="%spt" viewBox="0 0 %s %s">\n' % (
+            width, height, width, height),
+        '<rect width="%s" height="%s" fill="white"/>\n' % (width, height),
+        '<g fill-opacity="0.5">\n'
+    ]
+    n = 1
+
+    for lv, (path1, paths) in enumerate(groups):
+        color = COLORS[lv % len(COLORS)]
+        parts.append('<text x="%.2f" y="%.2f" fill="%s">%s</text>\n' % (px(y_max / -1.7), py(n), color, escape(path1)))
+        n += 1
+
+        for path2, num in paths:
+            parts.append('<text x="%.2f" y="%.2f" fill="%s">%s</text>\n' % (
+                px(y_max / -1.8), py(n), color, escape(path2)))
+            parts.append('<text x="%.2f" y="%.2f">%s</text>\n' % (px(num), py(n), num))
+            bars.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s"/>\n' % (
+                px(0), py(n) - bar / 2, px(num) - px(0), bar, color))
+            n += 1
+
+    # bars are drawn under texts
+    bars.append('</g>\n')
+    parts = bars + parts
+    parts.append('</g>\n<g %s font-size="8" text-anchor="middle">\n' % font)
+    parts.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="none" stroke="black" stroke-width="0.8"/>\n' % (
+        left, top, right - left, bottom - top))
+    step = _nice_step(y_max)
+    tick = 0
+
+    while tick <= y_max:
+        parts.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" stroke="black" stroke-width="0.8"/>\n' % (
+            px(tick), bottom, px(tick), bottom + 3.5))
+        parts.append('<text x="%.2f" y="%.2f">%s</text>\n' % (px(tick), bottom + 12, ("%f" % tick).rstrip("0").rstrip(".")))
+        tick += step
+
+    parts.append('<text x="%.2f" y="%.2f" font-size="10">Number of Genes</text>\n' % (
+        (left + right) / 2, bottom + 24))
+    parts.append('</g>\n</svg>\n')
+
+    with open(out, "w") as fh:
+        fh.write("".join(parts))
 
     return 0
 
@@ -138,6 +536,10 @@ contact: %s <%s>\
     args.add_argument("--keg", metavar="FILE", required=True,
                       help="KO file named '*.keg', can be make by make_keg.py")
     args.add_argument("--out", metavar="STR", default="out", help="output prefix (default: out)")
+    args.add_argument("--table", action="store_true",
+                      help="also output the number of proteins of each A, B, C level to {out}.tsv")
+    args.add_argument("--svg", action="store_true",
+                      help="plot to {out}.svg by the built-in SVG writer instead of {out}.pdf, matplotlib is not needed")
 
     return args.parse_args()
 
@@ -151,8 +553,15 @@ def main():
     )
 
     args = set_args()
-    keg_dict = stat_keg(args.keg)
-    plot_keg(keg_dict, args.out+".pdf")
+    counts = count_keg(args.keg)
+
+    if args.table:
+        counts.write(args.out+".tsv")
+
+    if args.svg:
+        write_svg(counts, args.out+".svg")
+    else:
+        plot_keg(counts, args.out+".pdf")
 
 
 if __name__ == "__main__":
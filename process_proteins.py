@@ -6,26 +6,28 @@ import os
 import argparse
 import logging
 
-from common import read_org_ko, read_org, __email__, __version__, __author__
-from FastaReader import open_fasta
+from common import load_org_ko_table, process_pool, read_org, __email__, __version__, __author__
+from FastaReader import open_fasta, ncbi_gene_id
 
 
 LOG = logging.getLogger(__name__)
 
 __all__ = []
 
+BUFFER_SIZE = 1 << 20
 
-def process_protein(org, keg, pep, out):
+
+def process_protein(org, keg, pep, out, cache=None):
     """
     get the protein seq of with ko
     :param org: the organism abbr.
     :param keg: directory contains org.keg
     :param pep: directory contains org.pep.fasta.gz
     :param out: output directory
+    :param cache: directory to cache parsed .keg
     :return:
     """
 
-    r = []
     keg_name = os.path.join(keg, "%s00001.keg" % org)
     pep_name = os.path.join(pep, "%s.pep.fasta.gz" % org)
 
@@ -37,57 +39,95 @@ def process_protein(org, keg, pep, out):
         LOG.info("pep %r not exists, skip" % pep_name)
         return "%s\tno protein" % org
 
-    gene_dict = read_org_ko(keg_name)
+    gene_dict = load_org_ko_table(keg_name, cache)
 
     if not gene_dict:
         LOG.info("keg %r is empty, skip" % keg_name)
         return "%s\t keg is empty" % org
 
-    records = []
-
-    for record in open_fasta(pep_name):
-        name = record.name
+    out_name = os.path.join(out, "%s.pep.fasta" % org)
+    tmp_name = out_name + ".tmp"
+    # records are written as they are read, the temporary file is renamed only if any id matched
 
-        # gene_id is in db_xref or locus_tag
+    try:
+        with open(tmp_name, "wb", buffering=BUFFER_SIZE) as fh:
+            matched = write_proteins(org, open_fasta(pep_name, lazy=True, validate=False), gene_dict, fh)
 
-        if "locus_tag=" in name:
-            id = name.split("locus_tag=")[1].split("]")[0]
-        elif "db_xref=GeneID:" in name:
-            id = name.split("db_xref=GeneID:")[1].split("]")[0]
-        elif "protein_id=" in name:
-            id = name.split("protein_id=")[1].split("]")[0].split(".")[0]
+        if matched:
+            os.replace(tmp_name, out_name)
         else:
+            os.remove(tmp_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    if matched:
+        return 0
+    else:
+        return "%s\tpep not match with keg" % org
+
+
+def write_proteins(org, records, gene_dict, fh):
+    """
+    write the records named by gene id to fh
+    :param org: the organism abbr.
+    :param records: fasta records
+    :param gene_dict: genes with ko
+    :param fh: binary output stream
+    :return: True if any gene id in gene_dict
+    """
+    matched = False
+
+    for record in records:
+        # gene_id is in locus_tag, db_xref or protein_id
+        id = ncbi_gene_id(record.name)
+
+        if id is None:
             continue
 
         if id in gene_dict:
-            r.append(id)
+            matched = True
 
-        records.append(">%s:%s\n%s\n" % (org, id, record.seq))
+        fh.write((">%s:%s\n" % (org, id)).encode())
+        fh.write(record.raw_seq)
+        fh.write(b"\n")
+
+    return matched
 
-    if r:
-        with open(os.path.join(out, "%s.pep.fasta" % org), "w") as fh:
-            fh.write("".join(records))
-        return 0
-    else:
-        return "%s\tpep not match with keg" % org
 
+def _process_protein(args):
+    return process_protein(*args)
 
-def process_proteins(orgs, keg, pep, out):
+
+def process_proteins(orgs, keg, pep, out, threads=1, cache=None):
     """
     get the protein seq of ids in keg from pep
+    :param orgs: list of organism abbr.
     :param keg:
     :param pep:
     :param out:
-    :return:
+    :param threads: number of processes
+    :param cache: directory to cache parsed .keg
+    :return: list of failed status returned by process_protein
     """
 
     num = len(orgs)
+    tasks = [(org, keg, pep, out, cache) for org in orgs]
+
+    # small chunks keep the workers balanced, proteome sizes vary a lot
+    chunksize = max(1, min(8, num // (max(threads, 1) * 4)))
+    returns = []
 
-    for n, org in enumerate(orgs):
-        LOG.info("%s/%s process %s" % (n+1, num, org))
-        process_protein(org, keg, pep, out)
+    with process_pool(threads) as imap:
+        for n, result in enumerate(imap(_process_protein, tasks, chunksize=chunksize)):
+            LOG.info("%s/%s processed %s" % (n+1, num, orgs[n]))
+            returns.append(result)
 
-    return 0
+    fail = [i for i in returns if i]
+    LOG.info("%s success, %s failed" % (num-len(fail), len(fail)))
+
+    return fail
 
 
 def set_args():
@@ -107,6 +147,10 @@ contact: %s <%s>\
     args.add_argument("--pep", metavar="DIR", required=True,
                       help="directory contains {org}.pep.fasta.gz from NCBI")
     args.add_argument("--out", metavar="DIR", default=".", help="output directory (default: current directory)")
+    args.add_argument("--threads", metavar="INT", type=int, default=1,
+                      help="number of processes to process organisms (default: 1)")
+    args.add_argument("--cache", metavar="DIR", default=None,
+                      help="directory to cache parsed .keg, reused if .keg not changed (default: no cache)")
 
     return args.parse_args()
 
@@ -122,7 +166,10 @@ def main():
     args = set_args()
 
     orgs = read_org(args.org)
-    process_proteins([i[0] for i in orgs], args.keg, args.pep, args.out)
+    fail = process_proteins([i[0] for i in orgs], args.keg, args.pep, args.out, args.threads, args.cache)
+
+    if fail:
+        print("\n".join(fail))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import multiprocessing
+import struct
+import sys
+
+import pytest
+
+from common import KoTableBuilder, RankIndex, dump_ko_table, load_ko_table, load_org_ko_table, process_pool, \
+    read_org_ko_table
+
+
+RANKS = """\
+# org\ttaxon_id\tlineage
+eco\t511145\tBacteria\t\tProteobacteria\tGammaproteobacteria\tEnterobacterales\tEnterobacteriaceae\tEscherichia\tEscherichia coli
+bsu\t224308\tBacteria\t\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\tBacillus subtilis
+hsa\t9606\tEukaryota\tMetazoa\tChordata\tMammalia\tPrimates\tHominidae\tHomo\tHomo sapiens
+ecs\t386585\tBacteria\t\tProteobacteria\tGammaproteobacteria\tEnterobacterales\tEnterobacteriaceae\tEscherichia\tEscherichia coli
+xyz\t1\tBacteria\t\tOtherphylum\tOtherclass\tOtherorder\tOtherfamily\tEscherichia
+"""
+
+
+def test_rank_index_select(tmp_path):
+    path = str(tmp_path / "KEGG.ranks")
+
+    with open(path, "w") as fh:
+        fh.write(RANKS)
+
+    index = RankIndex(path)
+
+    assert index.select(["Bacteria"]) == ["eco", "bsu", "ecs", "xyz"]
+    # the same genus name under two families
+    assert index.select(["genus=Escherichia"]) == ["eco", "ecs", "xyz"]
+    assert index.select(["Proteobacteria", "Escherichia"]) == ["eco", "ecs"]
+    assert index.select(["species=Escherichia"]) == []
+    assert index.select(["kingdom="]) == []
+
+
+def build_table():
+    builder = KoTableBuilder()
+    builder.add("p1", ["K00001", "K00002"], ["ko00010"])
+    builder.add("p2", ["K00002"], [])
+    builder.add("p3", [], ["ko00010", "ko00020"])
+
+    return builder.table()
+
+
+def table_rows(table):
+    return list(table.genes), table.kos, table.paths, list(table.ko_ptr), list(table.ko_idx), \
+        list(table.path_ptr), list(table.path_idx)
+
+
+def test_ko_table_is_little_endian(tmp_path):
+    path = str(tmp_path / "pep2ko.kgt")
+    table = build_table()
+    dump_ko_table(table, path, (1, 2))
+
+    with open(path, "rb") as fh:
+        data = fh.read()
+
+    # the four arrays end the file, ko_ptr first
+    num = len(table.ko_ptr) + len(table.ko_idx) + len(table.path_ptr) + len(table.path_idx)
+    values = struct.unpack("<%sI" % num, data[len(data) - num * 4:])
+    assert list(values[:len(table.ko_ptr)]) == list(table.ko_ptr)
+
+    loaded, stamp = load_ko_table(path)
+    assert stamp == (1, 2)
+    assert table_rows(loaded) == table_rows(table)
+
+
+
+def test_broken_ko_table_cache_is_rebuilt(tmp_path):
+    keg = str(tmp_path / "org00001.keg")
+
+    with open(keg, "w") as fh:
+        fh.write("A<b>Metabolism</b>\nC    00010 Glycolysis [PATH:ko00010]\n"
+                 "D      p1 HK1\tK00844 HK; hexokinase\nD      p2 GCK\tK12407 GCK; glucokinase\n")
+
+    cache = str(tmp_path / "cache")
+    expect = list(read_org_ko_table(keg).items())
+    assert list(load_org_ko_table(keg, cache).items()) == expect
+
+    kgt = str(tmp_path / "cache" / "org00001.keg.kgt")
+
+    with open(kgt, "rb") as fh:
+        data = fh.read()
+
+    for broken in (data[:len(data) // 2], data[:80] + bytes([data[80] ^ 1]) + data[81:]):
+        with open(kgt, "wb") as fh:
+            fh.write(broken)
+
+        assert list(load_org_ko_table(keg, cache).items()) == expect
+
+    # the arrays stay readable as views of the map
+    table = load_ko_table(kgt)[0]
+    assert isinstance(table.ko_idx, memoryview) or sys.byteorder == "big"
+    assert table.get_kos("p2") == ["K12407"]
+
+
+def _square(n):
+    if n < 0:
+        raise ValueError("negative %s" % n)
+
+    return n * n
+
+
+def test_process_pool():
+    for threads in (1, 2):
+        with process_pool(threads) as imap:
+            assert list(imap(_square, range(10), chunksize=3)) == [i * i for i in range(10)]
+            assert sorted(imap(_square, range(10), ordered=False)) == [i * i for i in range(10)]
+
+    # the workers are terminated when a task raises
+    with pytest.raises(ValueError):
+        with process_pool(2) as imap:
+            list(imap(_square, [1, -1, 2]))
+
+    assert not multiprocessing.active_children()
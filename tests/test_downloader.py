@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from downloader import HTTPClient, HTTPError, Manifest, sync_file
+
+
+DATA = bytes(range(256)) * 64
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, so the client can reuse its connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers), self.client_address))
+        status, headers, body = self.server.routes[self.path](self)
+        self.send_response(status)
+
+        for key, value in headers.items():
+            self.send_header(key, value)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_range(handler):
+    """
+    the DATA of ETAG, a Range request is answered by 206 only if If-Range matches ETAG
+    """
+    start = handler.headers.get("Range")
+    if_range = handler.headers.get("If-Range")
+
+    if not start or if_range not in (None, ETAG):
+        return 200, {"ETag": ETAG}, DATA
+
+    start = int(start[len("bytes="):-1])
+
+    if start >= len(DATA):
+        return 416, {"Content-Range": "bytes */%s" % len(DATA)}, b""
+
+    return 206, {"ETag": ETAG, "Content-Range": "bytes %s-%s/%s" % (start, len(DATA) - 1, len(DATA))}, DATA[start:]
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    httpd.routes = {"/data": serve_range}
+    httpd.url = "http://127.0.0.1:%s" % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client():
+    client = HTTPClient(retries=2, backoff=0, timeout=10)
+
+    yield client
+
+    client.close()
+
+
+def test_connection_is_kept_alive(server, client):
+    for i in range(3):
+        assert client.fetch(server.url + "/data") == DATA
+
+    assert len(set(address for path, headers, address in server.requests)) == 1
+
+
+def test_close_connections_of_all_threads(server, client):
+    threads = [threading.Thread(target=client.fetch, args=(server.url + "/data",)) for i in range(3)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conns = list(client._conns)
+    client.close()
+
+    assert len(conns) == 3
+    assert all(conn.sock is None for conn in conns)
+    # the connection closed by another thread is not used again
+    assert client.fetch(server.url + "/data") == DATA
+
+
+def test_retry_server_error(server, client):
+    replies = [503, 502]
+    server.routes["/busy"] = lambda handler: (replies.pop(0), {}, b"busy") if replies else (200, {}, b"ok")
+    server.routes["/down"] = lambda handler: (500, {}, b"down")
+
+    assert client.fetch(server.url + "/busy") == b"ok"
+    assert len(server.requests) == 3
+
+    with pytest.raises(HTTPError) as e:
+        client.fetch(server.url + "/down")
+
+    assert e.value.status == 500
+    assert len(server.requests) == 3 + 3
+
+
+def test_resume_part(server, client, tmp_path):
+    file = str(tmp_path / "data")
+    url = server.url + "/data"
+
+    with open(file + ".part", "wb") as fh:
+        fh.write(DATA[:1000])
+    with open(file + ".part.json", "w") as fh:
+        json.dump({"url": url, "etag": ETAG}, fh)
+
+    meta = client.download(url, file)
+    headers = server.requests[-1][1]
+
+    assert (headers["Range"], headers["If-Range"]) == ("bytes=1000-", ETAG)
+    assert meta["size"] == len(DATA) and meta["etag"] == ETAG
+    assert open(file, "rb").read() == DATA
+    assert not os.path.exists(file + ".part") and not os.path.exists(file + ".part.json")
+
+
+def test_resume_part_of_changed_file(server, client, tmp_path):
+    file = str(tmp_path / "data")
+    url = server.url + "/data"
+
+    with open(file + ".part", "wb") as fh:
+        fh.write(b"x" * 1000)
+    with open(file + ".part.json", "w") as fh:
+        json.dump({"url": url, "etag": '"v0"'}, fh)
+
+    meta = client.download(url, file)
+
+    # If-Range does not match, the whole file is sent and .part is written again
+    assert server.requests[-1][1]["If-Range"] == '"v0"'
+    assert meta["size"] == len(DATA)
+    assert open(file, "rb").read() == DATA
+
+
+def test_complete_part(server, client, tmp_path):
+    file = str(tmp_path / "data")
+    url = server.url + "/data"
+
+    with open(file + ".part", "wb") as fh:
+        fh.write(DATA)
+    with open(file + ".part.json", "w") as fh:
+        json.dump({"url": url, "etag": ETAG}, fh)
+
+    # 416 Range Not Satisfiable of a range at the end of file
+    assert client.download(url, file) == {"size": len(DATA)}
+    assert open(file, "rb").read() == DATA
+
+
+def test_sync_file_skips_unchanged(server, client, tmp_path):
+    file = str(tmp_path / "data")
+    url = server.url + "/data"
+    manifest = Manifest(str(tmp_path / "manifest.json"), save_every=1)
+    etags = [ETAG]
+
+    def serve(handler):
+        if handler.headers.get("If-None-Match") == etags[-1]:
+            return 304, {"ETag": etags[-1]}, b""
+
+        return 200, {"ETag": etags[-1]}, DATA
+
+    server.routes["/data"] = serve
+
+    assert sync_file(client, url, file, manifest)
+    record = Manifest(manifest.file).get("data")
+    assert (record["url"], record["etag"], record["size"]) == (url, ETAG, len(DATA))
+
+    # 304 Not Modified by ETag
+    assert not sync_file(client, url, file, manifest)
+    assert server.requests[-1][1]["If-None-Match"] == ETAG
+
+    # a new ETag of the same content is downloaded, but the file is not changed by sha256
+    etags.append('"v2"')
+    assert not sync_file(client, url, file, manifest)
+    assert manifest.get("data")["etag"] == '"v2"'
+    assert manifest.get("data")["sha256"] == record["sha256"]
@@ -0,0 +1,27 @@
+from FastaReader import ncbi_gene_id, parse_ncbi_header
+
+
+HEADERS = [
+    ("lcl|NC_000964.3_prot_NP_387882.1_1 [gene=dnaA] [locus_tag=BSU_00010] [db_xref=GeneID:939978] "
+     "[protein_id=NP_387882.1] [gbkey=CDS]", "BSU_00010"),
+    ("lcl|NW_003315947.1_prot_XP_003307542.1_1 [db_xref=GeneID:10018766] [protein_id=XP_003307542.1]", "10018766"),
+    # GeneID is not the first of db_xref
+    ("lcl|NC_000001.11_prot_NP_001005484.2_1 [db_xref=CCDS:CCDS30547.2,GeneID:79501] "
+     "[protein_id=NP_001005484.2]", "NP_001005484"),
+    ("lcl|CP000001.1_prot_AAB00001.1_7 [gene=yaaA] [protein_id=AAB00001.1] [gbkey=CDS]", "AAB00001"),
+    ("lcl|CP000001.1_prot_1 [gene=yaaA]", None),
+]
+
+
+def test_parse_ncbi_header():
+    name = HEADERS[0][0]
+    fields = {"locus_tag": "BSU_00010", "GeneID": "939978", "protein_id": "NP_387882.1"}
+
+    assert parse_ncbi_header(name) == fields
+    assert parse_ncbi_header(name.encode()) == {k.encode(): v.encode() for k, v in fields.items()}
+
+
+def test_ncbi_gene_id():
+    for name, id in HEADERS:
+        assert ncbi_gene_id(name) == id
+        assert ncbi_gene_id(name.encode()) == (id.encode() if id else None)
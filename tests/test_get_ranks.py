@@ -0,0 +1,43 @@
+import struct
+
+from get_ranks import TAXON_INDEX_HEADER, TaxonIndex, build_taxon_index, read_taxon
+
+
+RANKS = [
+    "#taxon_id\tkingdom\tphylum\tclass\torder\tfamily\tgenus\tspecies",
+    "9606\tMetazoa\tChordata\tMammalia\tPrimates\tHominidae\tHomo\tHomo sapiens",
+    "562\tBacteria\tProteobacteria\tGammaproteobacteria\tEnterobacterales\tEnterobacteriaceae\tEscherichia\tEscherichia coli",
+    "",
+    "1423\tBacteria\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\tBacillus subtilis",
+    "unclassified\t-\t-\t-\t-\t-\t-\t-",
+    "10090\tMetazoa\tChordata\tMammalia\tRodentia\tMuridae\tMus\tMus musculus",
+]
+
+
+def test_taxon_index_match_read_taxon(tmp_path):
+    file = str(tmp_path / "taxonomy.ranks")
+    index = file + ".idx"
+
+    # the ids are not sorted, the last line has no line end
+    with open(file, "w") as fh:
+        fh.write("\n".join(RANKS))
+
+    assert build_taxon_index(file, index) == 4
+
+    # the header and the sorted ids are little endian
+    with open(index, "rb") as fh:
+        data = fh.read()
+
+    num = TAXON_INDEX_HEADER.unpack_from(data, 0)[-1]
+    assert struct.unpack_from("<4Q", data, TAXON_INDEX_HEADER.size) == (562, 1423, 9606, 10090)
+
+    expect = read_taxon(file)
+
+    with TaxonIndex(file, index) as taxon:
+        assert len(taxon) == num == 4
+
+        for taxon_id in ("562", "1423", "9606", 10090):
+            assert taxon.get(taxon_id) == expect[str(taxon_id)]
+
+        for taxon_id in ("1", "600", "99999", "unclassified", ""):
+            assert taxon_id not in taxon
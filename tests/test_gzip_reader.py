@@ -0,0 +1,35 @@
+import gzip
+
+import GzipReader
+from GzipReader import build_gzip_index, open_gzip, write_gzip_index
+
+
+def write_members(path, parts):
+    with open(path, "wb") as fh:
+        for part in parts:
+            fh.write(gzip.compress(part))
+
+
+def test_single_member_with_index_is_streamed(tmp_path, monkeypatch):
+    path = str(tmp_path / "one.gz")
+    data = b"ACGT\n" * 100000
+    write_members(path, [data])
+    write_gzip_index(build_gzip_index(path), path + ".gzi")
+
+    def inflate_parallel(*args, **kwargs):
+        raise AssertionError("a single member should not be decompressed in parallel")
+
+    monkeypatch.setattr(GzipReader, "inflate_parallel", inflate_parallel)
+
+    with open_gzip(path, threads=2) as fh:
+        assert fh.read() == data
+
+
+def test_members_with_index_are_parallel(tmp_path):
+    path = str(tmp_path / "many.gz")
+    parts = [b"%d\n" % i * 1000 for i in range(8)]
+    write_members(path, parts)
+    write_gzip_index(build_gzip_index(path), path + ".gzi")
+
+    with open_gzip(path, threads=2) as fh:
+        assert fh.read() == b"".join(parts)
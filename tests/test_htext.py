@@ -0,0 +1,19 @@
+from htext import iter_htext
+
+
+LINES = ["+D\tKO\n", "A<b>Metabolism</b>\n", "\n", "  C    00010 Glycolysis [PATH:ko00010]\n",
+         "D      3098\tK00844 HK; hexokinase\n", "   \n"]
+
+
+def test_iter_htext_strips_before_tag():
+    assert list(iter_htext(LINES, "CD")) == [
+        ("C", "C    00010 Glycolysis [PATH:ko00010]"), ("D", "D      3098\tK00844 HK; hexokinase")]
+    assert [i[:2] for i in iter_htext(LINES, "CD", numbers=True)] == [(4, "C"), (5, "D")]
+
+
+def test_iter_htext_all_lines():
+    events = list(iter_htext(LINES))
+
+    assert [tag for tag, line in events] == ["+", "A", "C", "D"]
+    assert list(iter_htext(LINES, tags=False)) == [line for tag, line in events]
+    assert [n for n, tag, line in iter_htext(LINES, numbers=True)] == [1, 2, 4, 5]
@@ -0,0 +1,60 @@
+import pytest
+
+import make_keg
+from common import KoTableBuilder, dump_ko_table
+from make_keg import KoTableClusters, ProteinClusters, cluster_protein, cluster_protein_spill
+from makedb import add_pep2ko
+
+
+PEP2KO = """\
+hsa:1\tK00844\tko00010;ko00051
+hsa:2\tK00844;K12407\tko00010
+hsa:3\t-\tko00051
+hsa:4\tK00001\tko00010;ko00051;ko01100
+hsa:5\tK00844\tko00010
+"""
+
+
+def write_pep2ko(tmp_path):
+    text = str(tmp_path / "test.pep2ko.txt")
+    columnar = str(tmp_path / "test.pep2ko.kgt")
+
+    with open(text, "w") as fh:
+        fh.write(PEP2KO)
+
+    builder = KoTableBuilder()
+    add_pep2ko(builder, PEP2KO)
+    dump_ko_table(builder.table(), columnar)
+
+    return text, columnar
+
+
+def test_columnar_clusters_match_text(tmp_path):
+    text, columnar = write_pep2ko(tmp_path)
+    expect = cluster_protein(text)
+    clusters = cluster_protein(columnar)
+
+    assert isinstance(clusters, KoTableClusters)
+    assert dict(clusters) == expect
+    assert clusters["ko00010"] == {"K00844": ["hsa:1", "hsa:5"], "K00844;K12407": ["hsa:2"], "K00001": ["hsa:4"]}
+    assert "ko00020" not in clusters and len(clusters) == 3
+
+
+def test_spill_clusters_match_memory(tmp_path):
+    for file in write_pep2ko(tmp_path):
+        expect = cluster_protein(file)
+
+        # a run of 2 keys, so the keys are merged from runs
+        with cluster_protein_spill(file, spill_size=2, tmp_dir=str(tmp_path)) as clusters:
+            assert dict(clusters) == dict(expect)
+            assert "ko00020" not in clusters and len(clusters) == 3
+
+
+def test_spill_ids_over_bits(monkeypatch):
+    monkeypatch.setattr(make_keg, "PATH_BITS", 1)
+
+    with ProteinClusters() as clusters:
+        clusters.add("hsa:1", "K00844", "ko00010;ko00051")
+
+        with pytest.raises(ValueError, match="'ko01100' is over the 2 distinct pathways of the 1 bits"):
+            clusters.add("hsa:2", "K00844", "ko00010;ko01100")
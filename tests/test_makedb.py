@@ -0,0 +1,35 @@
+import os
+
+import makedb
+from makedb import copy_file
+
+
+def test_copy_file_short_writes(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    data = os.urandom(100000)
+
+    with open(src, "wb") as fh:
+        fh.write(data)
+
+    def copy_file_range(*args):
+        raise OSError("not supported")
+
+    write = os.write
+
+    def short_write(fd, data):
+        # at most 1000 bytes each time
+        return write(fd, data[:1000])
+
+    monkeypatch.setattr(makedb.os, "copy_file_range", copy_file_range, raising=False)
+    monkeypatch.setattr(makedb.os, "sendfile", copy_file_range, raising=False)
+    monkeypatch.setattr(makedb.os, "write", short_write)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+
+    try:
+        assert copy_file(src, fd) == len(data)
+    finally:
+        os.close(fd)
+
+    with open(dst, "rb") as fh:
+        assert fh.read() == data
@@ -0,0 +1,64 @@
+import os
+from array import array
+
+import pytest
+
+from make_keg import KoHierarchy, cluster_protein, output_keg
+from plot_keg import KegCounts, count_distinct, count_keg, plot_keg, _count_numpy, _count_sets
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples")
+
+
+def mixed_depth():
+    # A0 -> B1 -> (C2, C3), A0 -> B4, proteins are hit both at B and at C under it
+    parents = array("i", [-1, 0, 1, 1, 0])
+    hits = [(1, 0), (2, 0), (2, 1), (3, 1), (4, 2), (2, 2), (3, 3)]
+    rows = array("I", [i[0] for i in hits])
+    proteins = array("I", [i[1] for i in hits])
+
+    return rows, proteins, parents, 4
+
+
+def test_count_sets_mixed_depth():
+    assert list(_count_sets(*mixed_depth()[:3])) == [4, 4, 3, 2, 1]
+
+
+def test_count_numpy_agree_with_sets():
+    np = pytest.importorskip("numpy")
+    rows, proteins, parents, num = mixed_depth()
+
+    assert list(_count_numpy(np, rows, proteins, parents, num)) == list(_count_sets(rows, proteins, parents))
+
+
+def test_count_distinct_empty():
+    assert list(count_distinct(array("I"), array("I"), array("i", [-1, 0]), 0)) == [0, 0]
+
+
+def test_counts_from_hierarchy_match_written_keg(tmp_path):
+    hierarchy = KoHierarchy.from_keg(os.path.join(EXAMPLES, "ko00001.keg"))
+    path_dict = cluster_protein(os.path.join(EXAMPLES, "human.pep2ko.txt"))
+    output_keg(hierarchy, path_dict, str(tmp_path / "human.keg"))
+    counts = KegCounts.from_hierarchy(hierarchy, path_dict)
+    expect = count_keg(str(tmp_path / "human.keg"))
+
+    assert counts.rows == expect.rows
+    assert list(counts.counts) == list(expect.counts)
+
+
+def test_plot_keg_labels_in_one_collection(tmp_path, monkeypatch):
+    pytest.importorskip("matplotlib")
+    from matplotlib.figure import Figure
+
+    axes = []
+    add_subplot = Figure.add_subplot
+
+    def keep_axes(self, *args, **kwargs):
+        axes.append(add_subplot(self, *args, **kwargs))
+        return axes[-1]
+
+    monkeypatch.setattr(Figure, "add_subplot", keep_axes)
+    plot_keg(count_keg(os.path.join(EXAMPLES, "human.keg")), str(tmp_path / "human.png"))
+
+    assert os.path.getsize(str(tmp_path / "human.png"))
+    assert not axes[0].texts
+    assert len(axes[0].collections) == 1
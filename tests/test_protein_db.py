@@ -0,0 +1,83 @@
+import pytest
+
+from makedb import index_proteins
+from ProteinDB import ProteinDB, ProteinIndexWriter
+
+
+# {org: (proteins, pep2ko lines of genes without org)},
+# hsa:3 is not in pep2ko, eco:b0001 has no KO and an empty seq
+ORGS = {
+    "hsa": ([("hsa:10327", "MAASRLLLLG" * 7 + "MA"), ("hsa:1", "MSMLVVFLLLWGVTWGPVTEA"), ("hsa:3", "MKW")],
+            "10327\tK00002\tko00010;ko00040\n1\tK06091;K06092\tko04610\n"),
+    "eco": ([("eco:b0002", "MRVLKFGGTS" * 20 + "VAN"),
+             ("eco:b0001", "")],
+            "b0002\tK12524\tko00260;ko00270;ko00300\nb0001\t-\t\n"),
+}
+
+
+def write_fasta(file, proteins, width=60):
+    with open(file, "w") as fh:
+        for name, seq in proteins:
+            fh.write(">%s description\n" % name)
+
+            for i in range(0, len(seq), width):
+                fh.write(seq[i:i+width] + "\n")
+
+
+@pytest.fixture
+def db(tmp_path):
+    prefix = str(tmp_path / "db")
+    offset = 0
+
+    # a run of 2 entries, so the index is merged from runs
+    writer = ProteinIndexWriter(prefix + ".pep.idx", run_size=2)
+
+    with open(prefix + ".pep.fasta", "wb") as out, open(prefix + ".pep.fasta.fai", "w") as fai:
+        for org, (proteins, text) in ORGS.items():
+            pep_file = str(tmp_path / ("%s.pep.fasta" % org))
+            write_fasta(pep_file, proteins)
+            index_proteins(pep_file, offset, text, fai, writer)
+
+            with open(pep_file, "rb") as fh:
+                offset += out.write(fh.read())
+
+    assert writer.close() == 5
+
+    with ProteinDB(prefix) as db:
+        yield db
+
+
+def test_get_seq(db):
+    assert len(db) == 5
+
+    for proteins, text in ORGS.values():
+        for name, seq in proteins:
+            assert name in db
+            assert db.get_seq(name) == seq
+
+
+def test_get_annotation(db):
+    assert db.get_annotation("hsa:10327") == (["K00002"], ["ko00010", "ko00040"])
+    assert db.get_annotation("hsa:1") == (["K06091", "K06092"], ["ko04610"])
+    assert db.get_annotation("eco:b0001") == (["-"], [])
+    assert db.get_annotation("hsa:3") == ([], [])
+
+
+def test_find(db, tmp_path):
+    # eco follows hsa in the database
+    offset = (tmp_path / "hsa.pep.fasta").stat().st_size + len(">eco:b0002 description\n")
+
+    assert db.find("eco:b0002") == [("eco:b0002", ["K12524"], ["ko00260", "ko00270", "ko00300"],
+                                     len(ORGS["eco"][0][0][1]), offset, 60, 61)]
+    # ids sort next to the id searched but are not the same
+    assert db.find("hsa:10") == []
+    assert db.find("hsa:2") == []
+
+
+def test_missing_id(db):
+    assert "hsa:2" not in db
+
+    with pytest.raises(KeyError):
+        db.get_seq("hsa:2")
+    with pytest.raises(KeyError):
+        db.get_annotation("zzz:1")